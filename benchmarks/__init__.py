@@ -0,0 +1,6 @@
+"""
+Benchmarks package.
+
+Standalone performance measurements for the eComSync API. Each module can
+be run with ``python -m benchmarks.<module>``.
+"""
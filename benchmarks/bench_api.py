@@ -0,0 +1,433 @@
+"""
+API benchmark suite.
+
+Measures every resource registered in ecomsync/api.py against a synthetic
+catalog and order table of a given scale (10^3 to 10^6 orders), through
+the Flask test client and through a real WSGI server (Werkzeug's threaded
+server on a local port, with keep-alive connections). Each scenario sends
+a number of requests from concurrent clients and reports the latency
+percentiles, throughput and error count as JSON lines.
+
+The results of a whole run can be written to a JSON file and compared
+with an earlier one; scenarios whose p50 latency or throughput got worse
+than the tolerance are reported as regressions and make the run fail.
+
+Usage:
+    python -m benchmarks.bench_api --scale 1000 --scale 100000 \\
+        --transport client --transport wsgi --output results.json
+    python -m benchmarks.bench_api --scale 1000 --baseline results.json
+
+The overhead of the per-endpoint metrics is the difference between a run
+with --disable-metrics saved as the baseline and a run without it.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import platform
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import select
+from werkzeug.serving import make_server
+
+from ecomsync import db
+from ecomsync.datagen import BRANDS, generate
+from ecomsync.jobs import enqueue_orders
+from ecomsync.models import ApiKey, Product
+from ecomsync.stock import reserve
+from ecomsync.utils import ApiKeyStore
+from ecomsync.writes import run_write
+from benchmarks.bench_order_import import synthetic_orders
+from benchmarks.common import temporary_app, summarize, report
+
+JSON = "application/json"
+ADMIN_KEY = "benchmark-admin"
+MANUFACTURERS = 21
+OPTIONS = 12
+
+
+class Scenario:
+    """
+    One kind of request. path and body are either fixed values or
+    functions of the dataset (a dict with the "products", "orders",
+    "manufacturers", "options", "job", "skus" in stock and "reservation"
+    of the database) and of the number of the request within the
+    scenario, so every request can address a different row.
+    """
+
+    def __init__(self, name, method, path, body=None, admin=False, content_type=JSON):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.admin = admin
+        self.content_type = content_type
+
+    def request(self, dataset, n):
+        """
+        Returns the path, body and headers of the n-th request.
+        """
+        path = self.path(dataset, n) if callable(self.path) else self.path
+        body = self.body(dataset, n) if callable(self.body) else self.body
+        if body is not None and not isinstance(body, (str, bytes)):
+            body = json.dumps(body)
+        headers = {"Content-Type": self.content_type} if body is not None else {}
+        if self.admin:
+            headers["access-key"] = ADMIN_KEY
+        return path, body, headers
+
+
+def _product(dataset, n):
+    return 1 + n * 7919 % dataset["products"]
+
+
+def _order(n):
+    order = synthetic_orders(1)[0]
+    order["email"] = "bench%d@example.com" % n
+    return order
+
+
+def _new_product(dataset, n):
+    return {
+        "name": "Bench %d" % n, "description": "Benchmark product", "manufacturerId": 1,
+        "sku": "BENCH%012d" % n, "quantity": 10, "image": "/image/bench.jpg",
+        "price": "19.90", "width": "50", "selectedOptions": [1, 2, 3],
+        "date_added": "2023-02-27T02:14:38",
+    }
+
+
+def _product_update(dataset, n):
+    pid = _product(dataset, n)
+    return {
+        "name_update": "Product %d" % pid, "description_update": "Updated %d" % n,
+        "sku_update": "UPDATED%012d" % pid, "quantity_update": 500, "image_update":
+        "/image/products/%d.jpg" % pid, "price_update": "41.5", "width_update": "3",
+    }
+
+
+# Read scenarios first, then writes; the deletes remove the rows created by
+# the matching POST scenarios so the dataset keeps its size.
+SCENARIOS = [
+    Scenario("home", "GET", "/api/"),
+    Scenario("product_list", "GET", "/api/product/"),
+    Scenario("product_list_long", "GET", "/api/product/?form=long&limit=50"),
+    Scenario("product_ids", "GET", lambda d, n: "/api/product/?ids=%s" % ",".join(
+        str(_product(d, n + i)) for i in range(20))),
+    Scenario("product_detail", "GET", lambda d, n: "/api/product/%d" % _product(d, n)),
+    Scenario("product_search", "GET", lambda d, n: "/api/product/search?q=%s" % (
+        BRANDS[n % len(BRANDS)][1].replace("-", "+"))),
+    Scenario("manufacturer_list", "GET", "/api/manufacturer/", admin=True),
+    Scenario("manufacturer_item", "GET", lambda d, n: "/api/manufacturer/%d" % (
+        1 + n % d["manufacturers"])),
+    Scenario("option_list", "GET", "/api/option/", admin=True),
+    Scenario("order_list", "GET", "/api/order/"),
+    Scenario("order_filtered", "GET", "/api/order/?payment_country=Finland&sort=-total"),
+    Scenario("order_stream_day", "GET", lambda d, n: (
+        "/api/order/?stream=ndjson&date_from=2023-%02d-01&date_to=2023-%02d-02" % (
+            1 + n % 12, 1 + n % 12))),
+    Scenario("sales_report", "GET", "/api/report/sales?group_by=day,country"),
+    Scenario("change_feed", "GET", lambda d, n: "/api/changes?since=%d&limit=100" % (
+        n * 7919 % d["orders"])),
+    Scenario("job_item", "GET", lambda d, n: "/api/jobs/%d" % d["job"]),
+    Scenario("reservation_item", "GET", lambda d, n: "/api/reservations/%d" % d["reservation"]),
+    Scenario("order_post", "POST", "/api/order/", lambda d, n: _order(n)),
+    Scenario("order_batch_100", "POST", "/api/order/batch", lambda d, n: [
+        _order(n * 100 + i) for i in range(100)]),
+    Scenario("product_post", "POST", "/api/product/", _new_product),
+    Scenario("product_put", "PUT", lambda d, n: "/api/product/%d" % _product(d, n),
+             _product_update),
+    Scenario("product_delete", "DELETE", lambda d, n: "/api/product/%d" % (
+        d["products"] + 1 + n)),
+    Scenario("manufacturer_post", "POST", "/api/manufacturer/", lambda d, n: {
+        "name": "Bench %d" % n, "image": "/image/bench.jpg", "description": "Benchmark"}),
+    Scenario("manufacturer_put", "PUT", lambda d, n: "/api/manufacturer/%d" % (
+        d["manufacturers"] + 1 + n), lambda d, n: {
+        "name_update": "Bench %d" % n, "description_update": "Updated",
+        "image_update": "/image/bench.jpg"}),
+    Scenario("manufacturer_delete", "DELETE", lambda d, n: "/api/manufacturer/%d" % (
+        d["manufacturers"] + 1 + n)),
+    Scenario("option_post", "POST", "/api/option/", lambda d, n: {
+        "name": "Bench %d" % n, "image": "/image/options/bench.jpg"}, admin=True),
+    Scenario("option_put", "PUT", lambda d, n: "/api/option/%d" % (d["options"] + 1 + n),
+             lambda d, n: {"name_update": "Bench %d" % n}),
+    Scenario("option_delete", "DELETE", lambda d, n: "/api/option/%d" % (
+        d["options"] + 1 + n), admin=True),
+    Scenario("reservation_post", "POST", "/api/reservations/", lambda d, n: {"items": [
+        {"sku": d["skus"][(n + i) * 7919 % len(d["skus"])], "quantity": 1}
+        for i in range(3)]}),
+    Scenario("reservation_commit", "POST", lambda d, n: "/api/reservations/%d/commit" % (
+        d["reservation"] + 1 + n)),
+    Scenario("reservation_delete", "DELETE", lambda d, n: "/api/reservations/%d" % (
+        d["reservation"] + 1 + n)),
+]
+
+
+class ClientTransport:
+    """
+    Sends requests through the Flask test client, one client per thread.
+    """
+    name = "client"
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def send(self, method, path, body, headers):
+        if not hasattr(self._local, "client"):
+            self._local.client = self.app.test_client()
+        resp = self._local.client.open(path, method=method, data=body, headers=headers)
+        resp.get_data()
+        return resp.status_code
+
+    def close(self):
+        pass
+
+
+class WsgiTransport:
+    """
+    Serves the application with Werkzeug's threaded WSGI server on a free
+    local port and sends requests over HTTP/1.1, one keep-alive connection
+    per thread.
+    """
+    name = "wsgi"
+
+    def __init__(self, app):
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.server = make_server("127.0.0.1", 0, app, threaded=True)
+        self.port = self.server.server_port
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        self._local = threading.local()
+
+    def send(self, method, path, body, headers):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                "127.0.0.1", self.port)
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            resp = connection.getresponse()
+            resp.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+        return resp.status
+
+    def close(self):
+        self.server.shutdown()
+        self._thread.join()
+
+
+TRANSPORTS = {"client": ClientTransport, "wsgi": WsgiTransport}
+
+
+def prepare(app, orders, products):
+    """
+    Fills the database of app with the synthetic data of "flask testgen",
+    adds the admin key used by the admin scenarios, queues one ingestion
+    job and reserves one unit of stock.
+
+    Returns:
+        dict: The dataset passed to the scenarios.
+    """
+    with app.app_context():
+        generate(manufacturers=MANUFACTURERS, options=OPTIONS, products=products,
+                 orders=orders)
+        db.session.add(ApiKey(key=ApiKey.key_hash(ADMIN_KEY), admin=True))
+        db.session.commit()
+        ApiKeyStore.for_app(app).refresh()
+        job = enqueue_orders(json.dumps([_order(0)]).encode()).job_id
+        # SKUs with enough stock for the reservation scenarios
+        skus = db.session.scalars(select(Product.sku).where(Product.quantity >= 100)
+                                  .order_by(Product.product_id)).all()
+        reservation = run_write(lambda: reserve({skus[0]: 1}, 3600))["id"]
+    return {"products": products, "orders": orders, "manufacturers": MANUFACTURERS,
+            "options": OPTIONS, "job": job, "skus": skus, "reservation": reservation}
+
+
+def run_scenario(transport, scenario, dataset, requests, concurrency):
+    """
+    Sends requests requests of a scenario from concurrency threads.
+
+    Returns:
+        tuple: The latency of every request in seconds, the number of
+        failed requests (status 400 or higher, or a connection error) and
+        the elapsed wall clock time.
+    """
+    counter = itertools.count()
+    latencies = []
+    errors = []
+
+    def client():
+        mine = []
+        failed = 0
+        for n in counter:
+            if n >= requests:
+                break
+            path, body, headers = scenario.request(dataset, n)
+            start = time.perf_counter()
+            try:
+                status = transport.send(scenario.method, path, body, headers)
+            except (http.client.HTTPException, OSError):
+                status = 599
+            mine.append(time.perf_counter() - start)
+            failed += status >= 400
+        latencies.extend(mine)
+        errors.append(failed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, sum(errors), time.perf_counter() - start
+
+
+def run(scale, transports, scenarios, requests, concurrency, products=None, metrics=True):
+    """
+    Runs the scenarios against a fresh database of scale orders, once per
+    transport, and returns the results. metrics turns the per-endpoint
+    metrics (ecomsync.metrics) on or off, to measure their overhead.
+    """
+    products = products or max(100, scale // 100)
+    results = []
+    for name in transports:
+        with temporary_app(METRICS_ENABLED=metrics) as app:
+            dataset = prepare(app, scale, products)
+            transport = TRANSPORTS[name](app)
+            try:
+                for scenario in scenarios:
+                    latencies, errors, elapsed = run_scenario(
+                        transport, scenario, dataset, requests, concurrency)
+                    summary = summarize(latencies)
+                    summary["ops_per_sec"] = len(latencies) / elapsed
+                    results.append(report(
+                        "api", scenario=scenario.name, method=scenario.method,
+                        transport=name, scale=scale, products=products,
+                        concurrency=concurrency, metrics=metrics, errors=errors,
+                        **summary))
+            finally:
+                transport.close()
+    return results
+
+
+def uncovered_endpoints(app, scenarios=SCENARIOS):
+    """
+    Returns the (endpoint, method) pairs of the API blueprint that no
+    scenario exercises, so new resources do not go unmeasured.
+    """
+    adapter = app.url_map.bind("localhost")
+    covered = set()
+    dataset = {"products": 100, "orders": 1000, "manufacturers": MANUFACTURERS,
+               "options": OPTIONS, "job": 1, "skus": ["SKU"], "reservation": 1}
+    for scenario in scenarios:
+        path = scenario.request(dataset, 0)[0].split("?")[0]
+        endpoint, _ = adapter.match(path, method=scenario.method)
+        covered.add((endpoint, scenario.method))
+    return sorted(
+        (rule.endpoint, method)
+        for rule in app.url_map.iter_rules() if rule.endpoint.startswith("api.")
+        for method in rule.methods - {"HEAD", "OPTIONS"}
+        if (rule.endpoint, method) not in covered
+    )
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "started_at": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with the results of an earlier run.
+
+    Returns:
+        list: One dict per scenario, transport and scale measured in both
+        runs whose p50 latency grew, or whose throughput dropped, by more
+        than tolerance (a fraction).
+    """
+    def key(result):
+        return result["scenario"], result["transport"], result["scale"]
+
+    before = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = before.get(key(result))
+        if old is None:
+            continue
+        slower = result["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0
+        fewer = 1 - result["ops_per_sec"] / old["ops_per_sec"] if old["ops_per_sec"] else 0.0
+        if slower > tolerance or fewer > tolerance:
+            regressions.append({
+                "scenario": result["scenario"], "transport": result["transport"],
+                "scale": result["scale"], "p50_ms": [old["p50_ms"], result["p50_ms"]],
+                "ops_per_sec": [old["ops_per_sec"], result["ops_per_sec"]],
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, action="append",
+                        help="number of orders, may be repeated (default 1000)")
+    parser.add_argument("--products", type=int,
+                        help="number of products (default scale / 100, at least 100)")
+    parser.add_argument("--transport", action="append", choices=sorted(TRANSPORTS),
+                        help="may be repeated (default both)")
+    parser.add_argument("--scenario", action="append",
+                        choices=[scenario.name for scenario in SCENARIOS],
+                        help="may be repeated (default all)")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--disable-metrics", action="store_true",
+                        help="run without the per-endpoint metrics middleware")
+    parser.add_argument("--output", help="write all results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown before a scenario counts as a regression")
+    args = parser.parse_args()
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    environment = _environment()
+    results = []
+    for scale in args.scale or [1000]:
+        results.extend(run(scale, args.transport or sorted(TRANSPORTS), scenarios,
+                           args.requests, args.concurrency, args.products,
+                           not args.disable_metrics))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"environment": environment, "results": results}, output,
+                      indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)["results"], args.tolerance)
+        for regression in regressions:
+            report("regression", **regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
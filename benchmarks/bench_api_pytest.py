@@ -0,0 +1,58 @@
+"""
+API benchmarks for pytest-benchmark.
+
+Runs the scenarios of benchmarks.bench_api that can be repeated any number
+of times (the reads, creating orders and updating products) with the
+benchmark fixture of pytest-benchmark, which calibrates the number of
+rounds, computes the statistics and saves and compares runs. The database
+has BENCH_SCALE orders (default 1000).
+
+Usage:
+    pip install pytest-benchmark
+    python -m pytest benchmarks/bench_api_pytest.py --benchmark-autosave
+    BENCH_SCALE=100000 python -m pytest benchmarks/bench_api_pytest.py \\
+        --benchmark-compare --benchmark-compare-fail=median:25%
+"""
+import itertools
+import os
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from benchmarks.bench_api import SCENARIOS, TRANSPORTS, prepare
+from benchmarks.common import temporary_app
+
+SCALE = int(os.environ.get("BENCH_SCALE", "1000"))
+
+REPEATABLE = [
+    scenario for scenario in SCENARIOS
+    if scenario.method == "GET" or scenario.name in ("order_post", "product_put")
+]
+
+
+@pytest.fixture(scope="module")
+def application():
+    with temporary_app() as app:
+        yield app, prepare(app, SCALE, max(100, SCALE // 100))
+
+
+@pytest.fixture(scope="module", params=sorted(TRANSPORTS))
+def transport(request, application):
+    transport = TRANSPORTS[request.param](application[0])
+    yield transport
+    transport.close()
+
+
+@pytest.mark.parametrize("scenario", REPEATABLE, ids=lambda scenario: scenario.name)
+def test_resource(benchmark, application, transport, scenario):
+    _, dataset = application
+    counter = itertools.count()
+
+    def send():
+        path, body, headers = scenario.request(dataset, next(counter))
+        return transport.send(scenario.method, path, body, headers)
+
+    benchmark.group = scenario.name
+    benchmark.extra_info.update(scale=SCALE, transport=transport.name)
+    assert benchmark(send) < 400
@@ -0,0 +1,59 @@
+"""
+Change feed benchmark.
+
+Simulates a sync cycle after a small number of orders changed: downloading
+the whole order collection as NDJSON, as the sync clients did, against
+reading the changes since the previous cycle from GET /api/changes.
+
+Usage:
+    python -m benchmarks.bench_changes --orders 100000 --changed 100
+"""
+import argparse
+import json
+
+from sqlalchemy import func, select, update
+
+from ecomsync import db
+from ecomsync.models import ChangeLog, Order
+from benchmarks.common import (temporary_app, populate_catalog, populate_orders,
+                               measure, summarize, report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--changed", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    with temporary_app() as app:
+        with app.app_context():
+            populate_catalog(100)
+            populate_orders(args.orders, 100)
+            since = db.session.scalar(select(func.max(ChangeLog.seq)))
+            db.session.execute(update(Order).where(Order.order_id <= args.changed)
+                               .values(total=Order.total + 1))
+            db.session.commit()
+        client = app.test_client()
+
+        def full_download():
+            resp = client.get("/api/order/?stream=ndjson")
+            return len(resp.data.splitlines())
+
+        def change_feed():
+            cursor, changes = since, 0
+            while True:
+                resp = client.get("/api/changes", query_string={"since": cursor, "limit": 500})
+                body = json.loads(resp.data)
+                changes += len(body["changes"])
+                cursor = body["last_seq"]
+                if not body["more"]:
+                    return changes
+
+        for name, sync in (("full_download", full_download), ("change_feed", change_feed)):
+            report("change_feed", strategy=name, orders=args.orders, changed=args.changed,
+                   rows_transferred=sync(), **summarize(measure(sync, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Marketplace connector benchmark.
+
+Pulls the orders of 1 to 64 seller accounts from the stand-in marketplace
+(ecomsync.standin), which delays every page by --latency seconds like a
+remote API, and imports them into an empty database. Two modes are
+compared:
+
+- sequential: the accounts one after the other, one urllib request (and
+  connection) per page and one transaction per page, like a cron job
+  looping over the accounts.
+- concurrent: ConnectorScheduler, pulling all accounts at once over kept
+  alive connections and importing the queued pages in batches.
+
+Reports orders imported per second, the HTTP requests sent, the
+connections opened and the transactions committed.
+
+Usage:
+    python -m benchmarks.bench_connectors --accounts 1 4 16 64 --latency 0.02
+"""
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+from datetime import datetime
+
+from sqlalchemy import event, func, select
+from sqlalchemy.dialects.sqlite import insert
+
+from ecomsync import db
+from ecomsync.connectors import ConnectorScheduler
+from ecomsync.ingest import insert_orders, validate_order_rows
+from ecomsync.models import MarketplaceCursor, Order
+from ecomsync.standin import StandInConnector, StandInMarketplace, serve
+from ecomsync.writes import run_write
+from benchmarks.common import temporary_app, report
+
+
+def _sequential(app, accounts):
+    """
+    Pulls the accounts one after the other with a request per page.
+    Returns the number of connections opened.
+    """
+    connections = 0
+    for account in accounts:
+        cursor = None
+        more = True
+        while more:
+            url = "%s/sellers/%s/orders?limit=%d" % (
+                account["base_url"], account["name"], account["page_size"])
+            if cursor is not None:
+                url += "&after=" + cursor
+            with urllib.request.urlopen(url) as response:
+                connections += 1
+                page = json.loads(response.read())
+            mappings, _ = validate_order_rows(
+                [StandInConnector.order_row(order) for order in page["orders"]])
+            cursor, more = page["next"], page["has_more"]
+
+            def write(name=account["name"], mappings=mappings, cursor=cursor):
+                insert_orders(mappings, app.config["ORDER_BATCH_CHUNK_SIZE"])
+                stmt = insert(MarketplaceCursor)
+                db.session.execute(stmt.on_conflict_do_update(
+                    index_elements=[MarketplaceCursor.account],
+                    set_={"cursor": stmt.excluded.cursor}),
+                    {"account": name, "cursor": cursor, "updated_at": datetime.utcnow()})
+            with app.app_context():
+                run_write(write)
+    return connections
+
+
+def run(mode, accounts, orders, page_size, latency, seed=0):
+    marketplace = StandInMarketplace(orders, latency, seed=seed)
+    server = serve(marketplace)
+    settings = [{"name": "seller-%d" % number, "page_size": page_size, "rate": 1000,
+                 "burst": 10, "connector": "ecomsync.standin.StandInConnector",
+                 "base_url": "http://127.0.0.1:%d" % server.server_port}
+                for number in range(accounts)]
+    try:
+        with temporary_app(MARKETPLACE_ACCOUNTS=settings) as app:
+            with app.app_context():
+                commits = []
+                event.listen(db.engine, "commit", lambda conn: commits.append(1))
+            start = time.perf_counter()
+            if mode == "sequential":
+                connections = _sequential(app, settings)
+            else:
+                scheduler = ConnectorScheduler.from_app(app)
+                asyncio.run(scheduler.run())
+                connections = scheduler.http.opened
+            elapsed = time.perf_counter() - start
+            with app.app_context():
+                imported = db.session.scalar(select(func.count()).select_from(Order))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return report("connectors", mode=mode, accounts=accounts, latency=latency,
+                  orders=imported, complete=imported == accounts * orders,
+                  orders_per_sec=imported / elapsed, elapsed=elapsed,
+                  requests=marketplace.requests, connections=connections,
+                  commits=len(commits))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--accounts", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--orders", type=int, default=500, help="orders per account")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds the stand-in delays every page by")
+    args = parser.parse_args()
+    for accounts in args.accounts:
+        for mode in ("sequential", "concurrent"):
+            run(mode, accounts, args.orders, args.page_size, args.latency)
+
+
+if __name__ == "__main__":
+    main()
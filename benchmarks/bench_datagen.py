@@ -0,0 +1,66 @@
+"""
+Data generator benchmark.
+
+Times "flask testgen" (ecomsync.datagen.generate) at growing numbers of
+orders, and, for comparison, adding the same orders one ORM object at a
+time like the original sample data command did.
+
+Usage:
+    python -m benchmarks.bench_datagen --orders 1000 --orders 1000000
+"""
+import argparse
+import random
+import time
+from datetime import datetime
+
+from ecomsync import db
+from ecomsync.datagen import _order_rows, generate
+from ecomsync.models import Order
+from benchmarks.common import temporary_app, report
+
+COLUMNS = ("order_id", "firstname", "lastname", "email", "telephone", "product_id",
+           "payment_address_1", "payment_city", "payment_postcode", "payment_country",
+           "total", "date_added")
+
+
+def orm_orders(count):
+    """
+    Adds count generated orders with one db.session.add per order and
+    returns the elapsed time, the rows being built beforehand.
+    """
+    with temporary_app() as app, app.app_context():
+        generate(orders=0)
+        rows = [dict(zip(COLUMNS, row)) for row in _order_rows(
+            random.Random(0), 1, count, ([1], [39.55]), datetime(2023, 1, 1), 1.0)]
+        for row in rows:
+            row["date_added"] = datetime.fromisoformat(row["date_added"])
+        start = time.perf_counter()
+        for row in rows:
+            db.session.add(Order(**row))
+        db.session.commit()
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, action="append",
+                        help="may be repeated (default 10^3 to 10^6)")
+    parser.add_argument("--orm-orders", type=int, default=10000,
+                        help="orders added one at a time for comparison")
+    args = parser.parse_args()
+
+    for orders in args.orders or [1000, 10000, 100000, 1000000]:
+        with temporary_app() as app, app.app_context():
+            start = time.perf_counter()
+            generate(products=max(100, orders // 100), orders=orders)
+            elapsed = time.perf_counter() - start
+        report("datagen", method="testgen", orders=orders, seconds=elapsed,
+               orders_per_sec=orders / elapsed)
+
+    elapsed = orm_orders(args.orm_orders)
+    report("datagen", method="orm_add", orders=args.orm_orders, seconds=elapsed,
+           orders_per_sec=args.orm_orders / elapsed)
+
+
+if __name__ == "__main__":
+    main()
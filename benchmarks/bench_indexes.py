@@ -0,0 +1,80 @@
+"""
+Index benchmark.
+
+Measures the hot lookups of the resources (product by SKU, products of a
+manufacturer, options of a product, orders by email and by date range)
+on a database without the secondary indexes, then again after
+``flask migrate-db`` has created them.
+
+Usage:
+    python -m benchmarks.bench_indexes --rows 100000
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import inspect, select, text
+
+from ecomsync import db
+from ecomsync.models import Order, Product, ProductOption, create_missing_indexes
+from benchmarks.common import (temporary_app, populate_catalog, populate_orders,
+                               measure, summarize, report)
+
+
+def lookups(rows):
+    """
+    Returns the benchmarked lookups as (name, callable) pairs.
+    """
+    def by_sku():
+        db.session.execute(select(Product).filter_by(
+            sku="SKU%012d" % random.randint(1, rows))).first()
+
+    def by_manufacturer():
+        db.session.execute(select(Product.product_id).filter_by(
+            manufacturer_id=random.randint(1, 20)).limit(50)).all()
+
+    def options_of_product():
+        db.session.execute(select(ProductOption).filter_by(
+            product_id=random.randint(1, rows))).all()
+
+    def order_by_email():
+        db.session.execute(select(Order).filter_by(
+            email="buyer%d@example.com" % random.randint(1, rows))).all()
+
+    def orders_in_day():
+        day = datetime(2023, 1, 1) + timedelta(days=random.randint(0, 364))
+        db.session.execute(select(Order).where(
+            Order.date_added >= day, Order.date_added < day + timedelta(days=1))).all()
+
+    return [("product_by_sku", by_sku), ("products_by_manufacturer", by_manufacturer),
+            ("options_of_product", options_of_product), ("order_by_email", order_by_email),
+            ("orders_in_day", orders_in_day)]
+
+
+def drop_secondary_indexes():
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            for index in inspect(db.engine).get_indexes(table.name):
+                connection.execute(text('DROP INDEX "%s"' % index["name"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    with temporary_app() as app, app.app_context():
+        drop_secondary_indexes()
+        populate_catalog(args.rows)
+        populate_orders(args.rows, args.rows)
+        for indexed in (False, True):
+            if indexed:
+                create_missing_indexes()
+            for name, lookup in lookups(args.rows):
+                report("index_lookup", lookup=name, indexed=indexed, rows=args.rows,
+                       **summarize(measure(lookup, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
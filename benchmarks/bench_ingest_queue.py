@@ -0,0 +1,93 @@
+"""
+Ingestion queue benchmark.
+
+Simulates a marketplace burst: client threads POST batches of orders to
+/api/order/batch as fast as they can, first importing each batch inside
+the request and then queueing it, in a separate queue database, for
+in-process ingestion workers.
+Reports the request latency seen by the clients and the time until every
+order has been written.
+
+Usage:
+    python -m benchmarks.bench_ingest_queue --clients 8 --requests 50
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import func, select
+
+from ecomsync import db
+from ecomsync.jobs import IngestWorkers
+from ecomsync.models import Order
+from benchmarks.bench_order_import import synthetic_orders
+from benchmarks.common import temporary_app, summarize, report
+
+
+def run(mode, clients, requests, batch):
+    queue_fd, queue_fname = tempfile.mkstemp(suffix=".db")
+    with temporary_app(INGEST_POLL_INTERVAL=0.01,
+                       INGEST_QUEUE_DATABASE_URI="sqlite:///" + queue_fname) as app:
+        workers = IngestWorkers(app, 2) if mode == "async" else None
+        if workers:
+            workers.start()
+        orders = json.dumps(synthetic_orders(batch))
+        latencies = []
+        errors = []
+
+        def client():
+            test_client = app.test_client()
+            mine = []
+            for _ in range(requests):
+                start = time.perf_counter()
+                resp = test_client.post("/api/order/batch?async=%d" % (mode == "async"),
+                                        data=orders, content_type="application/json")
+                mine.append(time.perf_counter() - start)
+                if resp.status_code not in (201, 202):
+                    errors.append(resp.status_code)
+            latencies.extend(mine)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        accepted = time.perf_counter() - start
+
+        expected = clients * requests * batch
+        with app.app_context():
+            while db.session.scalar(select(func.count()).select_from(Order)) < expected:
+                db.session.remove()
+                time.sleep(0.01)
+        imported = time.perf_counter() - start
+        if workers:
+            workers.stop()
+
+        with app.app_context():
+            db.engines["jobs"].dispose()
+        os.close(queue_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(queue_fname + suffix):
+                os.unlink(queue_fname + suffix)
+
+        report("ingest_queue", mode=mode, clients=clients, batch=batch, errors=len(errors),
+               accepted_s=accepted, imported_s=imported, orders_per_sec=expected / imported,
+               **summarize(latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--batch", type=int, default=100)
+    args = parser.parse_args()
+    for mode in ("sync", "async"):
+        run(mode, args.clients, args.requests, args.batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Order filter benchmark.
+
+Compares answering typical reconciliation queries (one day of orders,
+one customer's orders, one country's orders within a total range) by
+downloading the whole order collection as NDJSON and filtering it on the
+client, with the server-side filters of GET /api/order/.
+
+Usage:
+    python -m benchmarks.bench_order_filters --orders 100000
+"""
+import argparse
+import json
+import random
+from datetime import datetime, timedelta
+
+from benchmarks.common import (temporary_app, populate_catalog, populate_orders,
+                               measure, summarize, report)
+
+
+def queries(orders):
+    """
+    Returns the benchmarked queries as (name, query arguments, client-side
+    predicate) triples.
+    """
+    def one_day():
+        day = datetime(2023, 1, 1) + timedelta(days=random.randint(0, 364))
+        end = day + timedelta(days=1)
+        return ({"date_from": day.isoformat(), "date_to": end.isoformat(), "sort": "date_added"},
+                lambda order: day <= datetime.fromisoformat(order["date_added"]) < end)
+
+    def by_email():
+        email = "buyer%d@example.com" % random.randint(1, orders)
+        return {"email": email}, lambda order: order["email"] == email
+
+    def country_total():
+        return ({"payment_country": "Sweden", "total_min": 100, "total_max": 101},
+                lambda order: order["payment_country"] == "Sweden"
+                and 100 <= order["total"] <= 101)
+
+    return [("orders_in_day", one_day), ("orders_by_email", by_email),
+            ("country_total_range", country_total)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with temporary_app() as app:
+        with app.app_context():
+            populate_catalog(100)
+            populate_orders(args.orders, 100)
+        client = app.test_client()
+
+        for name, make_query in queries(args.orders):
+            def client_side():
+                _, predicate = make_query()
+                resp = client.get("/api/order/?stream=ndjson")
+                return [order for order in map(json.loads, resp.data.splitlines())
+                        if predicate(order)]
+
+            def server_side():
+                params, _ = make_query()
+                resp = client.get("/api/order/", query_string=dict(params, limit=500))
+                return json.loads(resp.data)["orders"]
+
+            for strategy, run in (("client_side", client_side), ("server_side", server_side)):
+                report("order_filters", query=name, strategy=strategy, orders=args.orders,
+                       **summarize(measure(run, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
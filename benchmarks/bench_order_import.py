@@ -0,0 +1,67 @@
+"""
+Order import benchmark.
+
+Compares importing orders one POST /api/order/ request at a time with a
+single POST /api/order/batch request.
+
+Usage:
+    python -m benchmarks.bench_order_import --rows 20000
+"""
+import argparse
+import json
+import time
+
+from benchmarks.common import temporary_app, report
+
+
+def synthetic_orders(count):
+    """
+    Builds count order documents in the shape accepted by the order
+    resources.
+    """
+    return [{
+        "firstname": "Buyer%d" % i,
+        "lastname": "Example",
+        "email": "buyer%d@example.com" % i,
+        "telephone": "0123654789",
+        "product_id": 1 + i % 4,
+        "payment_address_1": "yliopistokatu",
+        "payment_city": "Oulu",
+        "payment_postcode": "90570",
+        "payment_country": "Finland",
+        "total": 39.55,
+        "date_added": "2023-02-27T02:14:38+00:00",
+    } for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--single-rows", type=int, default=1000,
+                        help="rows imported one request at a time (extrapolated)")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    with temporary_app() as app:
+        client = app.test_client()
+        orders = synthetic_orders(args.single_rows)
+        start = time.perf_counter()
+        for order in orders:
+            client.post("/api/order/", json=order)
+        single = args.single_rows / (time.perf_counter() - start)
+
+    with temporary_app() as app:
+        client = app.test_client()
+        body = json.dumps(synthetic_orders(args.rows))
+        start = time.perf_counter()
+        resp = client.post("/api/order/batch?chunk_size=%d" % args.chunk_size,
+                           data=body, content_type="application/json")
+        batch = args.rows / (time.perf_counter() - start)
+        assert resp.status_code == 201, resp.data
+
+    report("order_import", single_rows_per_sec=single, batch_rows_per_sec=batch,
+           speedup=batch / single)
+
+
+if __name__ == "__main__":
+    main()
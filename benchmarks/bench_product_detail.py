@@ -0,0 +1,65 @@
+"""
+Product detail benchmark.
+
+Compares the original three-query lookup behind GET /api/product/<id>
+(product, options through ProductOption, manufacturer) with the eager
+loading query built by Product.with_details().
+
+Usage:
+    python -m benchmarks.bench_product_detail --products 10000
+"""
+import argparse
+import random
+
+from ecomsync import db
+from ecomsync.models import Manufacturer, Options, Product, ProductOption
+from ecomsync.resources.product import serialize_product_detail
+from benchmarks.common import (temporary_app, populate_catalog, QueryCounter,
+                               measure, summarize, report)
+
+
+def separate_queries(product_id):
+    """
+    The lookup as it was done before eager loading.
+    """
+    product = Product.query.filter_by(product_id=product_id).first()
+    item = product.serialize(True)
+    options = Options.query.join(ProductOption, Options.option_id == ProductOption.option_id).\
+        filter(ProductOption.product_id == product.product_id).all()
+    item["options"] = [{"option_id": o.option_id, "option_name": o.name,
+                        "option_image": o.image} for o in options]
+    manufacturer = Manufacturer.query.filter_by(manufacturer_id=product.manufacturer_id).first()
+    item["manufacturer_name"] = manufacturer.name
+    return item
+
+
+def eager_query(product_id):
+    product = Product.with_details().filter_by(product_id=product_id).one_or_none()
+    return serialize_product_detail(product, True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    with temporary_app() as app, app.app_context():
+        populate_catalog(args.products)
+        ids = [random.randint(1, args.products) for _ in range(args.repeat)]
+        for name, lookup in (("separate_queries", separate_queries), ("eager", eager_query)):
+            with QueryCounter(db.engine) as counter:
+                lookup(ids[0])
+            queries = counter.count
+            position = iter(ids)
+
+            def run():
+                lookup(next(position))
+                db.session.remove()
+
+            report("product_detail", strategy=name, queries_per_lookup=queries,
+                   **summarize(measure(run, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
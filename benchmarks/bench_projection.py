@@ -0,0 +1,76 @@
+"""
+Projection benchmark.
+
+Compares listing orders by loading full ORM entities with listing them by
+selecting only the serialized columns as plain rows, for one page of the
+collection and for the whole table (as streamed by ?stream=ndjson).
+Reports latency and the peak memory allocated per listing.
+
+Usage:
+    python -m benchmarks.bench_projection --orders 100000
+"""
+import argparse
+import tracemalloc
+
+from sqlalchemy import select
+
+from ecomsync import db
+from ecomsync.constants import MAX_PAGE_SIZE, STREAM_CHUNK_SIZE
+from ecomsync.models import Order
+from ecomsync.serializers import ORDER_SERIALIZERS
+from benchmarks.common import (temporary_app, populate_catalog, populate_orders,
+                               measure, summarize, report)
+
+
+def entities(short_form, limit):
+    serializer = ORDER_SERIALIZERS[short_form]
+    stmt = select(Order).order_by(Order.order_id).limit(limit)
+    result = db.session.scalars(stmt.execution_options(yield_per=STREAM_CHUNK_SIZE))
+    count = 0
+    for orders in result.partitions():
+        count += len(serializer.serialize(serializer.rows(orders)))
+    return count
+
+
+def projection(short_form, limit):
+    serializer = ORDER_SERIALIZERS[short_form]
+    stmt = select(*serializer.columns()).order_by(Order.order_id).limit(limit)
+    result = db.session.execute(stmt.execution_options(yield_per=STREAM_CHUNK_SIZE))
+    count = 0
+    for rows in result.partitions():
+        count += len(serializer.serialize(rows))
+    return count
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with temporary_app() as app, app.app_context():
+        populate_catalog(100)
+        populate_orders(args.orders, 100)
+        for limit in (MAX_PAGE_SIZE, args.orders):
+            for short_form in (True, False):
+                for name, listing in (("entities", entities), ("projection", projection)):
+                    def run():
+                        listing(short_form, limit)
+                        db.session.remove()
+
+                    report("projection", strategy=name, short_form=short_form, rows=limit,
+                           peak_kib=peak_memory(run) // 1024,
+                           **summarize(measure(run, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
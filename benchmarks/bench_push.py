@@ -0,0 +1,100 @@
+"""
+Order push benchmark.
+
+Pushes --orders orders to the mock store (ecomsync.standin.MockStore),
+which delays every response by --latency seconds like a remote store,
+and compares:
+
+- per_order: one POST /wp-json/wc/v3/orders per order, one after the
+  other, each on a new urllib connection, like the external push script.
+- woocommerce / opencart: PushScheduler with the batch endpoint of the
+  platform and 1, 4 and 8 batches in flight.
+
+Reports orders pushed per second, the HTTP requests sent, the connections
+opened and the most requests the store had in flight at once.
+
+Usage:
+    python -m benchmarks.bench_push --orders 1000 --latency 0.02
+"""
+import argparse
+import asyncio
+import base64
+import time
+import urllib.request
+
+from ecomsync import db
+from ecomsync.push import PushScheduler, WooCommercePlatform, read_orders
+from ecomsync.serializers import dumps
+from ecomsync.standin import MockStore, serve
+from benchmarks.common import temporary_app, populate_catalog, populate_orders, report
+
+PLATFORMS = {
+    "woocommerce": "ecomsync.push.WooCommercePlatform",
+    "opencart": "ecomsync.push.OpenCartPlatform",
+}
+
+
+def _per_order(app, target):
+    """
+    Posts the orders one by one. Returns the number of connections opened.
+    """
+    platform = WooCommercePlatform(target)
+    with app.app_context():
+        orders = read_orders(0, 10 ** 9)
+        db.session.remove()
+    url = target["base_url"] + "/wp-json/wc/v3/orders"
+    headers = {"Content-Type": "application/json", "Authorization": "Basic " + base64.b64encode(
+        b"%s:%s" % (target["consumer_key"].encode(), target["consumer_secret"].encode())).decode()}
+    for order in orders:
+        request = urllib.request.Request(url, dumps(platform.order_document(order)), headers)
+        with urllib.request.urlopen(request) as response:
+            response.read()
+    return len(orders)
+
+
+def run(mode, orders, latency, in_flight=1, chunk_size=1000):
+    store = MockStore(latency)
+    server = serve(store)
+    target = {"name": mode, "platform": PLATFORMS.get(mode, PLATFORMS["woocommerce"]),
+              "base_url": "http://127.0.0.1:%d" % server.server_port,
+              "consumer_key": "ck_test", "consumer_secret": "cs_test", "api_token": "test"}
+    try:
+        with temporary_app() as app:
+            with app.app_context():
+                populate_catalog(100)
+                populate_orders(orders, 100)
+            start = time.perf_counter()
+            if mode == "per_order":
+                connections = _per_order(app, target)
+            else:
+                scheduler = PushScheduler(app, [target], chunk_size=chunk_size,
+                                          max_in_flight=in_flight)
+                asyncio.run(scheduler.run())
+                connections = scheduler.http.opened
+            elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    pushed = len(store.woocommerce) + len(store.opencart)
+    return report("push", mode=mode, in_flight=in_flight if mode != "per_order" else 1,
+                  latency=latency, orders=pushed, complete=pushed == orders,
+                  orders_per_sec=pushed / elapsed, elapsed=elapsed, requests=store.requests,
+                  connections=connections, max_in_flight=store.max_in_flight)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds the mock store delays every response by")
+    parser.add_argument("--in-flight", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+    run("per_order", args.orders, args.latency)
+    for mode in ("woocommerce", "opencart"):
+        for in_flight in args.in_flight:
+            run(mode, args.orders, args.latency, in_flight)
+
+
+if __name__ == "__main__":
+    main()
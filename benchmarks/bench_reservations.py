@@ -0,0 +1,174 @@
+"""
+Stock reservation stress benchmark.
+
+Client threads reserve one to three random SKUs of a small catalog with
+little stock each, so most of the stock is sold out during the run and
+many reservations race for the last units. Each successful reservation
+is then committed or, one time in three, released again. Reservations go
+through ecomsync.stock (reserve() in run_write(), the conditional UPDATE)
+or, for comparison, through a read-modify-write that reads the stock and
+then writes the new quantity, like a client doing GET and PUT on
+/api/product/<id>.
+
+After the run the benchmark checks that no unit was sold twice: the stock
+left plus the units of the held and committed reservations must equal the
+initial stock. Reports reservation attempts per second, the latency
+percentiles, the number of successful and rejected reservations, and the
+units sold that are missing from the stock ("oversold").
+
+Usage:
+    python -m benchmarks.bench_reservations --clients 16 --requests 500
+    python -m benchmarks.bench_reservations --transport api --clients 8
+"""
+import argparse
+import random
+import threading
+import time
+
+from sqlalchemy import event, func, select, update
+
+from ecomsync import db
+from ecomsync.models import Product, StockReservation, StockReservationLine
+from ecomsync.stock import (InsufficientStock, commit_reservation, release_reservation,
+                            reserve)
+from ecomsync.writes import run_write
+from benchmarks.common import temporary_app, populate_catalog, summarize, report
+
+
+def _sku(product_id):
+    return "SKU%012d" % product_id
+
+
+def _conditional(items):
+    """
+    Reserves items with reserve() and commits or releases the reservation.
+    Returns the number of units sold.
+    """
+    try:
+        reservation = run_write(lambda: reserve(items, 900))
+    except InsufficientStock:
+        return 0
+    if reservation["id"] % 3 == 0:
+        run_write(lambda: release_reservation(reservation["id"]))
+        return 0
+    run_write(lambda: commit_reservation(reservation["id"]))
+    return sum(items.values())
+
+
+def _read_modify_write(items):
+    """
+    Reads the stock of the items, checks it and writes the decremented
+    quantities. Returns the number of units sold.
+    """
+    stock = dict(db.session.execute(
+        select(Product.sku, Product.quantity).where(Product.sku.in_(list(items)))).all())
+    db.session.rollback()
+    if any(stock.get(sku, 0) < quantity for sku, quantity in items.items()):
+        return 0
+
+    def write():
+        for sku, quantity in items.items():
+            db.session.execute(update(Product).where(Product.sku == sku)
+                               .values(quantity=stock[sku] - quantity))
+    run_write(write)
+    return sum(items.values())
+
+
+def _api(client, items):
+    """
+    Reserves items through the API and commits or releases the reservation.
+    Returns the number of units sold.
+    """
+    resp = client.post("/api/reservations/", json={
+        "items": [{"sku": sku, "quantity": quantity} for sku, quantity in items.items()]})
+    if resp.status_code == 409:
+        return 0
+    href = resp.headers["Location"]
+    if int(href.rsplit("/", 1)[1]) % 3 == 0:
+        client.delete(href)
+        return 0
+    client.post(href + "/commit")
+    return sum(items.values())
+
+
+STRATEGIES = {"conditional": _conditional, "read_modify_write": _read_modify_write}
+
+
+def run(strategy, transport, clients, requests, products, stock, batching, seed=0):
+    with temporary_app(WRITE_BATCHING=batching) as app:
+        with app.app_context():
+            populate_catalog(products)
+            db.session.execute(update(Product).values(quantity=stock))
+            db.session.commit()
+            commits = []
+            event.listen(db.engine, "commit", lambda conn: commits.append(1))
+
+        latencies = []
+        sold = []
+
+        def client(number):
+            rng = random.Random(seed * 1000 + number)
+            test_client = app.test_client()
+            mine, units = [], 0
+            with app.app_context():
+                for _ in range(requests):
+                    items = {_sku(product_id): rng.randint(1, 2) for product_id in
+                             rng.sample(range(1, products + 1), rng.randint(1, 3))}
+                    start = time.perf_counter()
+                    if transport == "api":
+                        units += _api(test_client, items)
+                    else:
+                        units += STRATEGIES[strategy](items)
+                    mine.append(time.perf_counter() - start)
+            latencies.extend(mine)
+            sold.append(units)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        with app.app_context():
+            left = db.session.scalar(select(func.sum(Product.quantity)))
+            negative = db.session.scalar(select(func.count()).where(Product.quantity < 0))
+            held = db.session.scalar(
+                select(func.coalesce(func.sum(StockReservationLine.quantity), 0))
+                .join(StockReservation)
+                .where(StockReservation.status.in_(["held", "committed"])))
+            successful = db.session.scalar(select(func.count()).select_from(StockReservation))
+
+        summary = summarize(latencies)
+        summary["ops_per_sec"] = len(latencies) / elapsed
+        return report(
+            "reservations", strategy=strategy, transport=transport, batching=batching,
+            clients=clients, products=products, stock=products * stock,
+            sold=sum(sold), left=left, reservations=successful,
+            oversold=sum(sold) - (products * stock - left),
+            consistent=negative == 0 and left + held == products * stock
+            if strategy == "conditional" else None,
+            commits=len(commits), **summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="reservation attempts per client")
+    parser.add_argument("--products", type=int, default=20)
+    parser.add_argument("--stock", type=int, default=300, help="initial stock per product")
+    parser.add_argument("--transport", choices=["engine", "api"], default="engine",
+                        help="call ecomsync.stock directly or go through the API")
+    args = parser.parse_args()
+    strategies = sorted(STRATEGIES) if args.transport == "engine" else ["conditional"]
+    for strategy in strategies:
+        for batching in (False, True):
+            run(strategy, args.transport, args.clients, args.requests, args.products,
+                args.stock, batching)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Sales report benchmark.
+
+Compares computing the sales report from the order table with computing
+it from the trigger-maintained sales_rollup table, for every grouping of
+GET /api/report/sales, over a whole year and over one month.
+
+Usage:
+    python -m benchmarks.bench_sales_report --orders 100000
+"""
+import argparse
+from datetime import date
+
+from ecomsync import db
+from ecomsync.reporting import sales_report
+from benchmarks.common import (temporary_app, populate_catalog, populate_orders,
+                               measure, summarize, report)
+
+RANGES = {
+    "year": (None, None),
+    "month": (date(2023, 6, 1), date(2023, 7, 1)),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=100000)
+    parser.add_argument("--products", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    with temporary_app() as app, app.app_context():
+        populate_catalog(args.products)
+        populate_orders(args.orders, args.products)
+        for group_by in ("day", "product", "manufacturer", "country"):
+            for period, (date_from, date_to) in RANGES.items():
+                for from_orders in (True, False):
+                    def run():
+                        sales_report([group_by], date_from, date_to, from_orders)
+                        db.session.remove()
+
+                    report("sales_report", group_by=group_by, period=period,
+                           source="orders" if from_orders else "rollup", orders=args.orders,
+                           **summarize(measure(run, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
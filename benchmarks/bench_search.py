@@ -0,0 +1,69 @@
+"""
+Product search benchmark.
+
+Compares finding products by a word of their name, description, SKU or
+manufacturer with LIKE '%word%' scans of the product table against the
+FTS5 index behind GET /api/product/search, directly in SQL and through
+the resource.
+
+Usage:
+    python -m benchmarks.bench_search --products 100000
+"""
+import argparse
+import random
+
+from sqlalchemy import or_, select
+
+from ecomsync import db
+from ecomsync.models import Manufacturer, Product
+from ecomsync.search import match_expression, matches, product_search
+from benchmarks.common import temporary_app, populate_catalog, measure, summarize, report
+
+
+def like_scan(word):
+    pattern = "%" + word + "%"
+    return db.session.execute(
+        select(Product.product_id, Product.name)
+        .outerjoin(Manufacturer, Manufacturer.manufacturer_id == Product.manufacturer_id)
+        .where(or_(Product.name.like(pattern), Product.description.like(pattern),
+                   Product.sku.like(pattern), Manufacturer.name.like(pattern)))
+        .order_by(Product.product_id).limit(50)
+    ).all()
+
+
+def fts(word):
+    return db.session.execute(
+        select(Product.product_id, Product.name).select_from(product_search)
+        .join(Product, Product.product_id == product_search.c.rowid)
+        .where(matches(match_expression(word)))
+        .order_by(product_search.c.rank).limit(50)
+    ).all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with temporary_app() as app:
+        with app.app_context():
+            populate_catalog(args.products)
+        client = app.test_client()
+        words = {
+            "name": lambda: "Product %d" % random.randint(1, args.products),
+            "sku": lambda: "SKU%012d" % random.randint(1, args.products),
+        }
+        for kind, word in words.items():
+            with app.app_context():
+                for name, search in (("like_scan", like_scan), ("fts5", fts)):
+                    report("product_search", strategy=name, words=kind, products=args.products,
+                           **summarize(measure(lambda: search(word()), args.repeat)))
+            report("product_search", strategy="resource", words=kind, products=args.products,
+                   **summarize(measure(
+                       lambda: client.get("/api/product/search", query_string={"q": word()}),
+                       args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
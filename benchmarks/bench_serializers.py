@@ -0,0 +1,68 @@
+"""
+Serializer benchmark.
+
+Compares building a product collection page the original way (a
+MasonBuilder per row, add_control with url_for, stdlib json.dumps) with
+the row serializers of ecomsync.serializers, with and without orjson.
+
+Usage:
+    python -m benchmarks.bench_serializers --rows 500
+"""
+import argparse
+import json
+
+from flask import url_for
+
+from ecomsync import db, serializers
+from ecomsync.models import Product
+from ecomsync.utils import MasonBuilder
+from benchmarks.common import temporary_app, populate_catalog, measure, summarize, report
+
+
+def mason_builder(products, final_form):
+    """
+    The collection body as it was built before the row serializers.
+    """
+    body = MasonBuilder(products=[])
+    for product in products:
+        item = MasonBuilder(product.serialize(final_form))
+        item.add_control("self", url_for("api.ProductIndividualItem", id=product.product_id))
+        body["products"].append(item)
+    return json.dumps(body).encode()
+
+
+def row_serializer(products, final_form):
+    serializer = serializers.PRODUCT_SERIALIZERS[final_form]
+    rows = serializer.rows(products)
+    body = MasonBuilder(products=serializer.serialize(rows, serializers.product_controls()))
+    return serializers.dumps(body)
+
+
+def row_serializer_stdlib(products, final_form):
+    orjson, serializers.orjson = serializers.orjson, None
+    try:
+        return row_serializer(products, final_form)
+    finally:
+        serializers.orjson = orjson
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    strategies = (("mason_builder", mason_builder), ("row_serializer", row_serializer),
+                  ("row_serializer_stdlib_json", row_serializer_stdlib))
+    with temporary_app() as app, app.app_context(), app.test_request_context():
+        populate_catalog(args.rows)
+        products = db.session.scalars(db.select(Product).order_by(Product.product_id)).all()
+        for final_form in (False, True):
+            for name, build in strategies:
+                report("serializers", strategy=name, long_form=final_form, rows=args.rows,
+                       orjson=serializers.orjson is not None,
+                       **summarize(measure(lambda: build(products, final_form), args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
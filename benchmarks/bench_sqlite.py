@@ -0,0 +1,80 @@
+"""
+SQLite profile benchmark.
+
+Runs reader threads fetching product details while a writer thread imports
+orders one POST at a time, first with the SQLite defaults (rollback
+journal, synchronous=FULL) and then with the WAL performance profile.
+Reports the writer throughput and the reader latency.
+
+Usage:
+    python -m benchmarks.bench_sqlite --readers 4 --seconds 5
+"""
+import argparse
+import random
+import threading
+import time
+
+from benchmarks.bench_order_import import synthetic_orders
+from benchmarks.common import temporary_app, populate_catalog, summarize, report
+from ecomsync.sqlite import DEFAULT_PRAGMAS
+
+PROFILES = {
+    "default": {"busy_timeout": 5000},
+    "performance": DEFAULT_PRAGMAS,
+}
+
+
+def run(profile, readers, seconds, products):
+    with temporary_app(SQLITE_PRAGMAS=PROFILES[profile]) as app:
+        with app.app_context():
+            populate_catalog(products)
+        stop = time.perf_counter() + seconds
+        latencies = []
+        writes = []
+        errors = []
+
+        def reader():
+            client = app.test_client()
+            mine = []
+            while time.perf_counter() < stop:
+                start = time.perf_counter()
+                resp = client.get("/api/product/%d" % random.randint(1, products))
+                mine.append(time.perf_counter() - start)
+                if resp.status_code != 200:
+                    errors.append(resp.status_code)
+            latencies.extend(mine)
+
+        def writer():
+            client = app.test_client()
+            for order in synthetic_orders(20000):
+                if time.perf_counter() >= stop:
+                    break
+                resp = client.post("/api/order/", json=order)
+                if resp.status_code != 201:
+                    errors.append(resp.status_code)
+                writes.append(1)
+
+        threads = [threading.Thread(target=reader) for _ in range(readers)]
+        threads.append(threading.Thread(target=writer))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        report("sqlite_profile", profile=profile, readers=readers,
+               writes_per_sec=len(writes) / seconds, errors=len(errors),
+               **{"read_" + key: value for key, value in summarize(latencies).items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--products", type=int, default=10000)
+    args = parser.parse_args()
+    for profile in PROFILES:
+        run(profile, args.readers, args.seconds, args.products)
+
+
+if __name__ == "__main__":
+    main()
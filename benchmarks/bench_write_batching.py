@@ -0,0 +1,78 @@
+"""
+Write batching benchmark.
+
+Client threads POST single orders to /api/order/ as fast as they can,
+each request committing on its own and then through the group commit
+writer, with the default synchronous=NORMAL profile and with
+synchronous=FULL, which syncs every commit to disk.
+Reports the request latency seen by the clients, the write throughput and
+the number of commits.
+
+Usage:
+    python -m benchmarks.bench_write_batching --clients 16 --requests 100
+"""
+import argparse
+import json
+import threading
+import time
+
+from sqlalchemy import event
+
+from ecomsync import db
+from ecomsync.sqlite import DEFAULT_PRAGMAS
+from benchmarks.bench_order_import import synthetic_orders
+from benchmarks.common import temporary_app, summarize, report
+
+
+def run(batching, synchronous, clients, requests, window):
+    pragmas = dict(DEFAULT_PRAGMAS, synchronous=synchronous)
+    with temporary_app(WRITE_BATCHING=batching, WRITE_BATCH_WINDOW=window,
+                       SQLITE_PRAGMAS=pragmas) as app:
+        with app.app_context():
+            commits = []
+            event.listen(db.engine, "commit", lambda conn: commits.append(1))
+        orders = [json.dumps(order) for order in synthetic_orders(requests)]
+        latencies = []
+        errors = []
+
+        def client():
+            test_client = app.test_client()
+            mine = []
+            for order in orders:
+                start = time.perf_counter()
+                resp = test_client.post("/api/order/", data=order,
+                                        content_type="application/json")
+                mine.append(time.perf_counter() - start)
+                if resp.status_code != 201:
+                    errors.append(resp.status_code)
+            latencies.extend(mine)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        summary = summarize(latencies)
+        summary["ops_per_sec"] = len(latencies) / elapsed
+        report("write_batching", batching=batching, synchronous=synchronous,
+               clients=clients, window_ms=window * 1000, errors=len(errors),
+               commits=len(commits), **summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--window", type=float, default=0.0,
+                        help="WRITE_BATCH_WINDOW in seconds")
+    args = parser.parse_args()
+    for synchronous in ("NORMAL", "FULL"):
+        for batching in (False, True):
+            run(batching, synchronous, args.clients, args.requests, args.window)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Common benchmark helpers.
+
+This module provides an application factory backed by a throwaway SQLite
+database, timing and query counting helpers, and a result reporter.
+"""
+import json
+import os
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert
+
+from ecomsync import create_app, db
+from ecomsync.models import Manufacturer, Options, Order, Product, ProductOption
+
+
+@contextmanager
+def temporary_app(**config):
+    """
+    Creates an application with an empty database in a temporary file and
+    removes the file afterwards.
+
+    Yields:
+        Flask: The configured application with all tables created.
+    """
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    settings = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "CACHE_TYPE": "NullCache",
+    }
+    settings.update(config)
+    app = create_app(settings)
+    with app.app_context():
+        db.create_all()
+    try:
+        yield app
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed on an engine while active.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+
+def measure(func, repeat):
+    """
+    Calls func repeat times and returns the duration of each call in
+    seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def summarize(durations):
+    """
+    Summarizes a list of durations as latency percentiles in milliseconds
+    and throughput in operations per second.
+    """
+    ordered = sorted(durations)
+
+    def percentile(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "ops_per_sec": len(ordered) / sum(ordered) if sum(ordered) else 0.0,
+    }
+
+
+def report(name, **results):
+    """
+    Prints one benchmark result as a single JSON line and returns it.
+    """
+    result = {"benchmark": name, **results}
+    print(json.dumps(result, sort_keys=True))
+    return result
+
+
+def populate_catalog(products, options_per_product=4, manufacturers=20, options=12):
+    """
+    Bulk inserts a synthetic catalog shaped like the test fixture: products
+    spread over the manufacturers, each linked to options_per_product lens
+    color options. Must be called inside an application context.
+    """
+    now = datetime(2023, 2, 27, 2, 14, 38)
+    db.session.execute(insert(Manufacturer), [
+        {"manufacturer_id": i, "name": "Manufacturer %d" % i,
+         "image": "/image/m%d.jpg" % i, "description": "Sunglass Lenses %d" % i}
+        for i in range(1, manufacturers + 1)
+    ])
+    db.session.execute(insert(Options), [
+        {"option_id": i, "name": "Color %d" % i, "image": "/image/options/%d.jpg" % i}
+        for i in range(1, options + 1)
+    ])
+    db.session.execute(insert(Product), [
+        {"product_id": i, "name": "Product %d" % i, "description": "Sunglass %d" % i,
+         "manufacturer_id": 1 + i % manufacturers, "sku": "SKU%012d" % i,
+         "quantity": 1000, "image": "/image/products/%d.jpg" % i,
+         "price": 39.55, "width": 3, "date_added": now}
+        for i in range(1, products + 1)
+    ])
+    db.session.execute(insert(ProductOption), [
+        {"product_id": i, "option_id": 1 + (i + j) % options}
+        for i in range(1, products + 1) for j in range(options_per_product)
+    ])
+    db.session.commit()
+
+
+def populate_orders(orders, products, chunk_size=50000):
+    """
+    Bulk inserts synthetic orders spread over the products, countries and
+    the year 2023. Must be called inside an application context.
+    """
+    countries = ("Finland", "Sweden", "Germany", "France", "Spain")
+    start = datetime(2023, 1, 1)
+    for first in range(1, orders + 1, chunk_size):
+        db.session.execute(insert(Order), [
+            {"order_id": i, "firstname": "Buyer%d" % i, "lastname": "Example",
+             "email": "buyer%d@example.com" % i, "telephone": "0123654789",
+             "product_id": 1 + i % products, "payment_address_1": "yliopistokatu",
+             "payment_city": "Oulu", "payment_postcode": "90570",
+             "payment_country": countries[i % len(countries)],
+             "total": round(10 + i % 200 * 0.5, 2),
+             "date_added": start + (i * 31536000 // orders) * timedelta(seconds=1)}
+            for i in range(first, min(first + chunk_size, orders + 1))
+        ])
+    db.session.commit()
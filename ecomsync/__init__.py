@@ -4,6 +4,8 @@ Init module.
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import OperationalError
+from flask_caching import Cache
 from flask_cors import CORS
 from flasgger import Swagger
 
@@ -11,7 +13,7 @@ from flasgger import Swagger
 SQLAlchemy.
 """
 db = SQLAlchemy()
-# cache = Cache()
+cache = Cache()
 
 def create_app(test_config=None):
     """
@@ -29,6 +31,8 @@ def create_app(test_config=None):
     Returns:
     app (Flask): the configured Flask application.
     """
+    from ecomsync.sqlite import DEFAULT_PRAGMAS, DEFAULT_POOL, configure_engine, apply_pragmas
+
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY="dev",
@@ -36,6 +40,37 @@ def create_app(test_config=None):
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
         CACHE_TYPE="FileSystemCache",
         CACHE_DIR=os.path.join(app.instance_path, "cache"),
+        ORDER_BATCH_CHUNK_SIZE=1000,
+        ORDER_INGEST_ASYNC=False,
+        INGEST_WORKERS=0,
+        INGEST_BATCH_BYTES=4194304,
+        INGEST_POLL_INTERVAL=0.5,
+        INGEST_CLAIM_TIMEOUT=300,
+        INGEST_QUEUE_DATABASE_URI=None,
+        WRITE_BATCHING=True,
+        WRITE_BATCH_WINDOW=0.0,
+        WRITE_BATCH_MAX_SIZE=64,
+        WRITE_BATCH_TIMEOUT=None,
+        RESERVATION_TTL=900,
+        RESERVATION_SWEEP_INTERVAL=0,
+        MARKETPLACE_ACCOUNTS=[],
+        MARKETPLACE_MAX_CONNECTIONS=16,
+        MARKETPLACE_TIMEOUT=30.0,
+        MARKETPLACE_QUEUE_SIZE=64,
+        MARKETPLACE_BATCH_ROWS=5000,
+        MARKETPLACE_RETRIES=3,
+        PUSH_TARGETS=[],
+        PUSH_CHUNK_SIZE=1000,
+        PUSH_MAX_IN_FLIGHT=4,
+        PUSH_RETRIES=5,
+        PUSH_TIMEOUT=30.0,
+        METRICS_ENABLED=True,
+        QUERY_CHECK_ENABLED=False,
+        QUERY_CHECK_REPEAT=5,
+        QUERY_CHECK_SLOW_SECONDS=0.1,
+        API_KEY_TTL=60,
+        SQLITE_PRAGMAS=DEFAULT_PRAGMAS,
+        SQLITE_POOL=DEFAULT_POOL,
     )
 
     CORS(app)
@@ -58,19 +93,66 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from ecomsync.jobs import configure_queue
+    from ecomsync.writes import configure_writes
+    from ecomsync.metrics import configure_metrics
+    from ecomsync.querycheck import configure_query_check
+    configure_queue(app)
+    configure_engine(app)
     db.init_app(app)
-    ## cache.init_app(app)
+    apply_pragmas(app)
+    configure_writes(app)
+    configure_metrics(app)
+    configure_query_check(app)
+    cache.init_app(app)
 
     from . import models
+    from . import search
+    from . import reporting
+    from . import changes
     from . import api
-    from ecomsync.utils import ManufacturerConverter
+    from ecomsync.utils import ManufacturerConverter, ApiKeyStore
+    from ecomsync.jobs import IngestWorkers, ingest_worker_command
+    from ecomsync.datagen import testgen_command
+    from ecomsync.stock import ReservationSweeper, sweep_reservations_command
+    from ecomsync.connectors import pull_orders_command
+    from ecomsync.push import push_orders_command
+    from ecomsync.standin import standin_marketplace_command, standin_store_command
 
     app.cli.add_command(models.init_db_command)
-    app.cli.add_command(models.generate_test_data)
+    app.cli.add_command(models.migrate_db_command)
+    app.cli.add_command(testgen_command)
+    app.cli.add_command(testgen_command, name="populate-db")
     app.cli.add_command(models.generate_master_key)
+    app.cli.add_command(ingest_worker_command)
+    app.cli.add_command(sweep_reservations_command)
+    app.cli.add_command(pull_orders_command)
+    app.cli.add_command(standin_marketplace_command)
+    app.cli.add_command(push_orders_command)
+    app.cli.add_command(standin_store_command)
     app.url_map.converters["manufacturer"] = ManufacturerConverter
     app.register_blueprint(api.api_bp)
 
+    # Load the API keys up front so the first requests do not pay for it;
+    # the tables do not exist yet before "flask init-db".
+    with app.app_context():
+        try:
+            ApiKeyStore.for_app(app).refresh()
+        except OperationalError:
+            pass
+
+    # In-process ingestion workers; "flask ingest-worker" runs them in a
+    # separate process instead.
+    if app.config["INGEST_WORKERS"]:
+        app.extensions["ecomsync_ingest_workers"] = IngestWorkers(app, app.config["INGEST_WORKERS"])
+        app.extensions["ecomsync_ingest_workers"].start()
+
+    # Expiry of stock reservations; "flask sweep-reservations" can run it
+    # in a separate process instead.
+    if app.config["RESERVATION_SWEEP_INTERVAL"]:
+        app.extensions["ecomsync_reservation_sweeper"] = ReservationSweeper(
+            app, app.config["RESERVATION_SWEEP_INTERVAL"])
+        app.extensions["ecomsync_reservation_sweeper"].start()
 
     print(app.instance_path)
     return app
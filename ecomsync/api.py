@@ -7,10 +7,14 @@ from flask_restful import Api
 
 # Import resources
 from ecomsync.resources.home import Home
-from ecomsync.resources.order import OrderItem
+from ecomsync.resources.order import OrderItem, OrderBatch
 from ecomsync.resources.option import OptionItem, OptionIndividualItem
-from ecomsync.resources.product import ProductItem, ProductIndividualItem
+from ecomsync.resources.product import ProductItem, ProductIndividualItem, ProductSearch
 from ecomsync.resources.manufacturer import ManufacturerItem, ManufacturerCollection
+from ecomsync.resources.report import SalesReport
+from ecomsync.resources.changes import ChangeFeed
+from ecomsync.resources.jobs import JobItem
+from ecomsync.resources.stock import ReservationCollection, ReservationItem, ReservationCommit
 
 # Define a Blueprint for the API and set its prefix
 api_bp = Blueprint("api", __name__, url_prefix="/api")
@@ -22,7 +26,16 @@ api.add_resource(Home, "/")
 api.add_resource(ManufacturerCollection, "/manufacturer/", endpoint='ManufacturerCollection')
 api.add_resource(ManufacturerItem, "/manufacturer/<int:mid>", endpoint='ManufacturerItem')
 api.add_resource(ProductItem, "/product/")
+api.add_resource(ProductSearch, "/product/search", endpoint='ProductSearch')
 api.add_resource(ProductIndividualItem, '/product/<int:id>', endpoint='ProductIndividualItem')
 api.add_resource(OrderItem, "/order/")
+api.add_resource(OrderBatch, "/order/batch")
 api.add_resource(OptionItem, '/option/')
 api.add_resource(OptionIndividualItem, '/option/<int:oid>')
+api.add_resource(SalesReport, '/report/sales', endpoint='SalesReport')
+api.add_resource(ChangeFeed, '/changes', endpoint='ChangeFeed')
+api.add_resource(JobItem, '/jobs/<int:job_id>', endpoint='JobItem')
+api.add_resource(ReservationCollection, '/reservations/', endpoint='ReservationCollection')
+api.add_resource(ReservationItem, '/reservations/<int:reservation_id>', endpoint='ReservationItem')
+api.add_resource(ReservationCommit, '/reservations/<int:reservation_id>/commit',
+                 endpoint='ReservationCommit')
@@ -0,0 +1,257 @@
+"""
+Caching module.
+
+This module provides the response cache and the conditional request
+(ETag / Last-Modified) support used by the catalog resources, and an
+in-process LRU cache backend for Flask-Caching.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import Response, request
+from flask_caching.backends.base import BaseCache
+from sqlalchemy import bindparam, select
+from sqlalchemy.dialects.sqlite import insert
+
+from ecomsync import cache, db
+from ecomsync.models import ResourceVersion
+
+
+class LRUCache(BaseCache):
+    """
+    Thread-safe in-process cache with per-entry TTL and least recently used
+    eviction once *threshold* entries are stored. Only suitable for
+    deployments running a single process, because invalidations are not
+    shared between processes.
+
+    Enable it with ``CACHE_TYPE = "ecomsync.caching.LRUCache"``; the size
+    bound is read from ``CACHE_THRESHOLD`` and the TTL from
+    ``CACHE_DEFAULT_TIMEOUT``.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300, ignore_delete_many_errors=False):
+        super().__init__(default_timeout=default_timeout,
+                         ignore_delete_many_errors=ignore_delete_many_errors)
+        self._threshold = threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(dict(threshold=config["CACHE_THRESHOLD"]))
+        return cls(*args, **kwargs)
+
+    def _expiry(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.monotonic() + timeout if timeout > 0 else None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, _ = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, value, timeout):
+        self._entries[key] = (self._expiry(timeout), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._threshold:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._store(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            self._store(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def has(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        return True
+
+
+def _generation(scope):
+    """
+    Returns the current generation token of a cache scope. Missing tokens
+    (never set, or evicted) are replaced with a fresh random one, so entries
+    cached under an earlier token can never be served again.
+    """
+    key = "gen:" + scope
+    token = cache.get(key)
+    if token is None:
+        cache.add(key, uuid.uuid4().hex, timeout=0)
+        token = cache.get(key)
+    return token
+
+
+def invalidate(*scopes):
+    """
+    Invalidates every cached response stored under the given scopes, e.g.
+    ``invalidate("product", "product:1")``. Should be called after the
+    write has been committed.
+    """
+    for scope in scopes:
+        cache.set("gen:" + scope, uuid.uuid4().hex, timeout=0)
+
+
+def cached_response(scope):
+    """
+    Decorator caching the successful responses of a resource GET method.
+
+    The cache key combines the scope (a format string filled from the
+    view arguments, e.g. ``"product:{id}"``), the scope's generation token
+    and all query arguments, including ``form``. Writes invalidate the
+    scope with invalidate().
+
+    The ETag and Last-Modified headers are cached with the response, so
+    placed above conditional_response() a hit, conditional or not, is
+    answered without querying the database.
+
+    Parameters:
+        scope (str): The cache scope of the resource.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            resolved = scope.format(**kwargs)
+            # The generation is read before the response is built, so a
+            # write committed meanwhile leaves the entry unreachable
+            key = "view:%s:%s:%s" % (
+                resolved, _generation(resolved),
+                urlencode(sorted(request.args.items(multi=True)))
+            )
+            hit = cache.get(key)
+            if hit is not None:
+                data, status, mimetype, etag, modified = hit
+                if _not_modified(etag, modified):
+                    response = Response(status=304)
+                else:
+                    response = Response(data, status, mimetype=mimetype)
+                _set_validators(response, etag, modified)
+                return response
+
+            response = func(*args, **kwargs)
+            if isinstance(response, Response) and response.status_code == 200 \
+                    and not response.is_streamed:
+                cache.set(key, (response.get_data(), response.status_code, response.mimetype,
+                                response.get_etag()[0], response.last_modified))
+            return response
+        return wrapper
+    return decorator
+
+
+# Upsert of one version counter, built once because every write runs it
+_versions = ResourceVersion.__table__
+_bump = insert(_versions).values(name=bindparam("name"), version=1,
+                                 updated_at=bindparam("updated_at"))
+_bump = _bump.on_conflict_do_update(
+    index_elements=[_versions.c.name],
+    set_={"version": _versions.c.version + 1, "updated_at": _bump.excluded.updated_at}
+)
+
+
+def bump_version(*names):
+    """
+    Increments the version counters of the given tables, e.g.
+    ``bump_version("product")``. Must be called before the write is
+    committed so the counter changes in the same transaction.
+    """
+    now = datetime.utcnow()
+    db.session.execute(_bump, [{"name": name, "updated_at": now} for name in names])
+
+
+def _not_modified(etag, modified):
+    """
+    Returns whether the If-None-Match or, without it, If-Modified-Since
+    header of the request matches the given validators.
+    """
+    if request.if_none_match:
+        return etag is not None and request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return modified is not None and since is not None and \
+        modified.replace(tzinfo=None) <= since.replace(tzinfo=None)
+
+
+def _set_validators(response, etag, modified):
+    if etag is not None:
+        response.set_etag(etag)
+    if modified is not None:
+        response.last_modified = modified
+
+
+def conditional_response(*names, last_modified=None):
+    """
+    Decorator adding a strong ETag and Last-Modified header to a resource
+    GET method and answering If-None-Match / If-Modified-Since requests
+    with 304 Not Modified without calling the method.
+
+    The ETag is derived from the version counters of the tables the
+    representation depends on, the view arguments and the query arguments,
+    so computing it costs a single primary key lookup. Resources that are
+    also cached put cached_response() above this decorator, which then
+    only runs on cache misses.
+
+    Parameters:
+        names (str): Tables the representation is built from.
+        last_modified (callable): Optional fallback returning the
+        modification time when none of the tables has been written
+        through the API yet.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            versions = db.session.execute(
+                select(ResourceVersion.name, ResourceVersion.version, ResourceVersion.updated_at)
+                .where(ResourceVersion.name.in_(names))
+            ).all()
+            counters = {name: version for name, version, _ in versions}
+            digest = hashlib.sha1(repr((
+                request.endpoint, sorted(kwargs.items()),
+                sorted(request.args.items(multi=True)),
+                [counters.get(name, 0) for name in names]
+            )).encode()).hexdigest()
+            modified = max((updated_at for _, _, updated_at in versions), default=None)
+            if modified is None and last_modified is not None:
+                modified = last_modified()
+            if modified is not None:
+                modified = modified.replace(microsecond=0)
+
+            if _not_modified(digest, modified):
+                response = Response(status=304)
+            else:
+                response = func(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    return response
+            _set_validators(response, digest, modified)
+            return response
+        return wrapper
+    return decorator
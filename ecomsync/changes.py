@@ -0,0 +1,105 @@
+"""
+Changes module.
+
+This module provides the change feed: SQLite triggers appending a row to
+the change_log table for every insert, update and delete of an order or a
+product, and a reader returning the changes after a sequence number
+together with the current documents of the changed rows.
+"""
+from sqlalchemy import DDL, event, select
+
+from ecomsync import db
+from ecomsync.models import ChangeLog, Order, Product
+from ecomsync.serializers import ORDER_SERIALIZERS, PRODUCT_SERIALIZERS
+
+# (entity name, table, primary key column) of the tracked tables
+TRACKED = (("order", '"order"', "order_id"), ("product", "product", "product_id"))
+
+# Documents of the changed rows, in the long form of each collection
+_SERIALIZERS = {
+    "order": (Order, Order.order_id, ORDER_SERIALIZERS[False]),
+    "product": (Product, Product.product_id, PRODUCT_SERIALIZERS[True]),
+}
+
+_CREATE_STATEMENTS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS change_log_{entity}_{operation}
+    AFTER {event} ON {table} BEGIN
+        INSERT INTO change_log (entity, entity_id, operation, changed_at)
+        VALUES ('{entity}', {row}.{key}, '{operation}', strftime('%Y-%m-%d %H:%M:%f', 'now'));
+    END
+    """.format(entity=entity, table=table, key=key, operation=operation,
+               event=operation.upper(), row="old" if operation == "delete" else "new")
+    for entity, table, key in TRACKED
+    for operation in ("insert", "update", "delete")
+]
+
+# Created together with the model tables by db.create_all(). DDL treats
+# "%" as the start of a substitution, so the strftime format is escaped.
+for _statement in _CREATE_STATEMENTS:
+    event.listen(db.metadata, "after_create",
+                 DDL(_statement.replace("%", "%%")).execute_if(dialect="sqlite"))
+
+
+def install_change_triggers(connection=None):
+    """
+    Creates the change log triggers if they are missing, e.g. in a
+    database created before the change feed existed. Changes made before
+    are not in the log; clients should do a full sync first.
+
+    Parameters:
+        connection (Connection): Optional connection whose transaction the
+        triggers are created in. By default they get a transaction of their own.
+    """
+    if connection is None:
+        with db.engine.begin() as connection:
+            return install_change_triggers(connection)
+    for statement in _CREATE_STATEMENTS:
+        connection.exec_driver_sql(statement)
+
+
+def read_changes(since, limit, entity=None):
+    """
+    Reads a batch of changes.
+
+    Every change carries the current document of its row, or None if the
+    row has been deleted since. A row changed several times appears once
+    per change, each time with its current document, so applying the
+    changes in order leaves the client with the current state.
+
+    Parameters:
+        since (int): Only changes with a greater seq are returned.
+        limit (int): Maximum number of changes.
+        entity (str): Optional entity ("order" or "product") to filter on.
+
+    Returns:
+        tuple: (changes, more) where changes is the list of change dicts in
+        seq order and more tells whether further changes follow.
+    """
+    stmt = select(ChangeLog.seq, ChangeLog.entity, ChangeLog.entity_id,
+                  ChangeLog.operation, ChangeLog.changed_at).where(ChangeLog.seq > since)
+    if entity is not None:
+        stmt = stmt.where(ChangeLog.entity == entity)
+    rows = db.session.execute(stmt.order_by(ChangeLog.seq).limit(limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    documents = {}
+    for name, (model, key, serializer) in _SERIALIZERS.items():
+        ids = {row.entity_id for row in rows if row.entity == name}
+        if not ids:
+            continue
+        current = db.session.execute(
+            select(*serializer.columns(), key).where(key.in_(ids))).all()
+        for row, doc in zip(current, serializer.serialize(current)):
+            documents[name, row[-1]] = doc
+
+    changes = [{
+        "seq": row.seq,
+        "entity": row.entity,
+        "id": row.entity_id,
+        "operation": row.operation,
+        "changed_at": str(row.changed_at),
+        "data": documents.get((row.entity, row.entity_id)),
+    } for row in rows]
+    return changes, more
@@ -0,0 +1,448 @@
+"""
+Connectors module.
+
+This module provides the marketplace connector framework: the
+MarketplaceConnector interface turning the order API of a marketplace
+into pages of order rows, a pool of keep-alive HTTP connections shared by
+all connectors, and the asyncio scheduler pulling the pages of many seller
+accounts concurrently, each account within its own request rate.
+
+Pulling and writing are decoupled by a bounded queue. A single writer
+imports everything queued so far in one transaction, together with the
+cursor of every account, so an account resumes after its last imported
+page and no page is imported twice. When the writer falls behind, the
+queue fills up and the pullers wait, so memory use stays bounded however
+fast the marketplaces answer.
+
+Accounts are configured in MARKETPLACE_ACCOUNTS, e.g.::
+
+    MARKETPLACE_ACCOUNTS = [
+        {"name": "standin-1", "connector": "ecomsync.standin.StandInConnector",
+         "base_url": "http://127.0.0.1:8081", "rate": 5, "burst": 5},
+    ]
+"""
+import asyncio
+import json
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import click
+import httpx
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.utils import import_string
+
+from ecomsync import db
+from ecomsync.ingest import insert_orders, validate_order_rows
+from ecomsync.models import MarketplaceCursor
+
+
+class MarketplaceError(Exception):
+    """
+    Raised by a connector when a page cannot be fetched or understood.
+    """
+
+
+class RateLimited(MarketplaceError):
+    """
+    Raised by a connector when the marketplace asks it to slow down, e.g.
+    with 429 Too Many Requests.
+
+    Attributes:
+        retry_after (float): Seconds to wait before the next request.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Rate limited for %s s" % retry_after)
+        self.retry_after = retry_after
+
+
+class OrderPage:
+    """
+    One page of orders pulled from a marketplace.
+
+    Attributes:
+        rows (list): The orders as rows of the order import (see
+        ecomsync.ingest), validated by the scheduler.
+        cursor (str): Where the next page starts; stored once the rows are
+        imported.
+        more (bool): Whether further pages are available right away.
+    """
+
+    def __init__(self, rows, cursor, more):
+        self.rows = rows
+        self.cursor = cursor
+        self.more = more
+
+
+class MarketplaceConnector:
+    """
+    Interface of the connectors. A connector is created for each seller
+    account with the account's settings from MARKETPLACE_ACCOUNTS and
+    fetches one page of orders per call through the shared HttpPool.
+    Subclasses implement fetch_page().
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.name = account["name"]
+
+    async def fetch_page(self, http, cursor):
+        """
+        Fetches the orders after cursor.
+
+        Parameters:
+            http (HttpPool): The pool to send requests with.
+            cursor (str): The cursor of the last imported page, or None to
+            start from the beginning.
+
+        Returns:
+            OrderPage: The next page of orders.
+
+        Raises:
+            RateLimited: If the marketplace asks to slow down.
+            MarketplaceError: If the page cannot be fetched or parsed.
+            OSError: If the connection fails.
+        """
+        raise NotImplementedError
+
+
+class HttpResponse:
+    """
+    A response received by HttpPool. Header names are lower case.
+    """
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class RequestNotSent(OSError):
+    """
+    Raised by HttpPool.request() when the connection could not be opened,
+    i.e. nothing of the request reached the server, so it may be sent
+    again whatever its method.
+    """
+
+
+# Methods a request can be sent again with when a kept connection fails
+# after it may have reached the server
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+
+class HttpPool:
+    """
+    HTTP client for asyncio keeping connections alive between requests,
+    with an httpx.AsyncClient per host. At most max_connections requests
+    per host are in flight at once; their connections are kept for the
+    next requests, so pulling many pages from one marketplace costs one
+    TCP (and TLS) handshake per connection instead of one per page.
+    """
+
+    def __init__(self, max_connections=16, timeout=30.0):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.opened = 0
+        self._clients = {}
+
+    async def request(self, method, url, headers=None, body=None):
+        """
+        Sends a request and reads the whole response.
+
+        Parameters:
+            method (str): The HTTP method.
+            url (str): The absolute http or https URL.
+            headers (dict): Optional request headers.
+            body (bytes): Optional request body.
+
+        Returns:
+            HttpResponse: The response.
+
+        Raises:
+            RequestNotSent: If the connection could not be opened.
+            OSError: If the connection fails or times out after that.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        client = self._clients.get(key)
+        if client is None:
+            # Requests wait for a free connection of their host as long as
+            # it takes; the timeout applies once they have one
+            client = self._clients[key] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.timeout, pool=None))
+
+        while True:
+            connected = []
+
+            async def trace(event, info):
+                if event == "connection.connect_tcp.complete":
+                    self.opened += 1
+                    connected.append(info)
+
+            try:
+                response = await client.request(method, url, headers=headers, content=body,
+                                                extensions={"trace": trace})
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                raise RequestNotSent("%s %s failed: %r" % (method, url, e)) from e
+            except httpx.TransportError as e:
+                # The server may have closed a kept connection just as the
+                # request went out. Whether it was processed is not known,
+                # so only idempotent requests are sent again.
+                if not connected and method in IDEMPOTENT_METHODS \
+                        and not isinstance(e, httpx.TimeoutException):
+                    continue
+                raise OSError("%s %s failed: %r" % (method, url, e)) from e
+            return HttpResponse(response.status_code, dict(response.headers.items()),
+                                response.content)
+
+    async def close(self):
+        """
+        Closes the kept connections.
+        """
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+class RateLimiter:
+    """
+    Token bucket allowing rate requests per second on average and bursts
+    of up to burst requests.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        """
+        Waits until a request may be sent.
+        """
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """
+        Holds back the next request for at least seconds, e.g. after the
+        marketplace answered 429 Too Many Requests.
+        """
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+def load_accounts(app, names=None):
+    """
+    Returns the MARKETPLACE_ACCOUNTS of an application, optionally only
+    those with the given names.
+
+    Raises:
+        KeyError: If a name is not configured.
+    """
+    accounts = {account["name"]: account for account in app.config["MARKETPLACE_ACCOUNTS"]}
+    if not names:
+        return list(accounts.values())
+    return [accounts[name] for name in names]
+
+
+class ConnectorScheduler:
+    """
+    Pulls the orders of several seller accounts concurrently on one asyncio
+    event loop and imports them in batches.
+
+    Every account has its own puller task, connector and RateLimiter (the
+    account's "rate" requests per second, default 5, with bursts of
+    "burst", default 1), so a slow or throttled account does not hold up
+    the others. The pullers put validated pages in a queue of queue_size
+    pages; the writer imports what is queued, up to batch_rows rows per
+    transaction, on a worker thread while the pullers go on. Invalid rows
+    are counted and skipped. An account whose page fails more than
+    retries times in a row, or whose rows cannot be written, stops for
+    this run and resumes from its stored cursor in the next.
+    """
+
+    def __init__(self, app, accounts, http=None, queue_size=64, batch_rows=5000,
+                 retries=3, backoff=0.5):
+        self.app = app
+        self.accounts = accounts
+        self.http = http or HttpPool(app.config["MARKETPLACE_MAX_CONNECTIONS"],
+                                     app.config["MARKETPLACE_TIMEOUT"])
+        self.queue_size = queue_size
+        self.batch_rows = batch_rows
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {}
+        self._stopped = set()
+
+    @classmethod
+    def from_app(cls, app, names=None):
+        """
+        Creates the scheduler of the configured accounts of an application.
+        """
+        return cls(app, load_accounts(app, names),
+                   queue_size=app.config["MARKETPLACE_QUEUE_SIZE"],
+                   batch_rows=app.config["MARKETPLACE_BATCH_ROWS"],
+                   retries=app.config["MARKETPLACE_RETRIES"])
+
+    async def run(self, interval=None):
+        """
+        Pulls every account until it has no more pages and waits until all
+        pulled orders are imported. With an interval, the accounts are
+        polled again every interval seconds until the task is cancelled.
+
+        Returns:
+            dict: Per account, the number of "pages", imported "orders",
+            "rejected" rows, "rate_limited" responses and "retries", and
+            the "error" that stopped it, if any.
+        """
+        self.stats = {account["name"]: {"pages": 0, "orders": 0, "rejected": 0,
+                                        "rate_limited": 0, "retries": 0, "error": None}
+                      for account in self.accounts}
+        self._stopped = set()
+        cursors = await asyncio.to_thread(self._load_cursors)
+        queue = asyncio.Queue(self.queue_size)
+        writer = asyncio.create_task(self._write(queue))
+        pullers = asyncio.gather(*[
+            self._pull(account, cursors.get(account["name"]), queue, interval)
+            for account in self.accounts
+        ])
+        try:
+            # The writer only finishes first if it failed
+            await asyncio.wait([pullers, writer], return_when=asyncio.FIRST_COMPLETED)
+            if writer.done():
+                writer.result()
+            await pullers
+            await queue.put(None)
+            await writer
+        finally:
+            pullers.cancel()
+            writer.cancel()
+            await self.http.close()
+        return self.stats
+
+    def _load_cursors(self):
+        with self.app.app_context():
+            return dict(db.session.execute(
+                select(MarketplaceCursor.account, MarketplaceCursor.cursor)).all())
+
+    async def _pull(self, account, cursor, queue, interval):
+        name = account["name"]
+        stats = self.stats[name]
+        connector = import_string(account["connector"])(account)
+        limiter = RateLimiter(account.get("rate", 5), account.get("burst", 1))
+        failures = 0
+        while name not in self._stopped:
+            await limiter.acquire()
+            try:
+                page = await connector.fetch_page(self.http, cursor)
+            except RateLimited as e:
+                stats["rate_limited"] += 1
+                limiter.pause(e.retry_after)
+                continue
+            except (MarketplaceError, OSError, ValueError) as e:
+                failures += 1
+                if failures > self.retries:
+                    stats["error"] = str(e)
+                    return
+                stats["retries"] += 1
+                await asyncio.sleep(self.backoff * 2 ** (failures - 1))
+                continue
+            failures = 0
+            stats["pages"] += 1
+            if page.rows or page.cursor != cursor:
+                mappings, errors = validate_order_rows(page.rows)
+                stats["rejected"] += len(errors)
+                # Waits while the queue is full
+                await queue.put((name, mappings, page.cursor))
+                cursor = page.cursor
+            if not page.more:
+                if interval is None:
+                    return
+                await asyncio.sleep(interval)
+
+    async def _write(self, queue):
+        while True:
+            batch = [await queue.get()]
+            rows = len(batch[0][1]) if batch[0] else 0
+            while batch[-1] is not None and rows < self.batch_rows and not queue.empty():
+                batch.append(queue.get_nowait())
+                rows += len(batch[-1][1]) if batch[-1] else 0
+            pages = [page for page in batch
+                     if page is not None and page[0] not in self._stopped]
+            if pages:
+                await asyncio.to_thread(self._store, pages)
+            if batch[-1] is None:
+                return
+
+    def _store(self, pages):
+        """
+        Imports the rows of the pages and stores the last cursor of each
+        account in one transaction.
+        """
+        cursors = {name: cursor for name, _, cursor in pages}
+        mappings = [mapping for _, rows, _ in pages for mapping in rows]
+
+        # Like the ingestion workers, the batch is committed on its own
+        # rather than through run_write(): a savepoint around thousands of
+        # rows makes the insert triggers several times slower.
+        with self.app.app_context():
+            try:
+                insert_orders(mappings, self.app.config["ORDER_BATCH_CHUNK_SIZE"])
+                stmt = insert(MarketplaceCursor)
+                db.session.execute(stmt.on_conflict_do_update(
+                    index_elements=[MarketplaceCursor.account],
+                    set_={"cursor": stmt.excluded.cursor, "updated_at": stmt.excluded.updated_at}
+                ), [{"account": name, "cursor": cursor, "updated_at": datetime.utcnow()}
+                    for name, cursor in cursors.items()])
+                db.session.commit()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                for name in cursors:
+                    self.stats[name]["error"] = "Import failed: %s" % e
+                    self._stopped.add(name)
+                return
+            finally:
+                db.session.remove()
+        for name, rows, _ in pages:
+            self.stats[name]["orders"] += len(rows)
+
+
+@click.command("pull-orders")
+@click.option("--account", multiple=True, help="Account name; may be repeated (default all).")
+@click.option("--interval", type=float, default=None,
+              help="Poll again every this many seconds instead of exiting.")
+@with_appcontext
+def pull_orders_command(account, interval):
+    """
+    Command to pull the orders of the MARKETPLACE_ACCOUNTS.
+
+    Usage:
+        flask pull-orders
+        flask pull-orders --account standin-1 --interval 60
+    """
+    scheduler = ConnectorScheduler.from_app(current_app._get_current_object(), account)
+    start = time.perf_counter()
+    stats = asyncio.run(scheduler.run(interval))
+    for name, result in stats.items():
+        print("%s: %d orders in %d pages, %d rejected, %d rate limited%s" % (
+            name, result["orders"], result["pages"], result["rejected"],
+            result["rate_limited"], ", " + result["error"] if result["error"] else ""))
+    print("Pulled %d orders in %.1f s over %d connections" % (
+        sum(result["orders"] for result in stats.values()),
+        time.perf_counter() - start, scheduler.http.opened))
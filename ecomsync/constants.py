@@ -6,3 +6,6 @@ LINK_RELATIONS_URL = "/ecomsync/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
 SENSOR_PROFILE = "/profiles/sensor/"
 MEASUREMENT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+NDJSON = "application/x-ndjson"
+STREAM_CHUNK_SIZE = 1000
@@ -0,0 +1,302 @@
+"""
+Data generator module.
+
+This module provides the synthetic data generator behind "flask testgen":
+manufacturers, lens color options, products with their options and orders
+in any quantity, derived from a seed so that the same arguments always
+produce the same rows. The first manufacturers and options are the ones of
+the original sample data.
+
+Everything is written in one transaction with multi-row INSERTs. The
+triggers maintaining the search index, the sales rollups and the change
+log are suspended while the rows are loaded, and the derived tables are
+rebuilt from the loaded rows afterwards with one statement each.
+"""
+import random
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, text
+
+from ecomsync import db, cache
+from ecomsync.models import Manufacturer, Options, Order, Product, ProductOption
+from ecomsync.utils import sql_timestamp
+
+BRANDS = (
+    ("Ray Ban", "ray-ban"), ("Arnette", "arnette"), ("Oakley", "oakley"),
+    ("Burberry", "burberry"), ("Dior", "dior"), ("Dolce & Gabbana", "dolce-gabbana"),
+    ("Emporio Armani", "emporio-armani"), ("Fendi", "fendi"), ("Gucci", "gucci"),
+    ("Hugo Boss", "hugo-boss"), ("Jimmy Choo", "jimmy-choo"), ("Kate Spade", "kate-spade"),
+    ("Lacoste", "lacoste"), ("Marc Jacobs", "marc-jacobs"),
+    ("Michael Kors", "michael-kors"), ("Miu Miu", "miu-miu"), ("Prada", "prada"),
+    ("Polo Ralph Lauren", "polo-ralph-lauren"), ("Versace", "versace"),
+    ("Swarovski", "swarovski"), ("Tom Ford", "tom-ford"),
+)
+
+COLORS = (
+    "Black", "Black Gradient", "Brown", "Brown Gradient", "Green", "Flash Silver",
+    "Purple Blue", "Light Blue", "Yellow", "Rose Gold", "Red Orange", "Blue",
+)
+
+FIRST_NAMES = (
+    "Roshan", "Dilshani", "Mithum", "Aino", "Eetu", "Emma", "Lauri", "Sofia", "Oliver",
+    "Maria", "Lukas", "Anna", "Noah", "Elsa", "Mateo", "Chloe", "Jonas", "Lucia",
+    "Hugo", "Ines", "Liam", "Sara", "Felix", "Julia",
+)
+
+LAST_NAMES = (
+    "Fernando", "Vithanage", "Korhonen", "Virtanen", "Nieminen", "Andersson",
+    "Johansson", "Muller", "Schmidt", "Martin", "Bernard", "Garcia", "Lopez",
+    "Rossi", "Smith", "Jones", "Perera", "Silva",
+)
+
+STREETS = ("yliopistokatu", "Kauppakatu", "Storgatan", "Hauptstrasse", "Rue de la Paix",
+           "Calle Mayor", "Via Roma", "High Street")
+
+# (city, postcode prefix, country, weight): most orders come from the home
+# market, like the sample data
+CITIES = (
+    ("Oulu", "905", "Finland", 30), ("Helsinki", "001", "Finland", 20),
+    ("Stockholm", "114", "Sweden", 10), ("Berlin", "101", "Germany", 10),
+    ("Paris", "750", "France", 8), ("Madrid", "280", "Spain", 7),
+    ("Rome", "001", "Italy", 6), ("London", "EC1", "United Kingdom", 9),
+)
+
+
+def _manufacturer_rows(first, count):
+    rows = []
+    for manufacturer_id in range(first, first + count):
+        name, slug = BRANDS[(manufacturer_id - 1) % len(BRANDS)]
+        series = (manufacturer_id - 1) // len(BRANDS)
+        if series:
+            name, slug = "%s %d" % (name, series + 1), "%s-%d" % (slug, series + 1)
+        rows.append((manufacturer_id, name, "/image/%s.jpg" % slug,
+                     "%s Sunglass Lenses" % name))
+    return rows
+
+
+def _option_rows(first, count):
+    rows = []
+    for option_id in range(first, first + count):
+        name = COLORS[(option_id - 1) % len(COLORS)]
+        series = (option_id - 1) // len(COLORS)
+        if series:
+            name = "%s %d" % (name, series + 1)
+        rows.append((option_id, name,
+                     "/image/options/%s.jpg" % name.lower().replace(" ", "-")))
+    return rows
+
+
+def _product_rows(rng, first, count, manufacturers, start):
+    rows = []
+    for product_id in range(first, first + count):
+        manufacturer_id = rng.choice(manufacturers)
+        brand = BRANDS[(manufacturer_id - 1) % len(BRANDS)][0]
+        code = brand.replace(" ", "").upper()[:3]
+        model = "%s%04d" % (code, rng.randrange(10000))
+        rows.append((
+            product_id, model, "%s %s Sunglass" % (brand, model), manufacturer_id,
+            "%sX%012d" % (code, product_id), rng.randrange(1001),
+            "/image/products/%s.jpg" % model, round(rng.uniform(19.9, 399.9), 2),
+            rng.randrange(45, 61),
+            sql_timestamp(start - timedelta(seconds=rng.randrange(3 * 365 * 86400))),
+        ))
+    return rows
+
+
+def _order_rows(rng, first, count, catalog, start, step):
+    """
+    Builds count orders, starting with order first at start and step
+    seconds apart on average, like orders arriving over time. Products are
+    picked with a skewed distribution, so a few best sellers get most of
+    the orders, and each order buys one to three items of its product.
+    """
+    ids, prices = catalog
+    cities = [city for city in CITIES for _ in range(city[3])]
+    names = [(first_name, first_name.lower()) for first_name in FIRST_NAMES]
+    surnames = [(last_name, last_name.lower()) for last_name in LAST_NAMES]
+    midnight = datetime.combine(start.date(), datetime.min.time())
+    origin = (start - midnight).total_seconds()
+    days = {}
+    random = rng.random
+    rows = []
+    for number, order_id in enumerate(range(first, first + count)):
+        firstname, first_lower = names[int(random() * len(names))]
+        lastname, last_lower = surnames[int(random() * len(surnames))]
+        city, postcode, country, _ = cities[int(random() * len(cities))]
+        index = int(len(ids) * random() ** 3)
+        # Formatting the day once and the time of day per order is much
+        # cheaper than formatting a datetime per order.
+        day, second = divmod(int(origin + (number + random()) * step), 86400)
+        if day not in days:
+            days[day] = (midnight + timedelta(days=day)).strftime("%Y-%m-%d")
+        minute, second = divmod(second, 60)
+        rows.append((
+            order_id, firstname, lastname,
+            "%s.%s%d@example.com" % (first_lower, last_lower, order_id),
+            "0%09d" % int(random() * 10 ** 9), ids[index],
+            "%s %d" % (STREETS[int(random() * len(STREETS))], 1 + int(random() * 199)),
+            city, "%s%02d" % (postcode, int(random() * 100)), country,
+            round(prices[index] * (1 + int(random() * 3)), 2),
+            "%s %02d:%02d:%02d.000000" % (days[day], minute // 60, minute % 60, second),
+        ))
+    return rows
+
+
+def _next_id(column):
+    return (db.session.scalar(select(func.max(column))) or 0) + 1
+
+
+def generate(manufacturers=21, options=12, products=100, orders=1000,
+             options_per_product=4, seed=0, start=datetime(2023, 1, 1), days=365,
+             chunk_size=50000):
+    """
+    Adds synthetic rows to the database and commits them in one
+    transaction. New rows get the ids following the existing ones, so the
+    generator can be run on a database that already has data. Orders
+    refer to the products generated in the same run, or to the existing
+    products if none are generated. Must be called inside an application
+    context.
+
+    Parameters:
+        manufacturers (int): Number of manufacturers.
+        options (int): Number of lens color options.
+        products (int): Number of products, each offered in one to
+        options_per_product of the options.
+        orders (int): Number of orders.
+        options_per_product (int): Most options of a product.
+        seed (int): Seed of the random generator.
+        start (datetime): Date of the first orders.
+        days (int): Number of days the orders are spread over.
+        chunk_size (int): Rows per batch of INSERTs.
+
+    Returns:
+        dict: The number of rows added to each table.
+    """
+    rng = random.Random(seed)
+    connection = db.session.connection()
+
+    first_manufacturer = _next_id(Manufacturer.manufacturer_id)
+    first_option = _next_id(Options.option_id)
+    first_product = _next_id(Product.product_id)
+    first_order = _next_id(Order.order_id)
+
+    # pysqlite only opens a transaction before INSERT/UPDATE/DELETE. The
+    # triggers and indexes are dropped first, so the transaction is opened
+    # here, or a failed load would leave them dropped.
+    if not connection.connection.driver_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+    try:
+        # Suspending the triggers and the indexes of the loaded tables; they
+        # are recreated from their saved definitions once the rows are in,
+        # which is much faster than updating the indexes row by row.
+        suspended = connection.execute(text(
+            "SELECT type, name, sql FROM sqlite_master WHERE type IN ('trigger', 'index') "
+            "AND sql IS NOT NULL AND tbl_name IN "
+            "('manufacturer', 'options', 'product', 'product_option', 'order')"
+        )).all()
+        for kind, name, _ in suspended:
+            connection.exec_driver_sql('DROP %s "%s"' % (kind.upper(), name))
+
+        def load(model, columns, rows):
+            statement = 'INSERT INTO "%s" (%s) VALUES (%s)' % (
+                model.__tablename__, ", ".join(columns), ", ".join("?" * len(columns)))
+            for offset in range(0, len(rows), chunk_size):
+                connection.exec_driver_sql(statement, rows[offset:offset + chunk_size])
+            return len(rows)
+
+        counts = {}
+        counts["manufacturer"] = load(
+            Manufacturer, ("manufacturer_id", "name", "image", "description"),
+            _manufacturer_rows(first_manufacturer, manufacturers))
+        counts["options"] = load(Options, ("option_id", "name", "image"),
+                                 _option_rows(first_option, options))
+
+        manufacturer_ids = list(range(first_manufacturer, first_manufacturer + manufacturers)) \
+            or db.session.scalars(select(Manufacturer.manufacturer_id)).all()
+        option_ids = list(range(first_option, first_option + options)) \
+            or db.session.scalars(select(Options.option_id)).all()
+        product_rows = _product_rows(rng, first_product, products, manufacturer_ids, start)
+        counts["product"] = load(
+            Product, ("product_id", "name", "description", "manufacturer_id", "sku", "quantity",
+                      "image", "price", "width", "date_added"), product_rows)
+        counts["product_option"] = load(ProductOption, ("product_id", "option_id"), [
+            (row[0], option_id)
+            for row in product_rows
+            for option_id in rng.sample(option_ids,
+                                        rng.randint(1, min(options_per_product, len(option_ids))))
+        ] if option_ids else [])
+
+        if product_rows:
+            catalog = ([row[0] for row in product_rows], [row[7] for row in product_rows])
+        else:
+            catalog = tuple(map(list, zip(*db.session.execute(
+                select(Product.product_id, Product.price).order_by(Product.product_id)).all())))
+        counts["order"] = 0
+        step = days * 86400 / max(orders, 1)
+        for offset in range(0, orders if catalog else 0, chunk_size):
+            counts["order"] += load(
+                Order, ("order_id", "firstname", "lastname", "email", "telephone", "product_id",
+                        "payment_address_1", "payment_city", "payment_postcode",
+                        "payment_country", "total", "date_added"),
+                _order_rows(rng, first_order + offset, min(chunk_size, orders - offset), catalog,
+                            start + timedelta(seconds=offset * step), step))
+
+        for _, _, sql in suspended:
+            connection.exec_driver_sql(sql)
+
+        # The change log gets an insert entry for each new product and order,
+        # as if the triggers had run.
+        now = sql_timestamp(datetime.utcnow())
+        for entity, table, key, first in (("product", "product", "product_id", first_product),
+                                          ("order", '"order"', "order_id", first_order)):
+            connection.execute(text(
+                "INSERT INTO change_log (entity, entity_id, operation, changed_at) "
+                "SELECT :entity, %s, 'insert', :now FROM %s WHERE %s >= :first ORDER BY %s"
+                % (key, table, key, key)
+            ), {"entity": entity, "now": now, "first": first})
+
+        from ecomsync.search import rebuild_search_index
+        from ecomsync.reporting import rebuild_sales_rollup
+        from ecomsync.caching import bump_version
+        rebuild_search_index(connection)
+        rebuild_sales_rollup(connection)
+        bump_version("product", "manufacturer", "option")
+    except BaseException:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    cache.clear()
+    return counts
+
+
+@click.command("testgen")
+@click.option("--manufacturers", default=21, show_default=True)
+@click.option("--options", default=12, show_default=True, help="Number of lens colors.")
+@click.option("--products", default=100, show_default=True)
+@click.option("--orders", default=1000, show_default=True)
+@click.option("--options-per-product", default=4, show_default=True,
+              help="Most options of a product.")
+@click.option("--seed", default=0, show_default=True,
+              help="The same seed always generates the same data.")
+@click.option("--start", default="2023-01-01", show_default=True,
+              help="Date of the first orders.")
+@click.option("--days", default=365, show_default=True,
+              help="Number of days the orders are spread over.")
+@with_appcontext
+def testgen_command(manufacturers, options, products, orders, options_per_product, seed,
+                    start, days):
+    """
+    Command to populate the database with synthetic test data.
+
+    Usage:
+        flask testgen
+        flask testgen --orders 1000000 --products 10000 --seed 42
+    """
+    started = datetime.now()
+    counts = generate(manufacturers, options, products, orders, options_per_product, seed,
+                      datetime.fromisoformat(start), days)
+    print("Generated %s in %.1f s" % (
+        ", ".join("%d %s" % (count, table) for table, count in counts.items()),
+        (datetime.now() - started).total_seconds()))
@@ -0,0 +1,136 @@
+"""
+Ingest module.
+
+This module provides helpers to parse, validate and bulk insert batches of
+orders imported from marketplace settlement files.
+"""
+import json
+from datetime import datetime
+from jsonschema import Draft7Validator
+
+from ecomsync import db
+from ecomsync.constants import NDJSON
+from ecomsync.models import Order
+from ecomsync.utils import naive_utc
+
+ORDER_SCHEMA = Order.json_schema()
+ORDER_VALIDATOR = Draft7Validator(ORDER_SCHEMA)
+
+_JSON_TYPES = {
+    "string": (str,),
+    "number": (int, float),
+    "integer": (int,),
+    "null": (type(None),),
+}
+
+def _compile_checks(schema):
+    """
+    Flattens the type and maxLength constraints of a flat object schema into
+    (name, required, types, max_length) tuples that can be checked with
+    plain isinstance calls. Validating a row this way is orders of magnitude
+    cheaper than running the jsonschema validator, which is then only needed
+    to describe the errors of rows that fail.
+    """
+    checks = []
+    for name, prop in schema["properties"].items():
+        type_names = prop["type"] if isinstance(prop["type"], list) else [prop["type"]]
+        types = tuple(t for type_name in type_names for t in _JSON_TYPES[type_name])
+        checks.append((name, name in schema["required"], types, prop.get("maxLength")))
+    return checks
+
+ORDER_CHECKS = _compile_checks(ORDER_SCHEMA)
+
+def _is_valid_order(row):
+    if not isinstance(row, dict):
+        return False
+    for name, required, types, max_length in ORDER_CHECKS:
+        if name not in row:
+            if required:
+                return False
+            continue
+        value = row[name]
+        if isinstance(value, bool) or not isinstance(value, types):
+            return False
+        if max_length is not None and isinstance(value, str) and len(value) > max_length:
+            return False
+    return True
+
+def parse_order_batch(data, mimetype):
+    """
+    Parses a request body holding a batch of orders.
+
+    Parameters:
+        data (bytes): The raw request body, or the same as str.
+        mimetype (str): The request content type. NDJSON bodies hold one
+        order per line, anything else must be a JSON array of orders.
+
+    Returns:
+        list: The decoded order rows.
+
+    Raises:
+        ValueError: If the body cannot be decoded.
+    """
+    if mimetype == NDJSON:
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+    rows = json.loads(data)
+    if not isinstance(rows, list):
+        raise ValueError("Request body must be a JSON array of orders")
+    return rows
+
+def validate_order_rows(rows):
+    """
+    Validates every row of a batch against the order schema and converts
+    the valid ones into column mappings.
+
+    Parameters:
+        rows (list): Decoded order rows.
+
+    Returns:
+        tuple: (mappings, errors) where errors maps the index of each
+        invalid row to a list of messages.
+    """
+    mappings = []
+    errors = {}
+    for index, row in enumerate(rows):
+        messages = []
+        if not _is_valid_order(row):
+            messages = [error.message for error in ORDER_VALIDATOR.iter_errors(row)]
+        if not messages:
+            try:
+                date_added = naive_utc(datetime.fromisoformat(row["date_added"]))
+            except ValueError as e:
+                messages.append(str(e))
+            # Bulk imports do not commit reservations; the stock would be
+            # released when the reservation expires
+            if row.get("reservation_id") is not None:
+                messages.append("reservation_id is only supported by POST /api/order/")
+        if messages:
+            errors[index] = messages
+            continue
+        mappings.append({
+            "firstname": row["firstname"],
+            "lastname": row["lastname"],
+            "email": row["email"],
+            "telephone": row["telephone"],
+            "product_id": row.get("product_id"),
+            "payment_address_1": row["payment_address_1"],
+            "payment_city": row["payment_city"],
+            "payment_postcode": row["payment_postcode"],
+            "payment_country": row["payment_country"],
+            "total": row["total"],
+            "date_added": date_added,
+        })
+    return mappings, errors
+
+def insert_orders(mappings, chunk_size):
+    """
+    Inserts validated order mappings with bulk INSERTs of chunk_size rows.
+    The caller is responsible for committing, so the whole batch can be
+    written in a single transaction.
+
+    Parameters:
+        mappings (list): Mappings returned by validate_order_rows.
+        chunk_size (int): Number of rows sent per INSERT statement.
+    """
+    for start in range(0, len(mappings), chunk_size):
+        db.session.bulk_insert_mappings(Order, mappings[start:start + chunk_size])
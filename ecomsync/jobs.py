@@ -0,0 +1,288 @@
+"""
+Jobs module.
+
+This module provides the durable order ingestion queue. The import
+endpoints store each request body as an IngestJob row and answer at once;
+a pool of worker threads drains the queue, validating the orders and
+writing those of several jobs in one transaction.
+
+The queue is kept in the tables of the "jobs" bind. By default that is
+the main database, where queueing a job waits for the write lock held
+by the workers while they import orders; set INGEST_QUEUE_DATABASE_URI
+to keep the queue in its own SQLite database and avoid that. Each import records the job in the IngestedJob
+table of the main database in the same transaction as the orders, so a
+job claimed again after a worker died is never imported twice.
+"""
+import json
+import threading
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from werkzeug.exceptions import BadRequest
+
+from ecomsync import db
+from ecomsync.ingest import parse_order_batch, validate_order_rows, insert_orders
+from ecomsync.models import IngestJob, IngestedJob
+
+JSON = "application/json"
+
+
+def configure_queue(app):
+    """
+    Adds the "jobs" bind holding the queue to SQLALCHEMY_BINDS: the
+    INGEST_QUEUE_DATABASE_URI database, or the main database if it is not
+    set. Must be called before db.init_app().
+
+    Parameters:
+        app (Flask): The application.
+    """
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    binds.setdefault("jobs", app.config["INGEST_QUEUE_DATABASE_URI"]
+                     or app.config["SQLALCHEMY_DATABASE_URI"])
+    app.config["SQLALCHEMY_BINDS"] = binds
+
+
+def enqueue_orders(data, mimetype=JSON):
+    """
+    Stores a request body holding a batch of orders as a queued job and
+    commits it. The body is neither parsed nor validated here so that
+    queueing costs a single small INSERT; the worker does both.
+
+    Parameters:
+        data (bytes): The raw request body.
+        mimetype (str): Its content type, JSON or NDJSON.
+
+    Returns:
+        IngestJob: The queued job.
+
+    Raises:
+        BadRequest: If the body is not UTF-8.
+    """
+    try:
+        payload = data.decode()
+    except UnicodeDecodeError:
+        raise BadRequest(description="The request body must be UTF-8")
+    job = IngestJob(status="queued", payload=payload, content_type=mimetype)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def requeue_stale(timeout):
+    """
+    Puts the jobs that have been running for more than timeout seconds,
+    e.g. because their worker died, back in the queue.
+
+    Returns:
+        int: The number of requeued jobs.
+    """
+    result = db.session.execute(
+        update(IngestJob)
+        .where(IngestJob.status == "running",
+               IngestJob.claimed_at < datetime.utcnow() - timedelta(seconds=timeout))
+        .values(status="queued", claimed_at=None)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def _claim(max_bytes):
+    """
+    Marks the oldest queued jobs, up to max_bytes of payload in total but
+    at least one job, as running and returns their (job_id, payload,
+    content_type) rows. The UPDATE only changes jobs that are still
+    queued, so concurrent workers never claim the same job.
+    """
+    queued = db.session.execute(
+        select(IngestJob.job_id, func.length(IngestJob.payload))
+        .where(IngestJob.status == "queued").order_by(IngestJob.job_id).limit(1000)
+    ).all()
+    ids, total = [], 0
+    for job_id, size in queued:
+        if ids and total + size > max_bytes:
+            break
+        ids.append(job_id)
+        total += size
+    if not ids:
+        return []
+    jobs = db.session.execute(
+        update(IngestJob)
+        .where(IngestJob.job_id.in_(ids), IngestJob.status == "queued")
+        .values(status="running", claimed_at=datetime.utcnow())
+        .returning(IngestJob.job_id, IngestJob.payload, IngestJob.content_type)
+    ).all()
+    db.session.commit()
+    return sorted(jobs)
+
+
+def _import(job, chunk_size):
+    """
+    Parses, validates and inserts the orders of a job and records the job
+    as imported. The caller commits.
+
+    Returns:
+        int: The number of imported orders.
+
+    Raises:
+        ValueError: If the payload cannot be parsed or a row is invalid.
+    """
+    job_id, payload, content_type = job
+    rows = parse_order_batch(payload, content_type)
+    mappings, errors = validate_order_rows(rows)
+    if errors:
+        raise ValueError(json.dumps({"invalid_rows": errors}, sort_keys=True))
+    insert_orders(mappings, chunk_size)
+    db.session.add(IngestedJob(job_id=job_id, row_count=len(rows)))
+    return len(rows)
+
+
+def _import_all(jobs, chunk_size):
+    """
+    Imports the orders of the claimed jobs into the main database in a
+    single transaction, skipping jobs imported before. If that fails, the
+    jobs are imported one transaction each so only the failing ones fail.
+    Any error other than OperationalError (e.g. "database is locked"),
+    including a bug hit by a row, fails the job it happened in.
+
+    Returns:
+        dict: Maps each job id to its (status, row_count, error).
+    """
+    imported = dict(db.session.execute(
+        select(IngestedJob.job_id, IngestedJob.row_count)
+        .where(IngestedJob.job_id.in_([job[0] for job in jobs]))
+    ).all())
+    results = {job_id: ("done", count, None) for job_id, count in imported.items()}
+    pending = [job for job in jobs if job[0] not in imported]
+    try:
+        counts = {job[0]: _import(job, chunk_size) for job in pending}
+        db.session.commit()
+        results.update((job_id, ("done", count, None)) for job_id, count in counts.items())
+        return results
+    except OperationalError:
+        raise
+    except Exception:
+        db.session.rollback()
+
+    for job in pending:
+        try:
+            count = _import(job, chunk_size)
+            db.session.commit()
+            results[job[0]] = ("done", count, None)
+        except OperationalError:
+            raise
+        except (IntegrityError, ValueError) as e:
+            db.session.rollback()
+            results[job[0]] = ("failed", None, str(e))
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception("Importing ingest job %s failed", job[0])
+            results[job[0]] = ("failed", None, "%s: %s" % (type(e).__name__, e))
+    return results
+
+
+def drain_once(max_bytes, chunk_size):
+    """
+    Imports the orders of the oldest queued jobs, up to max_bytes of
+    payload, and records the outcome of each job in the queue. Must be
+    called inside an application context.
+
+    Returns:
+        int: The number of processed jobs.
+    """
+    jobs = _claim(max_bytes)
+    if not jobs:
+        return 0
+    now = datetime.utcnow()
+    for job_id, (status, count, error) in _import_all(jobs, chunk_size).items():
+        db.session.execute(
+            update(IngestJob).where(IngestJob.job_id == job_id)
+            .values(status=status, row_count=count, error=error, finished_at=now)
+        )
+    db.session.commit()
+    return len(jobs)
+
+
+class IngestWorkers:
+    """
+    Pool of threads draining the ingestion queue of an application. Each
+    thread drains batches until the queue is empty, then polls it every
+    INGEST_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, app, workers):
+        self.app = app
+        self.workers = workers
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _run(self):
+        config = self.app.config
+        with self.app.app_context():
+            while not self._stop.is_set():
+                try:
+                    processed = drain_once(config["INGEST_BATCH_BYTES"],
+                                           config["ORDER_BATCH_CHUNK_SIZE"])
+                except OperationalError:
+                    # e.g. "database is locked" after busy_timeout; try again
+                    db.session.rollback()
+                    processed = 0
+                except Exception:
+                    # Keep the worker alive; claimed jobs are requeued after
+                    # INGEST_CLAIM_TIMEOUT
+                    current_app.logger.exception("Ingest worker failed")
+                    db.session.rollback()
+                    processed = 0
+                finally:
+                    db.session.remove()
+                if not processed:
+                    self._stop.wait(config["INGEST_POLL_INTERVAL"])
+
+    def start(self):
+        """
+        Requeues the jobs left running by workers that died and starts the
+        worker threads.
+        """
+        with self.app.app_context():
+            try:
+                requeue_stale(self.app.config["INGEST_CLAIM_TIMEOUT"])
+            except OperationalError:
+                # the queue table does not exist before "flask init-db"
+                db.session.rollback()
+            finally:
+                db.session.remove()
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run, name="ingest-worker-%d" % number,
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Stops the worker threads after their current batch.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+
+@click.command("ingest-worker")
+@click.option("--workers", default=1, show_default=True, help="Number of worker threads.")
+@with_appcontext
+def ingest_worker_command(workers):
+    """
+    Command to run ingestion workers in the foreground until interrupted.
+
+    Usage:
+        flask ingest-worker --workers 2
+    """
+    pool = IngestWorkers(current_app._get_current_object(), workers)
+    pool.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pool.stop()
@@ -0,0 +1,387 @@
+"""
+Metrics module.
+
+This module provides the per-endpoint metrics of the application: a WSGI
+middleware timing every request and counting the bytes of its response,
+SQLAlchemy cursor events counting the SQL statements of the request and
+the time spent in them, and the /metrics endpoint exposing the results in
+the Prometheus text format.
+
+Requests are labelled with their Flask endpoint (e.g. api.ProductItem)
+and method, so the number of series stays bounded however many URLs are
+requested. Each thread records into its own shard of preallocated
+histogram buckets, so recording takes no lock; /metrics adds the shards
+up when it is scraped. Writes passed to run_write() count for their
+request although the write batcher runs them on its own thread (see
+ecomsync.writes). SQL executed outside any request, e.g. by the ingestion
+workers or the batcher's shared COMMIT, is counted in the background
+series.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, request
+from sqlalchemy import event
+
+from ecomsync import db
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+_ENDPOINT_KEY = "ecomsync.endpoint"
+
+PROMETHEUS = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Series:
+    """
+    Histograms and counters of one endpoint and method in one shard.
+    Bucket i counts the values up to the i-th bound; the last one the
+    values above every bound.
+    """
+    __slots__ = ("latency", "latency_sum", "size", "size_sum", "queries", "queries_sum",
+                 "sql_seconds", "statuses")
+
+    def __init__(self):
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.size = [0] * (len(SIZE_BUCKETS) + 1)
+        self.size_sum = 0
+        self.queries = [0] * (len(QUERY_BUCKETS) + 1)
+        self.queries_sum = 0
+        self.sql_seconds = 0.0
+        self.statuses = {}
+
+
+class _Shard:
+    """
+    Per-thread state: the series recorded by the thread and the SQL
+    counters of the request it is serving, if any. Only the owning thread
+    writes to it, or the writer thread running a write of its request
+    while the owning thread waits for it (see Metrics.attributed()).
+    """
+    __slots__ = ("thread", "series", "in_request", "queries", "sql_seconds",
+                 "background_queries", "background_sql_seconds")
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.series = {}
+        self.in_request = False
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.background_queries = 0
+        self.background_sql_seconds = 0.0
+
+
+class Metrics:
+    """
+    Metrics registry of an application.
+    """
+
+    def __init__(self):
+        self._shards = []
+        # Totals of the threads that have exited
+        self._retired = _Shard()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            # Registered once per thread, the only time a lock is taken
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context,
+                              executemany):
+        # Kept on the execution context, which a failing statement discards
+        if context is not None:
+            context._ecomsync_query_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_ecomsync_query_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        # The shard of the request a batched write runs for, see attributed()
+        shard = getattr(self._local, "request_shard", None) or self._shard()
+        if shard.in_request:
+            shard.queries += 1
+            shard.sql_seconds += elapsed
+        else:
+            shard.background_queries += 1
+            shard.background_sql_seconds += elapsed
+
+    def attributed(self, work):
+        """
+        Wraps a write function so the statements it executes on another
+        thread (see ecomsync.writes) count for the request of this thread,
+        which waits for the write meanwhile.
+        """
+        shard = self._shard()
+        if not shard.in_request:
+            return work
+
+        def attributed_work():
+            self._local.request_shard = shard
+            try:
+                value = work()
+                # Flush here so the statements of the changes count too
+                db.session.flush()
+                return value
+            finally:
+                self._local.request_shard = None
+        return attributed_work
+
+    def begin_request(self):
+        """
+        Starts counting the SQL statements of a request on this thread.
+        """
+        shard = self._shard()
+        shard.in_request = True
+        shard.queries = 0
+        shard.sql_seconds = 0.0
+
+    def record_request(self, endpoint, method, status, elapsed, size):
+        """
+        Records a finished request of this thread with the SQL statements
+        counted since begin_request(). Requests that matched no URL rule
+        have no endpoint and are labelled "unmatched".
+        """
+        shard = self._shard()
+        shard.in_request = False
+        key = (endpoint or "unmatched", method if method in METHODS else "other")
+        series = shard.series.get(key)
+        if series is None:
+            series = shard.series[key] = _Series()
+        series.latency[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        series.latency_sum += elapsed
+        series.size[bisect_left(SIZE_BUCKETS, size)] += 1
+        series.size_sum += size
+        series.queries[bisect_left(QUERY_BUCKETS, shard.queries)] += 1
+        series.queries_sum += shard.queries
+        series.sql_seconds += shard.sql_seconds
+        series.statuses[status] = series.statuses.get(status, 0) + 1
+
+    def collect(self):
+        """
+        Adds up the shards of every thread. The shards of threads that have
+        exited are folded into one, so servers starting a thread per
+        connection do not accumulate them.
+
+        Returns:
+            tuple: (series, background) where series maps each (endpoint,
+            method) to a merged _Series and background is (queries,
+            seconds) of the SQL executed outside requests.
+        """
+        total = _Shard()
+        with self._lock:
+            live = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                else:
+                    _merge(self._retired, shard)
+            self._shards = live
+            _merge(total, self._retired)
+            for shard in live:
+                _merge(total, shard)
+        return total.series, (total.background_queries, total.background_sql_seconds)
+
+    def exposition(self):
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        merged, (background_queries, background_seconds) = self.collect()
+        keys = sorted(merged)
+        lines = [
+            "# HELP ecomsync_http_requests_total Requests served, by status code.",
+            "# TYPE ecomsync_http_requests_total counter",
+        ]
+        for key in keys:
+            for status, count in sorted(merged[key].statuses.items()):
+                lines.append("ecomsync_http_requests_total{%s,status=\"%s\"} %d"
+                             % (_labels(key), status, count))
+        _histogram(lines, "ecomsync_http_request_duration_seconds",
+                   "Time from receiving a request until its response was sent.",
+                   LATENCY_BUCKETS, merged, keys, "latency", "latency_sum")
+        _histogram(lines, "ecomsync_http_response_size_bytes", "Size of the response body.",
+                   SIZE_BUCKETS, merged, keys, "size", "size_sum")
+        _histogram(lines, "ecomsync_http_request_sql_queries",
+                   "SQL statements executed while serving a request.",
+                   QUERY_BUCKETS, merged, keys, "queries", "queries_sum")
+        lines.append("# HELP ecomsync_http_request_sql_seconds_total "
+                     "Time spent executing the SQL statements of requests.")
+        lines.append("# TYPE ecomsync_http_request_sql_seconds_total counter")
+        for key in keys:
+            lines.append("ecomsync_http_request_sql_seconds_total{%s} %r"
+                         % (_labels(key), merged[key].sql_seconds))
+        lines.extend([
+            "# HELP ecomsync_background_sql_queries_total "
+            "SQL statements executed outside requests.",
+            "# TYPE ecomsync_background_sql_queries_total counter",
+            "ecomsync_background_sql_queries_total %d" % background_queries,
+            "# HELP ecomsync_background_sql_seconds_total "
+            "Time spent executing SQL statements outside requests.",
+            "# TYPE ecomsync_background_sql_seconds_total counter",
+            "ecomsync_background_sql_seconds_total %r" % background_seconds,
+        ])
+        return "\n".join(lines) + "\n"
+
+
+def _merge(total, shard):
+    """
+    Adds the series and background counters of shard to total.
+    """
+    total.background_queries += shard.background_queries
+    total.background_sql_seconds += shard.background_sql_seconds
+    # dict.copy() is atomic, the owning thread may add series meanwhile
+    for key, series in shard.series.copy().items():
+        into = total.series.get(key)
+        if into is None:
+            into = total.series[key] = _Series()
+        for name in ("latency", "size", "queries"):
+            buckets = getattr(into, name)
+            for index, count in enumerate(getattr(series, name)):
+                buckets[index] += count
+        into.latency_sum += series.latency_sum
+        into.size_sum += series.size_sum
+        into.queries_sum += series.queries_sum
+        into.sql_seconds += series.sql_seconds
+        for status, count in series.statuses.copy().items():
+            into.statuses[status] = into.statuses.get(status, 0) + count
+
+
+def _labels(key):
+    endpoint, method = key
+    return "endpoint=\"%s\",method=\"%s\"" % (endpoint.replace("\\", "\\\\").replace("\"", "\\\""),
+                                              method)
+
+
+def _format_bound(bound):
+    return "%r" % float(bound) if isinstance(bound, float) else "%d" % bound
+
+
+def _histogram(lines, name, description, bounds, merged, keys, buckets, total):
+    lines.append("# HELP %s %s" % (name, description))
+    lines.append("# TYPE %s histogram" % name)
+    for key in keys:
+        series = merged[key]
+        labels = _labels(key)
+        cumulative = 0
+        for bound, count in zip(bounds, getattr(series, buckets)):
+            cumulative += count
+            lines.append("%s_bucket{%s,le=\"%s\"} %d" % (name, labels, _format_bound(bound),
+                                                         cumulative))
+        # The count is derived from the buckets so it always matches +Inf
+        cumulative += getattr(series, buckets)[-1]
+        lines.append("%s_bucket{%s,le=\"+Inf\"} %d" % (name, labels, cumulative))
+        lines.append("%s_sum{%s} %r" % (name, labels, getattr(series, total)))
+        lines.append("%s_count{%s} %d" % (name, labels, cumulative))
+
+
+class ResponseBody:
+    """
+    Iterates over a WSGI response body, counting its bytes, and calls
+    finish(size) once the body has been sent or the server closes it,
+    whichever comes first.
+    """
+
+    def __init__(self, body, finish):
+        self._body = body
+        self._finish = finish
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self._body:
+            self.size += len(chunk)
+            yield chunk
+        self._done()
+
+    def _done(self):
+        finish, self._finish = self._finish, None
+        if finish is not None:
+            finish(self.size)
+
+    def close(self):
+        try:
+            if hasattr(self._body, "close"):
+                self._body.close()
+        finally:
+            self._done()
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware recording the latency, response size and SQL
+    statements of every request in a Metrics registry. The latency runs
+    until the whole body has been sent, so streamed responses are timed
+    completely.
+    """
+
+    def __init__(self, wsgi_app, metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        metrics = self.metrics
+        start = time.perf_counter()
+        status = ["500"]
+
+        def capture(code, headers, exc_info=None):
+            status[0] = code[:3]
+            return start_response(code, headers, exc_info)
+
+        def finish(size):
+            metrics.record_request(environ.get(_ENDPOINT_KEY), environ["REQUEST_METHOD"],
+                                   status[0], time.perf_counter() - start, size)
+
+        metrics.begin_request()
+        try:
+            body = self.wsgi_app(environ, capture)
+        except BaseException:
+            finish(0)
+            raise
+        return ResponseBody(body, finish)
+
+
+def metrics_view():
+    """
+    Serves the metrics in the Prometheus text format.
+    """
+    metrics = current_app.extensions["ecomsync_metrics"]
+    return Response(metrics.exposition(), mimetype=PROMETHEUS)
+
+
+def configure_metrics(app):
+    """
+    Installs the metrics middleware, the SQL statement events on every
+    engine (the main database and the binds) and the /metrics endpoint if
+    METRICS_ENABLED is set. Must be called after db.init_app().
+
+    Parameters:
+        app (Flask): The application.
+    """
+    if not app.config["METRICS_ENABLED"]:
+        return
+    metrics = app.extensions["ecomsync_metrics"] = Metrics()
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", metrics.before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", metrics.after_cursor_execute)
+
+    @app.before_request
+    def label_request():
+        request.environ[_ENDPOINT_KEY] = request.endpoint
+
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics)
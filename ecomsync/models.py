@@ -6,8 +6,12 @@ This module provides models.
 import hashlib
 from datetime import datetime
 import click
+from flask import current_app
 from flask.cli import with_appcontext
-from ecomsync import db
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from ecomsync import db, cache
 
 class ApiKey(db.Model):
     """
@@ -47,8 +51,8 @@ class ProductOption(db.Model):
     many-to-many relationships between products and options.
     """
     product_option_id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey("product.product_id"))
-    option_id = db.Column(db.Integer, db.ForeignKey("options.option_id"))
+    product_id = db.Column(db.Integer, db.ForeignKey("product.product_id"), index=True)
+    option_id = db.Column(db.Integer, db.ForeignKey("options.option_id"), index=True)
     # Define a relationship to the Product model
     product = db.relationship("Product", back_populates="product_option" , \
                               foreign_keys=[product_id])
@@ -97,8 +101,8 @@ class Product(db.Model):
     product_id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=True)
     description = db.Column(db.String(255), nullable=True)
-    manufacturer_id = db.Column(db.Integer, db.ForeignKey("manufacturer.manufacturer_id"))
-    sku = db.Column(db.String(64), nullable=True)
+    manufacturer_id = db.Column(db.Integer, db.ForeignKey("manufacturer.manufacturer_id"), index=True)
+    sku = db.Column(db.String(64), nullable=True, unique=True, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     image = db.Column(db.String(255), nullable=False)
     price = db.Column(db.Float, nullable=False)
@@ -109,6 +113,21 @@ class Product(db.Model):
     manufacturer = db.relationship("Manufacturer", back_populates="product")
     product_option = db.relationship("ProductOption", back_populates="product")
 
+    @staticmethod
+    def with_details():
+        """
+        Builds a Product query that eagerly loads the manufacturer and the
+        options of each product (through ProductOption) in the same SELECT,
+        so serializing the details does not issue any further queries.
+
+        Returns:
+            Query: Product query with joined eager loading.
+        """
+        return Product.query.options(
+            joinedload(Product.manufacturer),
+            joinedload(Product.product_option).joinedload(ProductOption.options)
+        )
+
     def serialize(self, short_form=False):
         """
         Converts the Product instance into a dictionary for easier serialization.
@@ -208,18 +227,56 @@ class Order(db.Model):
     order_id = db.Column(db.Integer, primary_key=True)
     firstname = db.Column(db.String(32), nullable=False)
     lastname = db.Column(db.String(32), nullable=False)
-    email = db.Column(db.String(96), nullable=False)
+    email = db.Column(db.String(96), nullable=False, index=True)
     telephone = db.Column(db.String(32), nullable=False)
-    product_id =  db.Column(db.Integer, db.ForeignKey("product.product_id"))
+    product_id =  db.Column(db.Integer, db.ForeignKey("product.product_id"), index=True)
     payment_address_1 = db.Column(db.String(128), nullable=False)
     payment_city = db.Column(db.String(128), nullable=False)
     payment_postcode = db.Column(db.String(10), nullable=False)
-    payment_country = db.Column(db.String(128), nullable=False)
-    total = db.Column(db.Float, nullable=False)
-    date_added = db.Column(db.DateTime, nullable=False)
+    payment_country = db.Column(db.String(128), nullable=False, index=True)
+    total = db.Column(db.Float, nullable=False, index=True)
+    date_added = db.Column(db.DateTime, nullable=False, index=True)
     # Define a relationship to the Product model
     product = db.relationship("Product", back_populates="order")
 
+    @staticmethod
+    def json_schema():
+        """
+        Generates a JSON schema for an order object.
+
+        Returns:
+            dict: JSON schema defining an order.
+        """
+        schema = {
+            "type": "object",
+            "required": ["firstname", "lastname", "email", "telephone",
+                         "payment_address_1", "payment_city", "payment_postcode",
+                         "payment_country", "total", "date_added"]
+        }
+        props = schema["properties"] = {}
+        props["firstname"] = {"description": "First name of the customer",
+                              "type": "string", "maxLength": 32}
+        props["lastname"] = {"description": "Last name of the customer",
+                             "type": "string", "maxLength": 32}
+        props["email"] = {"description": "Email address of the customer",
+                          "type": "string", "maxLength": 96}
+        props["telephone"] = {"description": "Telephone number of the customer",
+                              "type": "string", "maxLength": 32}
+        props["product_id"] = {"description": "Ordered product",
+                               "type": ["integer", "null"]}
+        props["payment_address_1"] = {"description": "Payment address",
+                                      "type": "string", "maxLength": 128}
+        props["payment_city"] = {"description": "Payment city",
+                                 "type": "string", "maxLength": 128}
+        props["payment_postcode"] = {"description": "Payment postcode",
+                                     "type": "string", "maxLength": 10}
+        props["payment_country"] = {"description": "Payment country",
+                                    "type": "string", "maxLength": 128}
+        props["total"] = {"description": "Order total", "type": "number"}
+        props["date_added"] = {"description": "ISO 8601 date the order was placed",
+                               "type": "string"}
+        return schema
+
     def serialize(self, short_form=False):
         """
         Converts the Order instance into a dictionary for easier serialization.
@@ -246,6 +303,203 @@ class Order(db.Model):
             doc["date_added"] = str(self.date_added)
         return doc
 
+class SalesRollup(db.Model):
+    """
+    Model holding the number of orders and the revenue per day, product and
+    payment country.
+
+    The rows are maintained by triggers on the order table (see
+    ecomsync.reporting), so sales reports never have to scan the orders.
+    Orders without a product are counted under product_id 0.
+    """
+    day = db.Column(db.String(10), primary_key=True)
+    product_id = db.Column(db.Integer, primary_key=True)
+    payment_country = db.Column(db.String(128), primary_key=True)
+    order_count = db.Column(db.Integer, nullable=False)
+    revenue = db.Column(db.Float, nullable=False)
+
+class ChangeLog(db.Model):
+    """
+    Model recording every insert, update and delete of an order or a
+    product.
+
+    Rows are written by triggers (see ecomsync.changes) and numbered by
+    seq, which only ever increases, so sync clients can ask for the
+    changes after the last seq they have seen.
+    """
+    __table_args__ = {"sqlite_autoincrement": True}
+    seq = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(16), nullable=False, index=True)
+    entity_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(8), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+class IngestJob(db.Model):
+    """
+    Model representing a queued batch of orders.
+
+    Jobs are created by the order import endpoints in asynchronous mode
+    and drained by the ingestion workers (see ecomsync.jobs). The payload
+    is the request body, a JSON array or NDJSON as given by content_type;
+    row_count is filled in once the orders have been imported. Jobs are
+    stored in the "jobs" bind, a separate queue database if
+    INGEST_QUEUE_DATABASE_URI is set.
+    """
+    __bind_key__ = "jobs"
+    __table_args__ = {"sqlite_autoincrement": True}
+    job_id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(8), nullable=False, default="queued", index=True)
+    payload = db.Column(db.Text, nullable=False)
+    content_type = db.Column(db.String(32), nullable=False)
+    row_count = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def serialize(self):
+        """
+        Converts the job into a dictionary for easier serialization. The
+        payload is left out.
+
+        Returns:
+            dict: A dictionary representation of the job.
+        """
+        return {
+            "id": self.job_id,
+            "status": self.status,
+            "rows": self.row_count,
+            "error": self.error,
+            "created_at": str(self.created_at),
+            "finished_at": str(self.finished_at) if self.finished_at else None,
+        }
+
+class IngestedJob(db.Model):
+    """
+    Model recording the ingestion jobs whose orders have been imported.
+
+    Rows are written in the same transaction as the orders of the job, so
+    a job that is claimed again after its worker died is not imported a
+    second time.
+    """
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    row_count = db.Column(db.Integer, nullable=False)
+
+class StockReservation(db.Model):
+    """
+    Model representing stock held for an order.
+
+    Reserving takes the quantities of the lines out of Product.quantity
+    right away, so Product.quantity is always the stock that can still be
+    sold. A reservation is "held" until it is committed to an order,
+    released, or expires at expires_at, which gives the stock back; a
+    committed reservation can still be released, e.g. when the order is
+    cancelled. Status changes are made with conditional UPDATEs (see
+    ecomsync.stock).
+    """
+    __table_args__ = (
+        db.Index("ix_stock_reservation_status_expires_at", "status", "expires_at"),
+        {"sqlite_autoincrement": True},
+    )
+    reservation_id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(9), nullable=False, default="held")
+    order_id = db.Column(db.Integer, db.ForeignKey("order.order_id"), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    lines = db.relationship("StockReservationLine", back_populates="reservation",
+                            order_by="StockReservationLine.sku")
+
+    def serialize(self):
+        """
+        Converts the reservation and its lines into a dictionary for easier
+        serialization.
+
+        Returns:
+            dict: A dictionary representation of the reservation.
+        """
+        return {
+            "id": self.reservation_id,
+            "status": self.status,
+            "order_id": self.order_id,
+            "created_at": str(self.created_at),
+            "expires_at": str(self.expires_at),
+            "items": [
+                {"sku": line.sku, "product_id": line.product_id, "quantity": line.quantity}
+                for line in self.lines
+            ],
+        }
+
+class StockReservationLine(db.Model):
+    """
+    Model representing the quantity of one product held by a reservation.
+    """
+    reservation_id = db.Column(db.Integer, db.ForeignKey("stock_reservation.reservation_id"),
+                               primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey("product.product_id"), primary_key=True)
+    sku = db.Column(db.String(64), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    reservation = db.relationship("StockReservation", back_populates="lines")
+
+class MarketplaceCursor(db.Model):
+    """
+    Model holding, per marketplace seller account, the cursor after the
+    last page of orders imported from it.
+
+    The cursor is written in the same transaction as the orders of the
+    page (see ecomsync.connectors), so pulling resumes exactly where the
+    last import ended.
+    """
+    account = db.Column(db.String(64), primary_key=True)
+    cursor = db.Column(db.String(255), nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class PushCursor(db.Model):
+    """
+    Model holding, per push target, the high-water mark of the order push:
+    the change_log seq of the last order the target has accepted.
+
+    The mark only moves past orders once their batch has been answered
+    (see ecomsync.push), so an interrupted push is resumed, not skipped.
+    """
+    target = db.Column(db.String(64), primary_key=True)
+    seq = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class PushBatch(db.Model):
+    """
+    Model recording a batch of the order push, by the change_log seqs of
+    its first and last order, when the target's mark cannot record it:
+
+    - "accepted" batches were answered while a batch before them failed;
+      they are skipped when the orders after the mark are sent again and
+      deleted once the mark has moved past them;
+    - "failed" batches were refused by the store as a whole (e.g. 400 Bad
+      Request). The push moves past them; they stay as the target's dead
+      letters, with the store's error.
+    """
+    __table_args__ = (
+        db.Index("ix_push_batch_target_last_seq", "target", "last_seq"),
+    )
+    batch_id = db.Column(db.Integer, primary_key=True)
+    target = db.Column(db.String(64), nullable=False)
+    first_seq = db.Column(db.Integer, nullable=False)
+    last_seq = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(8), nullable=False)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class ResourceVersion(db.Model):
+    """
+    Model holding a version counter per catalog table.
+
+    The counter is bumped in the same transaction as every write to the
+    table, which lets conditional GET requests be answered from the
+    counters alone.
+    """
+    name = db.Column(db.String(32), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
 @click.command("masterkey")
 @with_appcontext
 def generate_master_key():
@@ -266,6 +520,8 @@ def generate_master_key():
     )
     db.session.add(db_key)
     db.session.commit()
+    from ecomsync.utils import ApiKeyStore
+    ApiKeyStore.for_app(current_app).refresh()
     print(token)
 
 # Define a command line command to create the database tables
@@ -282,152 +538,62 @@ def init_db_command():
         flask init-db
     """
     db.create_all()
+    cache.clear()
+
+def create_missing_indexes():
+    """
+    Creates the indexes declared on the models that are missing from the
+    database, e.g. in a development.db created by an earlier version.
+    Unique indexes that conflict with existing data are skipped.
 
-@click.command("populate-db")
+    Returns:
+        tuple: (created, skipped) lists of index names, where skipped
+        pairs each name with the reason.
+    """
+    created = []
+    skipped = []
+    existing = {
+        table.name: {index["name"] for index in inspect(db.engine).get_indexes(table.name)}
+        for table in db.metadata.sorted_tables
+    }
+    for table in db.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in existing[table.name]:
+                continue
+            try:
+                index.create(bind=db.engine)
+                created.append(index.name)
+            except IntegrityError as e:
+                skipped.append((index.name, str(e.orig)))
+    with db.engine.begin() as connection:
+        connection.execute(text("ANALYZE"))
+    return created, skipped
+
+@click.command("migrate-db")
 @with_appcontext
-def generate_test_data():
+def migrate_db_command():
     """
-    Command to populate the database with test data.
+    Command to upgrade an existing database: creates missing tables and the
+    indexes on frequently filtered columns (Product.sku, Product.manufacturer_id,
+    ProductOption.product_id, Order.email, Order.date_added,
+    Order.payment_country, Order.total, ...), and rebuilds the full-text
+    product search index and the sales rollups, and installs the change
+    feed triggers.
 
     This command does not take any arguments.
 
     Usage:
-        flask populate-db
-    """
-    # from datetime import datetime
-    # Add Product Options Data
-    product_options_data = [
-        (1, 1, 1),
-        (2, 1, 2),
-        (3, 1, 3),
-        (4, 1, 4),
-        (5, 2, 5),
-        (6, 2, 6),
-        (7, 2, 7),
-        (8, 2, 8),
-        (9, 3, 9),
-        (10, 3, 10),
-        (11, 3, 11),
-        (12, 4, 12),
-        (13, 4, 1),
-        (14, 4, 2)
-    ]
-    # Add Options Data
-    options_data = [
-        (1, 'Black','/image/options/black.jpg'),
-        (2, 'Black Gradient','/image/options/black-gradient.jpg'),
-        (3, 'Brown','/image/options/brown.jpg'),
-        (4, 'Brown Gradient','/image/options/brown-gradient.jpg'),
-        (5, 'Green','/image/options/green.jpg'),
-        (6, 'Flash Silver','/image/options/flash-silver.jpg'),
-        (7, 'Purple Blue','/image/options/purple-blue.jpg'),
-        (8, 'Light Blue','/image/options/light-blue.jpg'),
-        (9, 'Yellow','/image/options/yellow.jpg'),
-        (10, 'Rose Gold','/image/options/rose-gold.jpg'),
-        (11, 'Red Orange','/image/options/red-orange.jpg'),
-        (12, 'Blue','/image/options/blue.jpg')
-    ]
-    # Add Manuffacturer Data
-    manufacturer_data = [
-        (1, 'Ray Ban','/image/ray-ban.jpg','Ray Ban Sunglass Lenses'),
-        (2, 'Arnette','/image/arnette.jpg','Arnette Sunglass Lenses'),
-        (3, 'Oakley','/image/oakley.jpg','Oakley Sunglass Lenses'),
-        (4, 'Burberry','/image/burberry.jpg','Burberry Sunglass Lenses'),
-        (5, 'Dior','/image/dior.jpg','Dior Sunglass Lenses'),
-        (6, 'Dolce & Gabbana','/image/dolce-gabbana.jpg','Dolce & Gabbana Sunglass Lenses'),
-        (7, 'Emporio Armani','/image/emporio-armani.jpg','Emporio Armani Sunglass Lenses'),
-        (8, 'Fendi','/image/fendi.jpg','Fendi Sunglass Lenses'),
-        (9, 'Gucci','/image/gucci.jpg','Gucci Sunglass Lenses'),
-        (10, 'Hugo Boss','/image/hugo-boss.jpg','Hugo Boss Sunglass Lenses'),
-        (11, 'Jimmy Choo','/image/jimmy-choo.jpg','Jimmy Choo Sunglass Lenses'),
-        (12, 'Kate Spade','/image/kate-spade.jpg','Kate Spade Sunglass Lenses'),
-        (13, 'Lacoste','/image/lacoste.jpg','Lacoste Sunglass Lenses'),
-        (14, 'Marc Jacobs','/image/marc-jacobs.jpg','Marc Jacobs Sunglass Lenses'),
-        (15, 'Michael Kors','/image/michael-kors.jpg','Michael Kors Sunglass Lenses'),
-        (16, 'Miu Miu','/image/miu-miu.jpg','Miu Miu Sunglass Lenses'),
-        (17, 'Prada','/image/prada.jpg','Prada Sunglass Lenses'),
-        (18, 'Polo Ralph Lauren','/image/polo-ralph-lauren.jpg',\
-         'Polo Ralph Lauren Sunglass Lenses'),
-        (19, 'Versace','/image/versace.jpg','Versace Sunglass Lenses'),
-        (20, 'Swarovski','/image/swarovski.jpg','Swarovski Sunglass Lenses'),
-        (21, 'Tom Ford','/image/tom-ford.jpg','Tom Ford Sunglass Lenses')
-    ]
-    # Add Product Data
-    products = [
-        (1, 'Rage 4025','Arnette Rage 4025 Sunglass','2','ANX4025000008BF2',\
-         '1000','/image/products/rage_4025.jpg',39.55,3,'2023-02-27T02:14:38+00:00'),
-        (2, 'RB3357','Ray Ban RB3357 Sunglass','1','RBX335700000006B',\
-         '1000','/image/products/RB3357.jpg',39.55,3,'2023-02-27T02:14:38+00:00'),
-        (3, 'GG2598','Gucci GG2598 Sunglass','9','GUCXGG259800006B',\
-         '1000','/image/products/GG2598.jpg',39.55,3,'2023-02-27T02:14:38+00:00'),
-        (4, 'Hijinx OO9021','Oakley Hijinx Sunglass','3','OAKXHIJINX006BF1',\
-         '1000','/image/products/hijinx_OO9021.jpg',39.55,3,'2023-02-27T02:14:38+00:00')
-    ]
-    # Add Order Data
-    orders = [
-        (1, 'Roshan','Fernando','roshan@gmail.com','0123654789',1,\
-         'yliopistokatu','Oulu','90570', 'Finland', 39.55,'2019-02-27T02:14:38+00:00'),
-        (2, 'Dilshani','Vithanage','dilshani@gmail.com','0123654789',2,\
-         'yliopistokatu','Oulu','90570', 'Finland', 39.55,'2019-02-27T02:14:38+00:00'),
-        (3, 'Mithum','Fernando','mithum@gmail.com','0123654789',3,\
-         'yliopistokatu','Oulu','90570', 'Finland', 39.55,'2019-02-27T02:14:38+00:00'),
-    ]
-    # date_added = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
-    for data in orders:
-        order_item = Order(
-            order_id=data[0],
-            firstname=data[1],
-            lastname=data[2],
-            email=data[3],
-            telephone=data[4],
-            product_id=data[5],
-            payment_address_1=data[6],
-            payment_city=data[7],
-            payment_postcode=data[8],
-            payment_country=data[9],
-            total=data[10],
-            date_added=datetime.fromisoformat(data[11])
-        )
-        db.session.add(order_item)
-
-    for data in products:
-        product_item = Product(
-            product_id=data[0],
-            name=data[1],
-            description=data[2],
-            manufacturer_id=data[3],
-            sku=data[4],
-            quantity=data[5],
-            image=data[6],
-            price=data[7],
-            width=data[8],
-            date_added=datetime.fromisoformat(data[9])
-        )
-        db.session.add(product_item)
-
-    for data in manufacturer_data:
-        manufacturer_item = Manufacturer(
-            manufacturer_id=data[0],
-            name=data[1],
-            image=data[2],
-            description=data[3]
-        )
-        db.session.add(manufacturer_item)
-
-    for data in options_data:
-        options_item = Options(
-            option_id=data[0],
-            name=data[1],
-            image=data[2]
-        )
-        db.session.add(options_item)
-
-    for data in product_options_data:
-        product_options_item = ProductOption(
-            product_option_id=data[0],
-            product_id=data[1],
-            option_id=data[2]
-        )
-        db.session.add(product_options_item)
-
-    db.session.commit()
+        flask migrate-db
+    """
+    db.create_all()
+    created, skipped = create_missing_indexes()
+    for name in created:
+        print("Created index %s" % name)
+    for name, reason in skipped:
+        print("Skipped index %s: %s" % (name, reason))
+    from ecomsync.search import rebuild_search_index
+    print("Indexed %d products for search" % rebuild_search_index())
+    from ecomsync.reporting import rebuild_sales_rollup
+    print("Rebuilt %d sales rollup rows" % rebuild_sales_rollup())
+    from ecomsync.changes import install_change_triggers
+    install_change_triggers()
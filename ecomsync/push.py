@@ -0,0 +1,527 @@
+"""
+Push module.
+
+This module provides the order push: new orders are read from the change
+feed (see ecomsync.changes) in chunks, mapped to the batch endpoint of a
+store platform (WooCommerce, OpenCart) and sent with a bounded number of
+requests in flight over the keep-alive HttpPool of ecomsync.connectors.
+Batches the store is too busy for (429, 503) or that never reached it
+are retried with exponential backoff.
+
+Every target has a high-water mark, the change_log seq of the last order
+it has accepted, stored in the push_cursor table. The mark only moves
+past a batch once the batches before it have been settled too, so a
+push that is interrupted resends from the first unanswered batch: orders
+are delivered at least once. Batches accepted beyond the mark are
+recorded in the push_batch table and skipped when the orders after the
+mark are sent again. A batch is only sent again within a run if it got
+no answer because it never reached the store: a connection lost after
+sending it, or a 502 or 504 answer, may come after the store created
+its orders, and stops the target for the run instead.
+
+Orders the store rejects one by one (e.g. failing its validation) are
+counted and skipped. A batch the store refuses as a whole (400, 413,
+422) is recorded in push_batch as a dead letter, with the error, and
+skipped too, so one bad order cannot hold back the orders after it.
+
+Targets are configured in PUSH_TARGETS, e.g.::
+
+    PUSH_TARGETS = [
+        {"name": "woo", "platform": "ecomsync.push.WooCommercePlatform",
+         "base_url": "https://shop.example.com", "consumer_key": "ck_...",
+         "consumer_secret": "cs_..."},
+        {"name": "opencart", "platform": "ecomsync.push.OpenCartPlatform",
+         "base_url": "https://oc.example.com", "api_token": "..."},
+    ]
+"""
+import asyncio
+import base64
+import time
+from datetime import datetime
+from urllib.parse import quote
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert
+from werkzeug.utils import import_string
+
+from ecomsync import db
+from ecomsync.connectors import HttpPool, RequestNotSent
+from ecomsync.models import ChangeLog, Order, Product, PushBatch, PushCursor
+from ecomsync.serializers import dumps
+from ecomsync.writes import run_write
+
+
+class PushError(Exception):
+    """
+    Raised by a platform when a batch is not accepted.
+
+    Attributes:
+        retryable (bool): Whether sending the batch again may succeed,
+        e.g. after 429 Too Many Requests or 503 Service Unavailable.
+        rejected (bool): Whether the store refused the batch itself, so
+        sending it again cannot succeed; it is recorded as a dead letter.
+        retry_after (float): Seconds the store asked to wait, or None.
+    """
+
+    def __init__(self, message, retryable=False, rejected=False, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.rejected = rejected
+        self.retry_after = retry_after
+
+
+def _status_error(response, url):
+    """
+    Returns the PushError for an unsuccessful response. Only 429 and 503
+    say the batch was not processed; other 5xx answers, e.g. 502 or 504
+    from a proxy, may come after the store created the orders.
+    """
+    retry_after = response.headers.get("retry-after")
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        retry_after = None
+    return PushError("POST %s answered %d" % (url, response.status),
+                     retryable=response.status in (429, 503),
+                     rejected=response.status in (400, 413, 422),
+                     retry_after=retry_after)
+
+
+class PushPlatform:
+    """
+    Interface of the store platforms. A platform is created for each push
+    target with the target's settings from PUSH_TARGETS and sends one
+    batch of at most batch_size orders per call. Subclasses implement
+    send_batch().
+    """
+    batch_size = 100
+
+    def __init__(self, target):
+        self.target = target
+        self.name = target["name"]
+        self.batch_size = target.get("batch_size", self.batch_size)
+
+    async def send_batch(self, http, orders):
+        """
+        Sends a batch of orders to the store.
+
+        Parameters:
+            http (HttpPool): The pool to send requests with.
+            orders (list): Order rows as returned by read_orders().
+
+        Returns:
+            dict: Maps the order_id of every order the store rejected to
+            the reason.
+
+        Raises:
+            PushError: If the batch as a whole was not accepted, or was
+            answered with something unexpected (rejected).
+            RequestNotSent: If the connection could not be opened.
+            OSError: If the connection fails after that.
+        """
+        raise NotImplementedError
+
+
+class WooCommercePlatform(PushPlatform):
+    """
+    WooCommerce REST API v3: POST /wp-json/wc/v3/orders/batch with up to
+    100 orders to create, authenticated with the "consumer_key" and
+    "consumer_secret" of the target.
+
+    The order becomes a paid order with one line item named after the
+    product and carrying the order total; the product is referenced by SKU
+    in the item's metadata, since product ids differ between the stores.
+    The order_id and the order date are kept in the "_ecomsync_order_id"
+    and "_ecomsync_date_added" metadata, in the target's "currency"
+    (default EUR).
+    """
+
+    def __init__(self, target):
+        super().__init__(target)
+        self.batch_size = min(self.batch_size, 100)
+        self.url = target["base_url"].rstrip("/") + "/wp-json/wc/v3/orders/batch"
+        credentials = "%s:%s" % (target.get("consumer_key", ""), target.get("consumer_secret", ""))
+        self.headers = {
+            "Authorization": "Basic " + base64.b64encode(credentials.encode()).decode(),
+            "Content-Type": "application/json",
+        }
+        self.currency = target.get("currency", "EUR")
+
+    def order_document(self, order):
+        total = "%.2f" % order["total"]
+        return {
+            "status": "processing",
+            "set_paid": True,
+            "currency": self.currency,
+            "billing": {
+                "first_name": order["firstname"],
+                "last_name": order["lastname"],
+                "address_1": order["payment_address_1"],
+                "city": order["payment_city"],
+                "postcode": order["payment_postcode"],
+                "country": order["payment_country"],
+                "email": order["email"],
+                "phone": order["telephone"],
+            },
+            "line_items": [{
+                "name": order["product_name"] or "Order %d" % order["order_id"],
+                "quantity": 1,
+                "subtotal": total,
+                "total": total,
+                "meta_data": [{"key": "sku", "value": order["sku"]}] if order["sku"] else [],
+            }],
+            # The creation date is set by WooCommerce; the original one is kept
+            "meta_data": [
+                {"key": "_ecomsync_order_id", "value": str(order["order_id"])},
+                {"key": "_ecomsync_date_added", "value": order["date_added"].isoformat(" ")},
+            ],
+        }
+
+    async def send_batch(self, http, orders):
+        body = dumps({"create": [self.order_document(order) for order in orders]})
+        response = await http.request("POST", self.url, self.headers, body)
+        if response.status != 200:
+            raise _status_error(response, self.url)
+        try:
+            created = response.json()["create"]
+        except (ValueError, KeyError, TypeError) as e:
+            # Answered, so sending it again could create the orders twice
+            raise PushError("Unexpected answer from %s: %s" % (self.url, e),
+                            rejected=True) from e
+        # The results are in the order of the request; failed ones carry
+        # an "error" object instead of the new order
+        return {order["order_id"]: result["error"].get("message", "rejected")
+                for order, result in zip(orders, created)
+                if isinstance(result, dict) and result.get("error")}
+
+
+class OpenCartPlatform(PushPlatform):
+    """
+    OpenCart: POST index.php?route=<route>&api_token=<api_token> with
+    {"orders": [...]} in the columns of OpenCart's order table, which the
+    order columns of ecomsync follow. OpenCart has no bulk order endpoint
+    of its own; "route" (default "api/sale/order.bulk") names the one of
+    the API extension installed in the store. The answer is
+    {"orders": [...], "error": {"<index>": "<reason>", ...}}.
+    """
+
+    def __init__(self, target):
+        super().__init__(target)
+        self.url = "%s/index.php?route=%s&api_token=%s" % (
+            target["base_url"].rstrip("/"), quote(target.get("route", "api/sale/order.bulk")),
+            quote(target.get("api_token", "")))
+        self.headers = {"Content-Type": "application/json"}
+
+    @staticmethod
+    def order_document(order):
+        return {
+            "firstname": order["firstname"],
+            "lastname": order["lastname"],
+            "email": order["email"],
+            "telephone": order["telephone"],
+            "payment_firstname": order["firstname"],
+            "payment_lastname": order["lastname"],
+            "payment_address_1": order["payment_address_1"],
+            "payment_city": order["payment_city"],
+            "payment_postcode": order["payment_postcode"],
+            "payment_country": order["payment_country"],
+            "total": order["total"],
+            "date_added": order["date_added"].isoformat(" ", "seconds"),
+            "comment": "ecomsync order %d" % order["order_id"],
+            "products": [{
+                "model": order["sku"],
+                "name": order["product_name"],
+                "quantity": 1,
+                "price": order["total"],
+                "total": order["total"],
+            }] if order["sku"] else [],
+        }
+
+    async def send_batch(self, http, orders):
+        body = dumps({"orders": [self.order_document(order) for order in orders]})
+        response = await http.request("POST", self.url, self.headers, body)
+        if response.status != 200:
+            raise _status_error(response, self.url)
+        try:
+            data = response.json()
+            errors = data.get("error") or {}
+            return {orders[int(index)]["order_id"]: reason for index, reason in errors.items()}
+        except (ValueError, KeyError, TypeError, IndexError, AttributeError) as e:
+            raise PushError("Unexpected answer from %s: %s" % (self.url, e),
+                            rejected=True) from e
+
+
+def read_orders(since, limit):
+    """
+    Reads the orders inserted after a high-water mark, with the SKU and
+    name of their product. Orders deleted since are left out.
+
+    Parameters:
+        since (int): The change_log seq of the last pushed order.
+        limit (int): Maximum number of orders.
+
+    Returns:
+        list: The orders as dicts, in seq order, each with its "seq".
+    """
+    rows = db.session.execute(
+        select(ChangeLog.seq, Order.order_id, Order.firstname, Order.lastname, Order.email,
+               Order.telephone, Order.payment_address_1, Order.payment_city,
+               Order.payment_postcode, Order.payment_country, Order.total, Order.date_added,
+               Product.sku, Product.name.label("product_name"))
+        .join(Order, Order.order_id == ChangeLog.entity_id)
+        .outerjoin(Product, Product.product_id == Order.product_id)
+        .where(ChangeLog.seq > since, ChangeLog.entity == "order",
+               ChangeLog.operation == "insert")
+        .order_by(ChangeLog.seq).limit(limit)
+    ).all()
+    return [row._asdict() for row in rows]
+
+
+def load_targets(app, names=None):
+    """
+    Returns the PUSH_TARGETS of an application, optionally only those with
+    the given names.
+
+    Raises:
+        KeyError: If a name is not configured.
+    """
+    targets = {target["name"]: target for target in app.config["PUSH_TARGETS"]}
+    if not names:
+        return list(targets.values())
+    return [targets[name] for name in names]
+
+
+class PushScheduler:
+    """
+    Pushes the new orders to several targets concurrently on one asyncio
+    event loop.
+
+    Every target reads chunk_size orders at a time after its mark, splits
+    them into batches of its platform's batch_size and sends at most
+    max_in_flight batches at once. A batch failing with a retryable error
+    is sent again after backoff * 2 ** n seconds (or the store's
+    Retry-After), up to retries times; connection failures only if the
+    request was not sent (RequestNotSent). A batch the store refuses
+    (PushError.rejected) is recorded as a dead letter and the push goes
+    on. Any other failure stops the target for this run, or until the
+    next interval: the batches of the chunk not sent yet are skipped, the
+    mark moves to the last order settled before the failed batch, and
+    the batches accepted after it are recorded so they are not sent again.
+    """
+
+    def __init__(self, app, targets, http=None, chunk_size=1000, max_in_flight=4,
+                 retries=5, backoff=0.5):
+        self.app = app
+        self.targets = targets
+        self.http = http or HttpPool(max_in_flight, app.config["PUSH_TIMEOUT"])
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.stats = {}
+
+    @classmethod
+    def from_app(cls, app, names=None):
+        """
+        Creates the scheduler of the configured targets of an application.
+        """
+        return cls(app, load_targets(app, names),
+                   chunk_size=app.config["PUSH_CHUNK_SIZE"],
+                   max_in_flight=app.config["PUSH_MAX_IN_FLIGHT"],
+                   retries=app.config["PUSH_RETRIES"])
+
+    async def run(self, interval=None):
+        """
+        Pushes the new orders to every target. With an interval, the
+        targets are checked for new orders every interval seconds until the
+        task is cancelled.
+
+        Returns:
+            dict: Per target, the number of "batches" sent, accepted
+            "orders", "rejected" orders, "dead_letters" (refused batches)
+            and "retries", the high-water "mark" and the "error" that
+            stopped it, if any.
+        """
+        self.stats = {target["name"]: {"batches": 0, "orders": 0, "rejected": 0,
+                                       "dead_letters": 0, "retries": 0, "mark": 0,
+                                       "error": None}
+                      for target in self.targets}
+        try:
+            await asyncio.gather(*[self._push(target, interval) for target in self.targets])
+        finally:
+            await self.http.close()
+        return self.stats
+
+    def _load_mark(self, name):
+        with self.app.app_context():
+            try:
+                return db.session.scalar(
+                    select(PushCursor.seq).where(PushCursor.target == name)) or 0
+            finally:
+                db.session.remove()
+
+    def _read(self, name, mark):
+        """
+        Returns the next chunk of orders after the mark and the (first_seq,
+        last_seq) of the batches the target accepted beyond the mark.
+        """
+        with self.app.app_context():
+            try:
+                accepted = db.session.execute(
+                    select(PushBatch.first_seq, PushBatch.last_seq)
+                    .where(PushBatch.target == name, PushBatch.status == "accepted",
+                           PushBatch.last_seq > mark)
+                ).all()
+                return read_orders(mark, self.chunk_size), accepted
+            finally:
+                db.session.remove()
+
+    def _save(self, name, seq, batches):
+        """
+        Stores the mark of a target together with the batches it accepted
+        beyond the mark and its dead letters, given as (batch, status,
+        error), and forgets the accepted batches the mark has passed.
+        """
+        def write():
+            now = datetime.utcnow()
+            stmt = insert(PushCursor)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[PushCursor.target],
+                set_={"seq": stmt.excluded.seq, "updated_at": stmt.excluded.updated_at}
+            ), {"target": name, "seq": seq, "updated_at": now})
+            db.session.execute(
+                delete(PushBatch).where(PushBatch.target == name,
+                                        PushBatch.status == "accepted",
+                                        PushBatch.last_seq <= seq))
+            if batches:
+                db.session.execute(insert(PushBatch), [
+                    {"target": name, "first_seq": batch[0]["seq"],
+                     "last_seq": batch[-1]["seq"], "status": status, "error": error,
+                     "created_at": now}
+                    for batch, status, error in batches])
+
+        with self.app.app_context():
+            run_write(write)
+
+    async def _push(self, target, interval):
+        name = target["name"]
+        stats = self.stats[name]
+        platform = import_string(target["platform"])(target)
+        slots = asyncio.Semaphore(self.max_in_flight)
+        mark = stats["mark"] = await asyncio.to_thread(self._load_mark, name)
+        while True:
+            orders, accepted = await asyncio.to_thread(self._read, name, mark)
+            if not orders:
+                if interval is None:
+                    return
+                await asyncio.sleep(interval)
+                continue
+
+            # Orders of batches accepted after a failure are not sent again
+            pending = [order for order in orders
+                       if not any(first <= order["seq"] <= last for first, last in accepted)]
+            batches = [pending[start:start + platform.batch_size]
+                       for start in range(0, len(pending), platform.batch_size)]
+            failed = asyncio.Event()
+            results = await asyncio.gather(
+                *[self._send(platform, batch, slots, stats, failed) for batch in batches],
+                return_exceptions=True)
+
+            # The mark moves up to the first batch that is neither accepted
+            # nor refused; accepted batches beyond it are recorded instead
+            stats["error"] = None
+            unsettled = None
+            settled = []
+            for batch, result in zip(batches, results):
+                if isinstance(result, PushError) and result.rejected:
+                    settled.append((batch, "failed", str(result)))
+                    stats["dead_letters"] += 1
+                    self.app.logger.warning("%s refused the batch of orders %d-%d: %s",
+                                            platform.name, batch[0]["order_id"],
+                                            batch[-1]["order_id"], result)
+                elif isinstance(result, Exception):
+                    if unsettled is None:
+                        unsettled = batch[0]["seq"]
+                        stats["error"] = str(result)
+                else:
+                    settled.append((batch, "accepted", None))
+            if unsettled is None:
+                answered = orders[-1]["seq"]
+            else:
+                answered = max((order["seq"] for order in orders if order["seq"] < unsettled),
+                               default=mark)
+            settled = [(batch, status, error) for batch, status, error in settled
+                       if status == "failed" or batch[-1]["seq"] > answered]
+            if answered != mark or settled:
+                await asyncio.to_thread(self._save, name, answered, settled)
+                mark = stats["mark"] = answered
+            if stats["error"]:
+                if interval is None:
+                    return
+                await asyncio.sleep(interval)
+
+    async def _send(self, platform, batch, slots, stats, failed):
+        async with slots:
+            # The batches after a failed one would only be sent again
+            if failed.is_set():
+                raise PushError("Not sent after an earlier batch failed")
+            failures = 0
+            while True:
+                try:
+                    rejected = await platform.send_batch(self.http, batch)
+                    break
+                except RequestNotSent as e:
+                    error, delay = e, None
+                except OSError as e:
+                    # Sending the batch again could create its orders twice
+                    error, delay = e, None
+                    failures = self.retries
+                except PushError as e:
+                    if e.rejected:
+                        # A dead letter, which does not hold back the others
+                        raise
+                    error, delay = e, e.retry_after
+                    if not e.retryable:
+                        failures = self.retries
+                if failures >= self.retries:
+                    failed.set()
+                    raise error
+                failures += 1
+                stats["retries"] += 1
+                await asyncio.sleep(self.backoff * 2 ** (failures - 1) if delay is None else delay)
+        stats["batches"] += 1
+        stats["orders"] += len(batch) - len(rejected)
+        stats["rejected"] += len(rejected)
+        if rejected:
+            self.app.logger.warning("%s rejected orders %s", platform.name, rejected)
+        return rejected
+
+
+@click.command("push-orders")
+@click.option("--target", multiple=True, help="Target name; may be repeated (default all).")
+@click.option("--interval", type=float, default=None,
+              help="Check for new orders every this many seconds instead of exiting.")
+@with_appcontext
+def push_orders_command(target, interval):
+    """
+    Command to push the new orders to the PUSH_TARGETS.
+
+    Usage:
+        flask push-orders
+        flask push-orders --target woo --interval 60
+    """
+    scheduler = PushScheduler.from_app(current_app._get_current_object(), target)
+    start = time.perf_counter()
+    stats = asyncio.run(scheduler.run(interval))
+    for name, result in stats.items():
+        print("%s: %d orders in %d batches, %d rejected, %d dead letters, %d retries, "
+              "mark %d%s" % (
+                  name, result["orders"], result["batches"], result["rejected"],
+                  result["dead_letters"], result["retries"], result["mark"],
+                  ", " + result["error"] if result["error"] else ""))
+    print("Pushed %d orders in %.1f s over %d connections" % (
+        sum(result["orders"] for result in stats.values()),
+        time.perf_counter() - start, scheduler.http.opened))
@@ -0,0 +1,315 @@
+"""
+Query check module.
+
+This module provides an opt-in detector of SQL regressions for
+development and CI. When QUERY_CHECK_ENABLED is set, every statement a
+request executes is recorded, together with the line of code that
+issued it, and at the end of the request two kinds of findings are
+logged as warnings with the resource method that served it (e.g.
+ProductIndividualItem.get):
+
+- repeated statements: the same statement shape (the SQL with its
+  literals and IN lists collapsed) executed QUERY_CHECK_REPEAT times or
+  more, the signature of an N+1 query loop;
+- slow statements: statements running QUERY_CHECK_SLOW_SECONDS or longer.
+
+QueryCheck.budget() turns the findings, and a maximum number of
+statements per request, into assertions, which the query_budget fixture
+and marker of the test suite use to make regressions fail the tests.
+Recording walks the stack for every statement, so it is meant for
+development, not for production.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, request
+from sqlalchemy import event
+
+import ecomsync
+from ecomsync import db
+from ecomsync.metrics import ResponseBody
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(ecomsync.__file__)))
+# Modules whose frames are skipped when looking for the origin of a statement
+_INTERNAL = ("sqlalchemy", "flask_sqlalchemy", __name__)
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+
+
+def statement_shape(statement):
+    """
+    Returns the shape of an SQL statement: the statement with its string
+    and number literals replaced by ? and its lists of parameters, e.g.
+    of an expanded IN, collapsed into one, so the statements of a query
+    loop share one shape whatever row each of them reads.
+    """
+    shape = _LITERAL.sub("?", statement)
+    shape = _IN_LIST.sub("(?, ...)", shape)
+    return " ".join(shape.split())
+
+
+def _origin():
+    """
+    Returns "path:line" of the innermost frame on the stack outside
+    SQLAlchemy and this module, i.e. the code that issued the statement.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if not module.startswith(_INTERNAL):
+            filename = frame.f_code.co_filename
+            if filename.startswith(_ROOT):
+                filename = os.path.relpath(filename, _ROOT)
+            return "%s:%d" % (filename, frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised by QueryCheck.budget() when a request went over its budget.
+    """
+
+
+class QueryReport:
+    """
+    The statements executed while serving one request.
+
+    Attributes:
+        resource (str): Resource method that served the request, e.g.
+        "ProductIndividualItem.get", or the endpoint of other views.
+        path (str): Path of the request.
+        statements (list): (statement, seconds, origin) of every statement.
+    """
+
+    def __init__(self, resource, path):
+        self.resource = resource
+        self.path = path
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def repeated(self, threshold):
+        """
+        Returns (shape, count, origin) of the statement shapes executed
+        threshold times or more, most repeated first.
+        """
+        shapes = {}
+        for statement, _, origin in self.statements:
+            shape = statement_shape(statement)
+            if shape in shapes:
+                shapes[shape][0] += 1
+            else:
+                shapes[shape] = [1, origin]
+        found = [(shape, count, origin) for shape, (count, origin) in shapes.items()
+                 if count >= threshold]
+        return sorted(found, key=lambda item: -item[1])
+
+    def slow(self, seconds):
+        """
+        Returns (statement, seconds, origin) of the statements that ran
+        seconds or longer.
+        """
+        return [item for item in self.statements if item[1] >= seconds]
+
+    def findings(self, repeat, slow_seconds):
+        """
+        Returns the findings as one message per finding.
+        """
+        messages = []
+        for shape, count, origin in self.repeated(repeat):
+            messages.append("%s (%s): %d x %s [first at %s]"
+                            % (self.resource, self.path, count, shape, origin))
+        for statement, seconds, origin in self.slow(slow_seconds):
+            messages.append("%s (%s): %.1f ms %s [at %s]"
+                            % (self.resource, self.path, seconds * 1000,
+                               " ".join(statement.split()), origin))
+        return messages
+
+
+class QueryCheck:
+    """
+    Records the statements of every request of an application and logs
+    the repeated and slow ones.
+
+    Statements are attributed to the request served by the thread that
+    executes them. Writes passed to run_write() run on the writer thread,
+    which the check follows through attributed().
+    """
+
+    def __init__(self, app, repeat=5, slow_seconds=0.1):
+        self.app = app
+        self.repeat = repeat
+        self.slow_seconds = slow_seconds
+        self._local = threading.local()
+        self._budgets = []
+
+    @classmethod
+    def from_app(cls, app):
+        return cls(app, app.config["QUERY_CHECK_REPEAT"], app.config["QUERY_CHECK_SLOW_SECONDS"])
+
+    def listen(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context,
+                               executemany):
+        # Kept on the execution context, which a failing statement discards
+        if context is not None and getattr(self._local, "report", None) is not None:
+            context._ecomsync_check_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context,
+                              executemany):
+        report = getattr(self._local, "report", None)
+        start = getattr(context, "_ecomsync_check_start", None)
+        if report is None or start is None:
+            return
+        report.statements.append((statement, time.perf_counter() - start, _origin()))
+
+    def start(self, resource, path):
+        """
+        Starts recording the statements of a request on this thread. A
+        report still open, i.e. of a response the test client did not
+        read, is finished first.
+        """
+        if getattr(self._local, "report", None) is not None:
+            self.finish()
+        self._local.report = QueryReport(resource, path)
+
+    def finish(self):
+        """
+        Stops recording on this thread, logs the findings of the request
+        and hands its report to the active budgets.
+
+        Returns:
+            QueryReport: The report, None if no request was recorded.
+        """
+        report = getattr(self._local, "report", None)
+        self._local.report = None
+        if report is None:
+            return None
+        for message in report.findings(self.repeat, self.slow_seconds):
+            self.app.logger.warning("Query check: %s", message)
+        for reports in list(self._budgets):
+            reports.append(report)
+        return report
+
+    def attributed(self, work):
+        """
+        Wraps a write function so the statements it executes on another
+        thread (see ecomsync.writes) count for the current request.
+        """
+        report = getattr(self._local, "report", None)
+        if report is None:
+            return work
+
+        def attributed_work():
+            previous = getattr(self._local, "report", None)
+            self._local.report = report
+            try:
+                value = work()
+                # Flush here so the statements of the changes count too
+                db.session.flush()
+                return value
+            finally:
+                self._local.report = previous
+        return attributed_work
+
+    @contextmanager
+    def budget(self, queries=None, repeated=True, slow=False):
+        """
+        Checks the requests finished inside the block, including the
+        request of this thread whose response was not read to the end.
+
+        Parameters:
+            queries (int): Most statements a request may execute, None for
+            no limit.
+            repeated (bool): Fail on repeated statement shapes.
+            slow (bool): Fail on slow statements.
+
+        Yields:
+            list: The QueryReports of the requests, filled as they finish.
+
+        Raises:
+            QueryBudgetExceeded: If a request went over the budget.
+        """
+        reports = []
+        self._budgets.append(reports)
+        try:
+            yield reports
+            if getattr(self._local, "report", None) is not None:
+                self.finish()
+        finally:
+            self._budgets.remove(reports)
+        problems = []
+        for report in reports:
+            if queries is not None and report.count > queries:
+                problems.append("%s (%s): %d statements, budget %d:\n    %s" % (
+                    report.resource, report.path, report.count, queries, "\n    ".join(
+                        " ".join(statement.split()) for statement, _, _ in report.statements)))
+            problems.extend(report.findings(self.repeat if repeated else sys.maxsize,
+                                            self.slow_seconds if slow else float("inf")))
+        if problems:
+            raise QueryBudgetExceeded("\n".join(problems))
+
+
+class QueryCheckMiddleware:
+    """
+    WSGI middleware finishing the report of every request once its
+    response has been sent, so the statements of streamed responses,
+    which run after the request's teardown, count too.
+    """
+
+    def __init__(self, wsgi_app, check):
+        self.wsgi_app = wsgi_app
+        self.check = check
+
+    def __call__(self, environ, start_response):
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.check.finish()
+            raise
+        return ResponseBody(body, lambda size: self.check.finish())
+
+
+def _resource_method():
+    """
+    Returns the name of the resource method serving the request, e.g.
+    ProductIndividualItem.get, or the endpoint of views without a class.
+    """
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, "view_class", None)
+    if view_class is not None:
+        return "%s.%s" % (view_class.__name__, request.method.lower())
+    return request.endpoint or "unmatched"
+
+
+def configure_query_check(app):
+    """
+    Installs the query check on every engine of the application if
+    QUERY_CHECK_ENABLED is set. Must be called after db.init_app().
+
+    Parameters:
+        app (Flask): The application.
+    """
+    if not app.config["QUERY_CHECK_ENABLED"]:
+        return
+    check = app.extensions["ecomsync_query_check"] = QueryCheck.from_app(app)
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        check.listen(engine)
+
+    @app.before_request
+    def start_query_check():
+        check.start(_resource_method(), request.path)
+
+    app.wsgi_app = QueryCheckMiddleware(app.wsgi_app, check)
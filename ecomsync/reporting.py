@@ -0,0 +1,149 @@
+"""
+Reporting module.
+
+This module provides the sales report: revenue, order counts and average
+order totals grouped by day, product, manufacturer and country. Reports
+are computed from the sales_rollup table, which SQLite triggers on the
+order table keep up to date with one row per day, product and country,
+or, on request, directly from the orders.
+"""
+from datetime import datetime, time
+
+from sqlalchemy import DDL, event, func, select, text
+
+from ecomsync import db
+from ecomsync.models import Manufacturer, Order, Product, SalesRollup
+
+DIMENSIONS = ("day", "product", "manufacturer", "country")
+
+# Applying an order to the rollup row of its day, product and country, and
+# taking it back out again. Rows whose orders have all been removed are
+# deleted so the table only holds days with sales.
+_ADD = """
+    INSERT INTO sales_rollup (day, product_id, payment_country, order_count, revenue)
+    VALUES (date(new.date_added), coalesce(new.product_id, 0), new.payment_country, 1, new.total)
+    ON CONFLICT (day, product_id, payment_country) DO UPDATE SET
+        order_count = order_count + 1, revenue = revenue + excluded.revenue;
+"""
+_REMOVE = """
+    UPDATE sales_rollup SET order_count = order_count - 1, revenue = revenue - old.total
+    WHERE day = date(old.date_added) AND product_id = coalesce(old.product_id, 0)
+        AND payment_country = old.payment_country;
+    DELETE FROM sales_rollup
+    WHERE day = date(old.date_added) AND product_id = coalesce(old.product_id, 0)
+        AND payment_country = old.payment_country AND order_count <= 0;
+"""
+
+_CREATE_STATEMENTS = [
+    'CREATE TRIGGER IF NOT EXISTS sales_rollup_insert AFTER INSERT ON "order" BEGIN'
+    + _ADD + "END",
+    'CREATE TRIGGER IF NOT EXISTS sales_rollup_update AFTER UPDATE OF '
+    'date_added, product_id, payment_country, total ON "order" BEGIN'
+    + _REMOVE + _ADD + "END",
+    'CREATE TRIGGER IF NOT EXISTS sales_rollup_delete AFTER DELETE ON "order" BEGIN'
+    + _REMOVE + "END",
+]
+
+# Created together with the model tables by db.create_all().
+for _statement in _CREATE_STATEMENTS:
+    event.listen(db.metadata, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+
+
+def rebuild_sales_rollup(connection=None):
+    """
+    Creates the rollup triggers if they are missing and recomputes the
+    sales_rollup table from the orders, e.g. for a database created before
+    the rollups existed.
+
+    Parameters:
+        connection (Connection): Optional connection whose transaction the
+        rebuild is part of. By default it runs in a transaction of its own.
+
+    Returns:
+        int: The number of rollup rows.
+    """
+    if connection is None:
+        with db.engine.begin() as connection:
+            return rebuild_sales_rollup(connection)
+    for statement in _CREATE_STATEMENTS:
+        connection.execute(text(statement))
+    connection.execute(text("DELETE FROM sales_rollup"))
+    connection.execute(text("""
+        INSERT INTO sales_rollup (day, product_id, payment_country, order_count, revenue)
+        SELECT date(date_added), coalesce(product_id, 0), payment_country,
+               count(*), sum(total)
+        FROM "order"
+        GROUP BY date(date_added), coalesce(product_id, 0), payment_country
+    """))
+    return connection.execute(text("SELECT count(*) FROM sales_rollup")).scalar()
+
+
+def _source_columns(from_orders):
+    """
+    Returns the day, product, country, count and revenue expressions of
+    the rollup table or of the order table.
+    """
+    if from_orders:
+        return (func.date(Order.date_added), func.coalesce(Order.product_id, 0),
+                Order.payment_country, func.count(), func.sum(Order.total))
+    return (SalesRollup.day, SalesRollup.product_id, SalesRollup.payment_country,
+            func.sum(SalesRollup.order_count), func.sum(SalesRollup.revenue))
+
+
+def sales_report(dimensions, date_from=None, date_to=None, from_orders=False):
+    """
+    Computes the sales report grouped by the given dimensions.
+
+    Parameters:
+        dimensions (list): Names from DIMENSIONS to group by, in order.
+        date_from (date): Optional first day of the report.
+        date_to (date): Optional day after the last day of the report.
+        from_orders (bool): Whether to aggregate the order table instead of
+        the rollups, e.g. to verify them.
+
+    Returns:
+        list: One dict per group with the dimension values, "orders",
+        "revenue" and "average".
+    """
+    day, product_id, country, count, revenue = _source_columns(from_orders)
+    groups = {
+        "day": [day.label("day")],
+        "product": [product_id.label("product_id"), Product.name.label("product_name")],
+        "manufacturer": [Manufacturer.manufacturer_id.label("manufacturer_id"),
+                         Manufacturer.name.label("manufacturer_name")],
+        "country": [country.label("country")],
+    }
+    columns = [column for dimension in dimensions for column in groups[dimension]]
+    stmt = select(*columns, count.label("orders"), revenue.label("revenue"))
+    stmt = stmt.select_from(Order if from_orders else SalesRollup)
+
+    if "product" in dimensions or "manufacturer" in dimensions:
+        stmt = stmt.outerjoin(Product, Product.product_id == product_id)
+    if "manufacturer" in dimensions:
+        stmt = stmt.outerjoin(Manufacturer, Manufacturer.manufacturer_id == Product.manufacturer_id)
+
+    if from_orders:
+        # Range predicates on the indexed column instead of date(date_added)
+        if date_from is not None:
+            stmt = stmt.where(Order.date_added >= datetime.combine(date_from, time()))
+        if date_to is not None:
+            stmt = stmt.where(Order.date_added < datetime.combine(date_to, time()))
+    else:
+        if date_from is not None:
+            stmt = stmt.where(SalesRollup.day >= date_from.isoformat())
+        if date_to is not None:
+            stmt = stmt.where(SalesRollup.day < date_to.isoformat())
+
+    keys = [column.key for column in columns]
+    stmt = stmt.group_by(*columns).order_by(*columns)
+
+    report = []
+    for row in db.session.execute(stmt):
+        item = dict(zip(keys, row))
+        if item.get("product_id") == 0:
+            item["product_id"] = None
+        item["orders"] = row.orders
+        item["revenue"] = round(row.revenue, 2)
+        item["average"] = round(row.revenue / row.orders, 2)
+        report.append(item)
+    return report
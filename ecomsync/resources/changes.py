@@ -0,0 +1,45 @@
+"""
+Changes module.
+
+This module provides the change feed resource used by the sync clients.
+"""
+from flask import Response, request, url_for
+from flask_restful import Resource
+from werkzeug.exceptions import BadRequest
+
+from ecomsync.changes import read_changes, TRACKED
+from ecomsync.constants import MAX_PAGE_SIZE, MEASUREMENT_PAGE_SIZE
+from ecomsync.serializers import dumps
+from ecomsync.utils import MasonBuilder
+
+# Constants - JSON content type
+JSON = "application/json"
+
+
+class ChangeFeed(Resource):
+    """Resource for reading the order and product changes after a sequence number."""
+    def get(self):
+        """
+        Returns at most "limit" changes with a seq greater than "since"
+        (default 0), optionally only those of one "entity". The "next"
+        control continues after the last returned change; clients store
+        "last_seq" and pass it as "since" in their next sync.
+        """
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', MEASUREMENT_PAGE_SIZE))
+        except ValueError:
+            raise BadRequest(description="since and limit must be integers")
+        if limit < 1:
+            raise BadRequest(description="limit must be positive")
+        entity = request.args.get('entity')
+        if entity is not None and entity not in [name for name, _, _ in TRACKED]:
+            raise BadRequest(description="entity must be order or product")
+
+        changes, more = read_changes(since, min(limit, MAX_PAGE_SIZE), entity)
+        last_seq = changes[-1]["seq"] if changes else since
+        body = MasonBuilder(changes=changes, last_seq=last_seq, more=more)
+        args = request.args.to_dict()
+        args["since"] = last_seq
+        body.add_control("next", url_for("api.ChangeFeed", **args), method="GET")
+        return Response(dumps(body), 200, mimetype=JSON)
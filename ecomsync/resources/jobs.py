@@ -0,0 +1,29 @@
+"""
+Jobs module.
+
+This module provides the status resource of the order ingestion jobs.
+"""
+from flask import Response, abort
+from flask_restful import Resource
+
+from ecomsync import db
+from ecomsync.models import IngestJob
+from ecomsync.serializers import dumps
+from ecomsync.utils import MasonBuilder
+
+# Constants - JSON content type
+JSON = "application/json"
+
+
+class JobItem(Resource):
+    """Resource for retrieving the status of an ingestion job."""
+    def get(self, job_id):
+        """
+        Returns the status of the job: "queued" until a worker has
+        imported its orders, then "done", or "failed" with the error.
+        """
+        job = db.session.get(IngestJob, job_id)
+        if job is None:
+            abort(404, description="Job not found")
+        body = MasonBuilder(job.serialize())
+        return Response(dumps(body), 200, mimetype=JSON)
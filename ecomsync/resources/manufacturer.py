@@ -12,6 +12,7 @@ import json
 from flask import Flask, Response, request, url_for, abort, jsonify
 from flask_restful import Api, Resource
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from jsonschema import validate, ValidationError, draft7_format_checker
 from werkzeug.exceptions import NotFound
@@ -20,9 +21,12 @@ from werkzeug.routing import BaseConverter
 # Local application imports
 from ecomsync.models import Manufacturer, Product
 from ecomsync import db, api
+from ecomsync.caching import cached_response, invalidate, conditional_response, bump_version
 from ecomsync.utils import MasonBuilder
 from ecomsync.constants import *
-from ecomsync.utils import require_admin, ManufacturerBuilder
+from ecomsync.utils import require_admin, ManufacturerBuilder, KeysetPage
+from ecomsync.serializers import MANUFACTURER_SERIALIZERS, dumps, manufacturer_controls
+from ecomsync.writes import run_write
 
 
 
@@ -31,6 +35,8 @@ JSON = "application/json"
 
 class ManufacturerItem(Resource):
     """Resource for retrieving a single Manufacturer by name."""
+    @cached_response("manufacturer:{mid}")
+    @conditional_response("manufacturer", "product")
     def get(self, mid):
         
         manufacturer_item = Manufacturer.query.filter_by(manufacturer_id=mid).first()
@@ -84,8 +90,17 @@ class ManufacturerItem(Resource):
         if manufacturer is None:
             abort(404, description="Product not found")
 
-        db.session.delete(manufacturer)
-        db.session.commit()
+        def delete_manufacturer():
+            manufacturer = db.session.get(Manufacturer, mid)
+            if manufacturer is None:
+                return False
+            db.session.delete(manufacturer)
+            bump_version("manufacturer")
+            return True
+
+        if not run_write(delete_manufacturer):
+            abort(404, description="Manufacturer not found")
+        self._invalidate(mid)
 
         return Response('Manufacturer Deleted Successfully', status=200)
     
@@ -104,42 +119,64 @@ class ManufacturerItem(Resource):
         description_is = request_data.get('description_update')
         image_is = request_data.get('image_update')
 
-        try:
+        def update_manufacturer():
+            manufacturer = db.session.get(Manufacturer, mid)
+            if manufacturer is None:
+                return False
             manufacturer.name = name_is
             manufacturer.description = description_is
             manufacturer.image = image_is
-            db.session.commit()
+            bump_version("manufacturer")
+            return True
+
+        try:
+            found = run_write(update_manufacturer)
         
         except IntegrityError as e:
             abort(409, description=str(e))
         except (KeyError, ValueError, IntegrityError) as e:
             abort(400, description=str(e))
-        
+
+        if not found:
+            abort(404, description="Manufacturer not found")
+        self._invalidate(mid)
 
         return Response('Manufacturer Updated Successfully', status=200)
+
+    @staticmethod
+    def _invalidate(mid):
+        """
+        Invalidates the cached manufacturer and every cached product document
+        that embeds the manufacturer's name.
+        """
+        product_ids = db.session.scalars(
+            select(Product.product_id).filter_by(manufacturer_id=mid)
+        ).all()
+        invalidate("manufacturer:%s" % mid, "product",
+                   *("product:%s" % pid for pid in product_ids))
     
 class ManufacturerCollection(Resource):
     """Resource for retrieving a collection of all Manufacturers."""
     @require_admin
+    @conditional_response("manufacturer")
     def get(self):
         """Get method for retrieving all Manufacturers."""
         form_is = request.args.get('form', 'long')
         final_form = form_is == 'short'
 
-        manufacturers = Manufacturer.query.all()
+        serializer = MANUFACTURER_SERIALIZERS[final_form]
+        page = KeysetPage.from_request(Manufacturer.manufacturer_id)
+        rows = page.collect(
+            db.session.execute(page.apply(select(*serializer.columns()))).all(),
+            lambda row: (row[-1],)
+        )
         # Construct the response body containing the serialized Manufacturer objects
-        body = {"manufacturers": []}
         body = ManufacturerBuilder()
-        body["items"] = []  
+        body["items"] = serializer.serialize(rows, manufacturer_controls())
         body.add_control_all_manufacturers()
+        page.add_controls(body)
 
-        for manufacturer_item in manufacturers:
-            manufacturer_json = ManufacturerBuilder(manufacturer_item.serialize(final_form))
-            manufacturer_json.add_control_view_product(manufacturer_item)      
-            body["items"].append(manufacturer_json)
-
-            
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return Response(dumps(body), 200, mimetype=JSON)
         
     
     def post(self):
@@ -153,14 +190,17 @@ class ManufacturerCollection(Resource):
         description_is = request_data['description']
 
         # Attempt to create a new Manufacturer record in the database
-        try:
+        def add_manufacturer():
             manufacture_item = Manufacturer(
                 name=name_is,
                 image=image_is,
                 description=description_is
             )
             db.session.add(manufacture_item)
-            db.session.commit()
+            bump_version("manufacturer")
+
+        try:
+            run_write(add_manufacturer)
         
         
         except IntegrityError:
@@ -9,14 +9,18 @@ import json  # The json module allows you to use JSON data within Python.
 from flask import Flask, Response, request, abort, jsonify  # Importing necessary objects from flask.
 from flask_restful import Api, Resource  # Importing the Api and Resource classes from flask_restful.
 from flask_sqlalchemy import SQLAlchemy  # Importing the SQLAlchemy class from flask_sqlalchemy.
+from sqlalchemy import select  # Importing the select construct from sqlalchemy.
 from sqlalchemy.exc import IntegrityError  # Importing the IntegrityError exception from sqlalchemy.exc.
 from datetime import datetime  # Importing the datetime class from the datetime module.
 from jsonschema import validate, ValidationError, draft7_format_checker  # Importing necessary objects from jsonschema.
 from werkzeug.exceptions import NotFound  # Importing the NotFound exception from werkzeug.exceptions.
 from werkzeug.routing import BaseConverter  # Importing the BaseConverter class from werkzeug.routing.
-from ecomsync.models import Options  # Importing the Options class from your application's models module.
+from ecomsync.models import Options, ProductOption  # Importing the model classes from your application's models module.
 from ecomsync import db  # Importing the db object from your application module.
+from ecomsync.caching import cached_response, invalidate, conditional_response, bump_version
 from ecomsync.utils import require_admin
+from ecomsync.serializers import OPTION_SERIALIZER, dumps
+from ecomsync.writes import run_write
 
 # Define the JSON content type
 JSON = "application/json"  # Defining a constant for the JSON content type string.
@@ -25,15 +29,16 @@ JSON = "application/json"  # Defining a constant for the JSON content type strin
 # Define a Flask-RESTful Resource for handling Orders
 class OptionItem(Resource):
     @require_admin
+    @conditional_response("option")
+    @cached_response("option")
     def get(self):
-        body = {"options": []}
         # Query the database for all options and add them to the JSON response body
-        for option in Options.query.all():
-            item = option.serialize()
-            body["options"].append(item)
+        rows = db.session.execute(
+            select(*OPTION_SERIALIZER.columns()).order_by(Options.option_id)).all()
+        body = {"options": OPTION_SERIALIZER.serialize(rows)}
         
         # Return a Flask Response object containing the JSON response body
-        return Response(json.dumps(body), 200, mimetype='application/json')
+        return Response(dumps(body), 200, mimetype='application/json')
     
     @require_admin
     def post(self):        
@@ -50,19 +55,25 @@ class OptionItem(Resource):
         if not name_is:
             abort(400, description="Missing required field: 'name'")
 
-        try:
+        def add_option():
             # Create a new Options object with the extracted data
             option_item = Options(
                 name=name_is,
                 image=image_is,
             )
-            # Add the new Options object to the database session and commit the transaction
+            # Add the new Options object to the database session
             db.session.add(option_item)
-            db.session.commit()
+            bump_version("option")
+
+        try:
+            # Commit the new option together with concurrent writes
+            run_write(add_option)
 
         except IntegrityError:
             abort(409, description="Integrity Error occurred")
 
+        invalidate("option")
+
         # Create a Flask Response object with a success message and return it
         response_message = 'Option Added Successfully'
         response = Response(response_message, status=201)
@@ -78,8 +89,19 @@ class OptionIndividualItem(Resource):
         if option is None:
             abort(404, description="Option not found")
 
-        db.session.delete(option)
-        db.session.commit()
+        product_ids = self._linked_products(oid)
+
+        def delete_option():
+            option = db.session.get(Options, oid)
+            if option is None:
+                return False
+            db.session.delete(option)
+            bump_version("option")
+            return True
+
+        if not run_write(delete_option):
+            abort(404, description="Option not found")
+        self._invalidate(product_ids)
 
         return Response('Option Deleted Successfully', status=200)
 
@@ -98,16 +120,43 @@ class OptionIndividualItem(Resource):
         name_is = request_data.get('name_update')
         image_is = request_data.get('image_update')
 
-        try:
+        def update_option():
+            option = db.session.get(Options, oid)
+            if option is None:
+                return False
             if name_is is not None:
                 option.name = name_is
             if image_is is not None:
                 option.image = image_is
-            db.session.commit()
+            bump_version("option")
+            return True
+
+        try:
+            found = run_write(update_option)
 
         except IntegrityError as e:
             abort(409, description=str(e))
         except (KeyError, ValueError, IntegrityError) as e:
             abort(400, description=str(e))
 
+        if not found:
+            abort(404, description="Option not found")
+        self._invalidate(self._linked_products(oid))
+
         return Response('Option Updated Successfully', status=200)
+
+    @staticmethod
+    def _linked_products(oid):
+        """Returns the ids of the products offering the option."""
+        return [
+            product_option.product_id
+            for product_option in ProductOption.query.filter_by(option_id=oid).all()
+        ]
+
+    @staticmethod
+    def _invalidate(product_ids):
+        """
+        Invalidates the cached option list and every cached product document
+        listing the option.
+        """
+        invalidate("option", "product", *("product:%s" % pid for pid in product_ids))
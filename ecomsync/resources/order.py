@@ -1,8 +1,9 @@
 #Import necessary libraries and modules
 import json
-from flask import Flask, Response, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, stream_with_context, current_app, url_for
 from flask_restful import Api, Resource
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 from jsonschema import validate, ValidationError, draft7_format_checker
@@ -10,13 +11,112 @@ from werkzeug.exceptions import NotFound, BadRequest
 from werkzeug.routing import BaseConverter
 from ecomsync.models import Order
 from ecomsync import db
+from ecomsync.constants import NDJSON, STREAM_CHUNK_SIZE
+from ecomsync.ingest import parse_order_batch, validate_order_rows, insert_orders
+from ecomsync.jobs import enqueue_orders
+from ecomsync.stock import ReservationError, commit_reservation
+from ecomsync.writes import run_write
 
-from ecomsync.utils import require_admin
+from ecomsync.utils import require_admin, MasonBuilder, KeysetPage, naive_utc, positive_int
+from ecomsync.serializers import ORDER_SERIALIZERS, dumps
 
 
 # Define the JSON content type
 JSON = "application/json"
 
+# Sort orders accepted by the order collection. Every sort ends with the
+# primary key so the order is stable and can be paginated with a cursor.
+ORDER_SORTS = {
+    "order_id": (Order.order_id,),
+    "date_added": (Order.date_added, Order.order_id),
+    "total": (Order.total, Order.order_id),
+}
+
+def _parse_date(name):
+    """
+    Parses an ISO 8601 query parameter into a naive UTC datetime, the way
+    Order.date_added is stored.
+    """
+    try:
+        return naive_utc(datetime.fromisoformat(request.args[name]))
+    except ValueError:
+        raise BadRequest(description="%s must be an ISO 8601 date" % name)
+
+def _parse_number(name, convert):
+    try:
+        return convert(request.args[name])
+    except ValueError:
+        raise BadRequest(description="%s must be a number" % name)
+
+def order_filters():
+    """
+    Builds the WHERE clauses of the order collection from the query
+    parameters. date_from is inclusive and date_to exclusive; total_min and
+    total_max are both inclusive. Every predicate is on an indexed column.
+
+    Returns:
+        list: SQL predicates on Order.
+
+    Raises:
+        BadRequest: If a parameter has an invalid value.
+    """
+    args = request.args
+    filters = []
+    if "date_from" in args:
+        filters.append(Order.date_added >= _parse_date("date_from"))
+    if "date_to" in args:
+        filters.append(Order.date_added < _parse_date("date_to"))
+    if "payment_country" in args:
+        filters.append(Order.payment_country == args["payment_country"])
+    if "email" in args:
+        filters.append(Order.email == args["email"])
+    if "product_id" in args:
+        filters.append(Order.product_id == _parse_number("product_id", int))
+    if "total_min" in args:
+        filters.append(Order.total >= _parse_number("total_min", float))
+    if "total_max" in args:
+        filters.append(Order.total <= _parse_number("total_max", float))
+    return filters
+
+def ingest_async():
+    """
+    Returns whether an import request should be queued for the ingestion
+    workers: the "async" query parameter if given, else ORDER_INGEST_ASYNC.
+    """
+    value = request.args.get("async")
+    if value is None:
+        return current_app.config["ORDER_INGEST_ASYNC"]
+    return value.lower() in ("1", "true", "yes")
+
+def queued_response(data, mimetype=JSON):
+    """
+    Queues a request body holding orders as an ingestion job and returns
+    the 202 Accepted response pointing at the job's status resource.
+    """
+    job = enqueue_orders(data, mimetype)
+    href = url_for("api.JobItem", job_id=job.job_id)
+    body = MasonBuilder(job.serialize())
+    body.add_control("self", href)
+    response = Response(dumps(body), 202, mimetype=JSON)
+    response.headers["Location"] = href
+    return response
+
+def order_sort():
+    """
+    Returns the key columns of the "sort" query parameter, e.g.
+    ``sort=-date_added``, and whether the sort is descending.
+
+    Raises:
+        BadRequest: If the sort is unknown.
+    """
+    sort = request.args.get("sort", "order_id")
+    descending = sort.startswith("-")
+    try:
+        return ORDER_SORTS[sort[1:] if descending else sort], descending
+    except KeyError:
+        raise BadRequest(description="sort must be one of %s, optionally prefixed with -"
+                         % ", ".join(ORDER_SORTS))
+
 # Define a Flask-RESTful Resource for handling Orders
 class OrderItem(Resource):
     def get(self):
@@ -25,15 +125,50 @@ class OrderItem(Resource):
         if form_is == 'short':
             short_form=True
 
+        if request.args.get('stream') == 'ndjson' or \
+                request.accept_mimetypes.best_match([JSON, NDJSON]) == NDJSON:
+            return self._stream(short_form, order_filters(), *order_sort())
 
-        body = {"orders": []}
-        # Query the database for all orders and add them to the JSON response body
-        for order in Order.query.all():
-            item = order.serialize(short_form)
-            body["orders"].append(item)
+        serializer = ORDER_SERIALIZERS[short_form]
+        filters = order_filters()
+        key_columns, descending = order_sort()
+        # Query the serialized columns of one page of the matching orders, followed
+        # by the sort key, and add them to the JSON response body
+        width = len(serializer.columns())
+        page = KeysetPage.from_request(*key_columns, descending=descending)
+        stmt = select(*serializer.columns(), *key_columns).where(*filters)
+        rows = page.collect(
+            db.session.execute(page.apply(stmt)).all(),
+            lambda row: tuple(row[width:])
+        )
+        body = MasonBuilder(orders=serializer.serialize(rows))
+        page.add_controls(body)
         
         # Return a Flask Response object containing the JSON response body
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        return Response(dumps(body), 200, mimetype=JSON)
+
+    @staticmethod
+    def _stream(short_form, filters, key_columns, descending):
+        """
+        Streams every matching order, in the requested sort order, as
+        newline delimited JSON. Only the serialized
+        columns are selected, as plain rows, in chunks of STREAM_CHUNK_SIZE
+        rows and each chunk is written out before the next one is read, so
+        the first byte is sent immediately and memory use does not grow with
+        the number of orders.
+        """
+        serializer = ORDER_SERIALIZERS[short_form]
+        order = [column.desc() for column in key_columns] if descending else key_columns
+
+        def generate():
+            result = db.session.execute(
+                select(*serializer.columns()).where(*filters).order_by(*order)
+                .execution_options(yield_per=STREAM_CHUNK_SIZE)
+            )
+            for rows in result.partitions():
+                yield b"".join(dumps(doc) + b"\n" for doc in serializer.serialize(rows))
+
+        return Response(stream_with_context(generate()), 200, mimetype=NDJSON)
     
     def post(self):        
         if not request.json:
@@ -42,6 +177,14 @@ class OrderItem(Resource):
         # Parse the request JSON data
         request_data = request.get_json()
 
+        # Queue the order for the ingestion workers in asynchronous mode;
+        # they import orders in bulk and cannot commit reservations
+        if ingest_async():
+            if request_data.get('reservation_id') is not None:
+                raise BadRequest(description="reservation_id cannot be used with "
+                                             "asynchronous ingestion")
+            return queued_response(json.dumps([request_data]).encode())
+
         # Extract order data from the request JSON data
         firstname_is = request_data['firstname']
         lastname_is = request_data['lastname']
@@ -53,14 +196,17 @@ class OrderItem(Resource):
         payment_postcode_is = request_data['payment_postcode']
         payment_country_is = request_data['payment_country']
         total_is = request_data['total']
+        reservation_id_is = request_data.get('reservation_id')
+        if reservation_id_is is not None and not positive_int(reservation_id_is):
+            raise BadRequest(description="reservation_id must be a reservation id")
 
         # Validate and extract the date_added field from the request JSON data
         try:
-            date_added_is = datetime.fromisoformat(request_data['date_added']) 
+            date_added_is = naive_utc(datetime.fromisoformat(request_data['date_added']))
         except ValueError as e:
             raise BadRequest(description=str(e))
 
-        try:
+        def add_order():
             # Create a new Order object with the extracted data
             order_item = Order(
                 firstname = firstname_is,
@@ -75,12 +221,23 @@ class OrderItem(Resource):
                 total = total_is,
                 date_added = date_added_is
             )
-            # Add the new Order object to the database session and commit the transaction
+            # Add the new Order object to the database session
             db.session.add(order_item)
-            db.session.commit()
+
+            # Commit the stock reserved for the order in the same transaction
+            if reservation_id_is is not None:
+                db.session.flush()
+                if commit_reservation(reservation_id_is, order_item.order_id) is None:
+                    raise ReservationError("Reservation %s not found" % reservation_id_is)
+
+        try:
+            # Commit the new order together with concurrent writes
+            run_write(add_order)
 
         except IntegrityError:
             abort(409)
+        except ReservationError as e:
+            abort(409, description=str(e))
         except (KeyError, ValueError, IntegrityError):
             abort(400)
         
@@ -88,4 +245,59 @@ class OrderItem(Resource):
         # Create a Flask Response object with a success message and return it
         responseMessage = 'Order Added Successfully'
         response = Response(responseMessage, status=201)
-        return response
\ No newline at end of file
+        return response
+
+
+# Define a Flask-RESTful Resource for importing batches of Orders
+class OrderBatch(Resource):
+    def post(self):
+        """
+        Imports a batch of orders given either as a JSON array or as NDJSON.
+        Every row is validated before anything is written; if any row is
+        invalid nothing is inserted. Valid batches are inserted with bulk
+        INSERTs of ``chunk_size`` rows inside a single transaction. In
+        asynchronous mode the body is queued for the ingestion workers,
+        which apply the same rules, and the job reports invalid rows.
+        """
+        if request.mimetype not in (JSON, NDJSON):
+            abort(415, description="Request content type must be JSON or NDJSON")
+
+        # Validation is left to the ingestion workers in asynchronous mode;
+        # rows with a reservation_id fail the job like other invalid rows.
+        # The workers insert with ORDER_BATCH_CHUNK_SIZE.
+        if ingest_async():
+            if 'chunk_size' in request.args:
+                raise BadRequest(description="chunk_size cannot be used with "
+                                             "asynchronous ingestion")
+            return queued_response(request.get_data(), request.mimetype)
+
+        try:
+            chunk_size = int(request.args.get(
+                'chunk_size', current_app.config["ORDER_BATCH_CHUNK_SIZE"]))
+        except ValueError:
+            raise BadRequest(description="chunk_size must be an integer")
+        if chunk_size < 1:
+            raise BadRequest(description="chunk_size must be positive")
+
+        try:
+            rows = parse_order_batch(request.get_data(), request.mimetype)
+        except ValueError as e:
+            raise BadRequest(description=str(e))
+
+        mappings, errors = validate_order_rows(rows)
+        if errors:
+            results = [
+                {"row": index, "status": "invalid", "errors": errors[index]}
+                if index in errors else {"row": index, "status": "valid"}
+                for index in range(len(rows))
+            ]
+            return Response(json.dumps({"created": 0, "results": results}), 400, mimetype=JSON)
+
+
+        try:
+            run_write(lambda: insert_orders(mappings, chunk_size))
+        except IntegrityError:
+            abort(409)
+
+        results = [{"row": index, "status": "created"} for index in range(len(rows))]
+        return Response(json.dumps({"created": len(rows), "results": results}), 201, mimetype=JSON)
@@ -3,6 +3,7 @@ import json
 from flask import Response, request, url_for, abort
 from flask_restful import Api, Resource
 
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 from jsonschema import  ValidationError
@@ -11,7 +12,11 @@ from werkzeug.exceptions import BadRequest
 #Importing from the project
 from ecomsync.models import Product, ProductOption, Options, Manufacturer
 from ecomsync import db
-from ecomsync.utils import MasonBuilder
+from ecomsync.caching import cached_response, invalidate, conditional_response, bump_version
+from ecomsync.utils import MasonBuilder, KeysetPage
+from ecomsync.serializers import PRODUCT_SERIALIZERS, dumps, product_controls
+from ecomsync.search import match_expression, matches, product_search
+from ecomsync.writes import run_write
 from ecomsync.constants import *
 from ecomsync.utils import require_admin
 
@@ -22,24 +27,65 @@ JSON = "application/json"
 class ProductItem(Resource):
        
     # GET request handler
+    @cached_response("product")
+    @conditional_response("product", "manufacturer", "option", last_modified=lambda: db.session.scalar(
+        select(func.max(Product.date_added))))
     def get(self):
+        if 'ids' in request.args:
+            return self._get_many(request.args['ids'])
+
         form_is = request.args.get('form', 'short')
         final_form = form_is == 'long'
 
-        # Initializing response body
-        body = {
-            "products": []
-        }
+        serializer = PRODUCT_SERIALIZERS[final_form]
 
-        # Iterating through all products and serializing them
-        for product in Product.query.all():
-            item = product.serialize(final_form)
-            masonItem = MasonBuilder(item)
-            masonItem.add_control("self", url_for("api.ProductIndividualItem", id=product.product_id))
-            body["products"].append(masonItem)
+        # Fetching only the serialized columns of one page of products
+        # ordered by their primary key
+        page = KeysetPage.from_request(Product.product_id)
+        rows = page.collect(
+            db.session.execute(page.apply(select(*serializer.columns()))).all(),
+            lambda row: (row[0],)
+        )
 
+        # Serializing the page of products
+        body = MasonBuilder(products=serializer.serialize(rows, product_controls()))
+        page.add_controls(body)
 
         # Returning response
+        return Response(dumps(body), 200, mimetype=JSON)
+
+    @staticmethod
+    def _get_many(ids_param):
+        """
+        Returns the details of several products, in the same shape as
+        ProductIndividualItem.get, for a comma separated list of ids. All
+        products, their options and manufacturers are loaded with a single
+        query no matter how many ids are requested.
+        """
+        form_is = request.args.get('form', 'long')
+        final_form = form_is == 'long'
+
+        try:
+            ids = list(dict.fromkeys(int(pid) for pid in ids_param.split(',') if pid.strip()))
+        except ValueError:
+            raise BadRequest(description="ids must be a comma separated list of integers")
+        if len(ids) > MAX_PAGE_SIZE:
+            raise BadRequest(description="At most %d ids can be requested at once" % MAX_PAGE_SIZE)
+
+        products = {
+            product.product_id: product
+            for product in Product.with_details().filter(Product.product_id.in_(ids)).all()
+        }
+
+        body = MasonBuilder(products=[], not_found=[])
+        for pid in ids:
+            if pid in products:
+                item = MasonBuilder(serialize_product_detail(products[pid], final_form))
+                item.add_control("self", url_for("api.ProductIndividualItem", id=pid))
+                body["products"].append(item)
+            else:
+                body["not_found"].append(pid)
+
         return Response(json.dumps(body), 200, mimetype=JSON)
     
     # POST request handler
@@ -62,14 +108,12 @@ class ProductItem(Resource):
         name_is = request_data['name']
         description_is = request_data['description']
         manufacturer_id_is = request_data['manufacturerId']
-        print(manufacturer_id_is)
         sku_is = request_data['sku']
         quantity_is = request_data['quantity']
         image_is = request_data['image']
         price_is = float(request_data['price'])
         width_is = float(request_data['width'])
         selected_options_are = request_data['selectedOptions']
-        print(selected_options_are)
         
         # Parsing and validating date_added field
         try:
@@ -79,8 +123,9 @@ class ProductItem(Resource):
         
 
 
-        # Adding new product to the database
-        try:
+        # Adding the new product and its options to the database in one
+        # transaction
+        def add_product():
             product_item = Product(
                 name = name_is,
                 description = description_is,
@@ -92,28 +137,22 @@ class ProductItem(Resource):
                 width = width_is,
                 date_added = date_added_is
             )
-
-            
+            product_item.product_option = [
+                ProductOption(option_id=option) for option in selected_options_are
+            ]
             db.session.add(product_item)
-            db.session.commit()
-
-            pro_id = product_item.product_id 
+            bump_version("product")
 
-            for option in selected_options_are:
-                product_options_item = ProductOption(
-                    product_id=pro_id,
-                    option_id=option  
-                )
-                db.session.add(product_options_item)
-
-            db.session.commit()
+        try:
+            run_write(add_product)
 
         # Handling errors
         except IntegrityError:
             abort(409)
         except (KeyError, ValueError, IntegrityError):
             abort(400)
-        
+
+        invalidate("product", "manufacturer:%s" % manufacturer_id_is)
 
         # Creating and returning success response
         responseMessage = 'Product Added Successfully'
@@ -122,35 +161,92 @@ class ProductItem(Resource):
     
 
 
+class ProductSearch(Resource):
+
+    # GET request handler
+    @cached_response("product")
+    @conditional_response("product", "manufacturer")
+    def get(self):
+        """
+        Returns the products matching the words of the "q" parameter in their
+        name, description, SKU or manufacturer name, most relevant first. The
+        matches come from the product_search FTS5 index and are paginated
+        with a cursor on their rank.
+        """
+        expression = match_expression(request.args.get('q', ''))
+        if expression is None:
+            raise BadRequest(description="q must contain at least one word")
+
+        form_is = request.args.get('form', 'short')
+        final_form = form_is == 'long'
+        serializer = PRODUCT_SERIALIZERS[final_form]
+        rank, rowid = product_search.c.rank, product_search.c.rowid
+
+        # Fetching one page of matches, followed by their rank and rowid
+        width = len(serializer.columns())
+        page = KeysetPage.from_request(rank, rowid)
+        stmt = select(*serializer.columns(), rank, rowid).select_from(product_search) \
+            .join(Product, Product.product_id == rowid).where(matches(expression))
+        rows = page.collect(
+            db.session.execute(page.apply(stmt)).all(),
+            lambda row: tuple(row[width:])
+        )
+
+        body = MasonBuilder(products=serializer.serialize(rows, product_controls()))
+        page.add_controls(body)
+        return Response(dumps(body), 200, mimetype=JSON)
+
+
+def serialize_product_detail(product, final_form):
+    """
+    Serializes a product with its lens color options and manufacturer name.
+    The product is expected to come from Product.with_details() so that the
+    relationships are already loaded.
+
+    Parameters:
+        product (Product): The product to serialize.
+        final_form (bool): Whether to include all product attributes.
+
+    Returns:
+        dict: The long-form product document.
+    """
+    item = product.serialize(final_form)
+
+    options = sorted(
+        (product_option.options for product_option in product.product_option
+         if product_option.options is not None),
+        key=lambda option: option.option_id
+    )
+
+    lens_colors = []
+    for option in options:
+        lens_colors.append({
+            "option_id": option.option_id,
+            "option_name": option.name,
+            "option_image": option.image
+        })
+
+    item["options"] = lens_colors
+    item["manufacturer_name"] = product.manufacturer.name if product.manufacturer else None
+    return item
+
+
 class ProductIndividualItem(Resource):
 
+    @cached_response("product:{id}")
+    @conditional_response("product", "manufacturer", "option", last_modified=lambda: db.session.scalar(
+        select(func.max(Product.date_added))))
     def get(self, id):
         form_is = request.args.get('form', 'long')
         final_form = form_is == 'long'
 
-        # Fetching the product from the database using its id
-        product = Product.query.filter_by(product_id=id).first()
+        # Fetching the product together with its options and manufacturer
+        product = Product.with_details().filter_by(product_id=id).one_or_none()
 
         if product is None:
             abort(404, description="Product_item not found")
 
-        item = product.serialize(final_form)
-
-        options = Options.query.join(ProductOption, Options.option_id == ProductOption.option_id).\
-                    filter(ProductOption.product_id == product.product_id).all()
-        
-        lens_colors = []
-        for option in options:
-            lens_colors.append({
-            "option_id": option.option_id,
-            "option_name": option.name,
-            "option_image": option.image
-            })   
-        
-        item["options"] = lens_colors
-
-        manufacturer_item = Manufacturer.query.filter_by(manufacturer_id=product.manufacturer_id).first()
-        item["manufacturer_name"] = manufacturer_item.name
+        item = serialize_product_detail(product, final_form)
         # item.add_control("self", href=url_for(ProductItem, product_id=product.product_id))
         # item.add_control("profile", href=PROFILE_PRODUCT)
         # item.add_control("collection", href=url_for(Products))
@@ -173,22 +269,25 @@ class ProductIndividualItem(Resource):
     def delete(self, id):
         # Fetching the product from the database using its id
         product = Product.query.filter_by(product_id=id).first()
-        print(product)
 
         # If the product is not found, return a 404 Not Found error
         if product is None:
             abort(404, description="Product not found")
-
-        # Fetching the product options related to the product
-        product_options = ProductOption.query.filter_by(product_id=id).all()
-
-        # Deleting the product options from the database
-        for option in product_options:
-            db.session.delete(option)
-
-        # Deleting the product from the database
-        db.session.delete(product)
-        db.session.commit()
+        manufacturer_id = product.manufacturer_id
+
+        # Deleting the product options and the product from the database
+        def delete_product():
+            product = db.session.get(Product, id)
+            if product is None:
+                return False
+            ProductOption.query.filter_by(product_id=id).delete()
+            db.session.delete(product)
+            bump_version("product")
+            return True
+
+        if not run_write(delete_product):
+            abort(404, description="Product not found")
+        invalidate("product", "product:%s" % id, "manufacturer:%s" % manufacturer_id)
 
         # Creating and returning success response
         responseMessage = 'Product Deleted Successfully'
@@ -208,6 +307,7 @@ class ProductIndividualItem(Resource):
         product = Product.query.filter_by(product_id=id).first()
         if not product:
             abort(404, description="Product not found")
+        manufacturer_id = product.manufacturer_id
 
         # Extracting required fields from request JSON data
         name_is = request_data['name_update']
@@ -219,7 +319,10 @@ class ProductIndividualItem(Resource):
         width_is = float(request_data['width_update']) if request_data['width_update'] else 0.0
 
         # Updating the product
-        try:
+        def update_product():
+            product = db.session.get(Product, id)
+            if product is None:
+                return False
             product.name = name_is
             product.description = description_is
             product.sku = sku_is
@@ -227,14 +330,21 @@ class ProductIndividualItem(Resource):
             product.image = image_is
             product.price = price_is
             product.width = width_is
+            bump_version("product")
+            return True
 
-            db.session.commit()
+        try:
+            found = run_write(update_product)
 
         # Handling errors
         except IntegrityError as e:
             abort(409, description=str(e))
         except (KeyError, ValueError, IntegrityError) as e:
             abort(400, description=str(e))
+
+        if not found:
+            abort(404, description="Product not found")
+        invalidate("product", "product:%s" % id, "manufacturer:%s" % manufacturer_id)
         
 
         # Creating and returning success response
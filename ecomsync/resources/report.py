@@ -0,0 +1,55 @@
+"""
+Report module.
+
+This module provides the sales reporting resource.
+"""
+from datetime import date
+
+from flask import Response, request
+from flask_restful import Resource
+from werkzeug.exceptions import BadRequest
+
+from ecomsync.reporting import DIMENSIONS, sales_report
+from ecomsync.serializers import dumps
+from ecomsync.utils import MasonBuilder
+
+# Constants - JSON content type
+JSON = "application/json"
+
+
+def _parse_day(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(description="%s must be a date (YYYY-MM-DD)" % name)
+
+
+class SalesReport(Resource):
+    """Resource for the aggregated sales report."""
+    def get(self):
+        """
+        Returns the number of orders, the revenue and the average order
+        total grouped by the comma separated "group_by" dimensions (day,
+        product, manufacturer, country; default day). date_from is the first
+        and date_to the day after the last day of the report. The report is
+        aggregated from the sales rollups unless source=orders is given.
+        """
+        dimensions = [d for d in request.args.get('group_by', 'day').split(',') if d]
+        unknown = [d for d in dimensions if d not in DIMENSIONS]
+        if unknown or not dimensions:
+            raise BadRequest(description="group_by must be a comma separated list of %s"
+                             % ", ".join(DIMENSIONS))
+        source = request.args.get('source', 'rollup')
+        if source not in ('rollup', 'orders'):
+            raise BadRequest(description="source must be rollup or orders")
+
+        body = MasonBuilder(
+            group_by=dimensions,
+            source=source,
+            sales=sales_report(list(dict.fromkeys(dimensions)), _parse_day('date_from'),
+                               _parse_day('date_to'), from_orders=source == 'orders')
+        )
+        return Response(dumps(body), 200, mimetype=JSON)
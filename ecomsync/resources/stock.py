@@ -0,0 +1,127 @@
+"""
+Stock module.
+
+This module provides the stock reservation resources.
+"""
+from flask import Response, abort, current_app, request, url_for
+from flask_restful import Resource
+from werkzeug.exceptions import BadRequest
+
+from ecomsync import db
+from ecomsync.models import StockReservation
+from ecomsync.serializers import dumps
+from ecomsync.stock import (MAX_RESERVATION_ITEMS, InsufficientStock, ReservationError,
+                            commit_reservation, invalidate_stock, release_reservation, reserve)
+from ecomsync.utils import MasonBuilder, positive_int
+from ecomsync.writes import run_write
+
+# Constants - JSON content type
+JSON = "application/json"
+
+
+def reservation_items():
+    """
+    Reads the SKUs and quantities to reserve from the request body, e.g.
+    ``{"items": [{"sku": "RBX335700000006B", "quantity": 2}], "ttl": 600}``.
+    Quantities of a SKU listed more than once are added up.
+
+    Returns:
+        tuple: (items, ttl) where items maps each SKU to its quantity.
+
+    Raises:
+        BadRequest: If the body is invalid.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("items"), list) \
+            or not data["items"]:
+        raise BadRequest(description="items must be a non-empty list")
+    items = {}
+    for item in data["items"]:
+        if not isinstance(item, dict) or not isinstance(item.get("sku"), str) \
+                or not positive_int(item.get("quantity")):
+            raise BadRequest(description="every item needs a sku and a positive quantity")
+        items[item["sku"]] = items.get(item["sku"], 0) + item["quantity"]
+    if len(items) > MAX_RESERVATION_ITEMS:
+        raise BadRequest(description="At most %d SKUs can be reserved at once"
+                         % MAX_RESERVATION_ITEMS)
+    ttl = data.get("ttl", current_app.config["RESERVATION_TTL"])
+    if not positive_int(ttl):
+        raise BadRequest(description="ttl must be a positive number of seconds")
+    return items, ttl
+
+
+def reservation_response(doc, status=200):
+    """
+    Returns the response holding a serialized reservation with its
+    controls, with a Location header for a new one.
+    """
+    href = url_for("api.ReservationItem", reservation_id=doc["id"])
+    body = MasonBuilder(doc)
+    body.add_control("self", href)
+    body.add_control("commit", url_for("api.ReservationCommit", reservation_id=doc["id"]),
+                     method="POST")
+    body.add_control("release", href, method="DELETE")
+    response = Response(dumps(body), status, mimetype=JSON)
+    if status == 201:
+        response.headers["Location"] = href
+    return response
+
+
+class ReservationCollection(Resource):
+    """Resource for reserving stock."""
+    def post(self):
+        """
+        Reserves the quantities of every item, or none of them if a SKU
+        does not exist or has too little stock (409, listing those SKUs).
+        The reservation expires after ttl seconds unless it is committed.
+        """
+        items, ttl = reservation_items()
+        try:
+            doc = run_write(lambda: reserve(items, ttl))
+        except InsufficientStock as e:
+            body = {"message": str(e), "unavailable": e.skus}
+            return Response(dumps(body), 409, mimetype=JSON)
+        invalidate_stock(item["product_id"] for item in doc["items"])
+        return reservation_response(doc, 201)
+
+
+class ReservationItem(Resource):
+    """Resource for a single stock reservation."""
+    def get(self, reservation_id):
+        reservation = db.session.get(StockReservation, reservation_id)
+        if reservation is None:
+            abort(404, description="Reservation not found")
+        return reservation_response(reservation.serialize())
+
+    def delete(self, reservation_id):
+        """
+        Releases a held or committed reservation and puts its stock back.
+        """
+        try:
+            product_ids = run_write(lambda: release_reservation(reservation_id))
+        except ReservationError as e:
+            abort(409, description=str(e))
+        if product_ids is None:
+            abort(404, description="Reservation not found")
+        invalidate_stock(product_ids)
+        return Response("Reservation Released Successfully", status=200)
+
+
+class ReservationCommit(Resource):
+    """Resource for committing a stock reservation."""
+    def post(self, reservation_id):
+        """
+        Commits a held reservation that has not expired, optionally to the
+        order given as "order_id" in the body.
+        """
+        data = request.get_json(silent=True) or {}
+        order_id = data.get("order_id")
+        if order_id is not None and not positive_int(order_id):
+            raise BadRequest(description="order_id must be an order id")
+        try:
+            doc = run_write(lambda: commit_reservation(reservation_id, order_id))
+        except ReservationError as e:
+            abort(409, description=str(e))
+        if doc is None:
+            abort(404, description="Reservation not found")
+        return reservation_response(doc)
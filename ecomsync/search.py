@@ -0,0 +1,144 @@
+"""
+Search module.
+
+This module provides the full-text product search: an SQLite FTS5 virtual
+table indexing the name, description and SKU of every product together
+with its manufacturer's name, the triggers keeping it in sync with the
+product and manufacturer tables, and helpers to query it.
+"""
+import re
+
+from sqlalchemy import DDL, event, literal_column, table, column, text
+
+from ecomsync import db
+
+SEARCH_TABLE = "product_search"
+
+# The index stores its own copy of the text so rows can be deleted without
+# looking up the old values. Prefix indexes make "term*" queries on the
+# first characters of a word as cheap as whole-word queries.
+_CREATE_STATEMENTS = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS product_search USING fts5(
+        name, description, sku, manufacturer,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_search_insert AFTER INSERT ON product BEGIN
+        INSERT INTO product_search (rowid, name, description, sku, manufacturer)
+        VALUES (new.product_id, new.name, new.description, new.sku,
+                (SELECT name FROM manufacturer
+                 WHERE manufacturer_id = new.manufacturer_id));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_search_update
+    AFTER UPDATE OF product_id, name, description, sku, manufacturer_id ON product BEGIN
+        DELETE FROM product_search WHERE rowid = old.product_id;
+        INSERT INTO product_search (rowid, name, description, sku, manufacturer)
+        VALUES (new.product_id, new.name, new.description, new.sku,
+                (SELECT name FROM manufacturer
+                 WHERE manufacturer_id = new.manufacturer_id));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_search_delete AFTER DELETE ON product BEGIN
+        DELETE FROM product_search WHERE rowid = old.product_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_search_manufacturer_insert
+    AFTER INSERT ON manufacturer BEGIN
+        UPDATE product_search SET manufacturer = new.name
+        WHERE rowid IN (SELECT product_id FROM product
+                        WHERE manufacturer_id = new.manufacturer_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_search_manufacturer_update
+    AFTER UPDATE OF name ON manufacturer BEGIN
+        UPDATE product_search SET manufacturer = new.name
+        WHERE rowid IN (SELECT product_id FROM product
+                        WHERE manufacturer_id = new.manufacturer_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_search_manufacturer_delete
+    AFTER DELETE ON manufacturer BEGIN
+        UPDATE product_search SET manufacturer = NULL
+        WHERE rowid IN (SELECT product_id FROM product
+                        WHERE manufacturer_id = old.manufacturer_id);
+    END
+    """,
+]
+
+# Created together with the model tables by db.create_all(), so the
+# database built by "flask init-db" and the test databases have it.
+for _statement in _CREATE_STATEMENTS:
+    event.listen(db.metadata, "after_create", DDL(_statement).execute_if(dialect="sqlite"))
+
+product_search = table(
+    SEARCH_TABLE,
+    column("rowid"), column("rank"),
+    column("name"), column("description"), column("sku"), column("manufacturer"),
+)
+
+
+def rebuild_search_index(connection=None):
+    """
+    Creates the search table and its triggers if they are missing and
+    refills the table from the product and manufacturer tables, e.g. for a
+    database created before full-text search existed.
+
+    Parameters:
+        connection (Connection): Optional connection whose transaction the
+        rebuild is part of. By default it runs in a transaction of its own.
+
+    Returns:
+        int: The number of indexed products.
+    """
+    if connection is None:
+        with db.engine.begin() as connection:
+            return rebuild_search_index(connection)
+    for statement in _CREATE_STATEMENTS:
+        connection.execute(text(statement))
+    connection.execute(text("DELETE FROM product_search"))
+    connection.execute(text("""
+        INSERT INTO product_search (rowid, name, description, sku, manufacturer)
+        SELECT product.product_id, product.name, product.description, product.sku,
+               manufacturer.name
+        FROM product LEFT JOIN manufacturer
+            ON manufacturer.manufacturer_id = product.manufacturer_id
+    """))
+    return connection.execute(text("SELECT count(*) FROM product_search")).scalar()
+
+
+def match_expression(query):
+    """
+    Converts free text typed by a user into an FTS5 query matching the
+    products that contain every word, the last one as a prefix so results
+    show up while the user is still typing. Words are quoted, so FTS5
+    operators and punctuation in the input are treated as plain text.
+
+    Parameters:
+        query (str): The search text.
+
+    Returns:
+        str: The FTS5 query, or None if the text has no words.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    terms = ['"%s"' % word for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def matches(query):
+    """
+    Returns the WHERE clause selecting the rows of product_search that
+    match an FTS5 query built by match_expression().
+    """
+    return literal_column(SEARCH_TABLE).op("MATCH")(query)
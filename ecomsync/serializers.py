@@ -0,0 +1,175 @@
+"""
+Serializers module.
+
+This module provides the row serializers used by the collection resources.
+A serializer turns rows (tuples of column values) into response documents
+with plain dict construction, and fills control hrefs from templates built
+once per request instead of calling url_for for every row. JSON encoding
+uses orjson when it is installed.
+"""
+import json
+from operator import attrgetter
+
+from flask import url_for
+
+from ecomsync.models import Manufacturer, Options, Order, Product
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Encodes a document as JSON, with orjson when available.
+
+    Returns:
+        bytes: The encoded document.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+class HrefTemplate:
+    """
+    URL template for an endpoint with one variable part. url_for is called
+    once with a sentinel value; afterwards URLs are built by concatenation.
+    """
+
+    SENTINEL = 987654321
+
+    def __init__(self, endpoint, param, **values):
+        values[param] = self.SENTINEL
+        self.prefix, _, self.suffix = url_for(endpoint, **values).partition(str(self.SENTINEL))
+
+    def __call__(self, value):
+        return self.prefix + str(value) + self.suffix
+
+
+class RowSerializer:
+    """
+    Serializes rows of a fixed column layout into documents.
+
+    Parameters:
+        model (Model): The model the columns belong to.
+        fields (list): (key, attribute) pairs of the document fields, in
+        order. The columns of a row follow the same order.
+        hidden (list): Attributes appended to each row that are needed for
+        controls or pagination but are not part of the document.
+        converters (dict): Functions applied to the values of some keys.
+    """
+
+    def __init__(self, model, fields, hidden=(), converters=None):
+        self.model = model
+        self.keys = tuple(key for key, _ in fields)
+        self.attrs = tuple(attr for _, attr in fields) + tuple(hidden)
+        self.converters = tuple((converters or {}).items())
+        getter = attrgetter(*self.attrs)
+        self._getter = getter if len(self.attrs) > 1 else lambda obj: (getter(obj),)
+
+    def index(self, attr):
+        """
+        Returns the position of an attribute in the rows.
+        """
+        return self.attrs.index(attr)
+
+    def columns(self):
+        """
+        Returns the model columns to select to get rows in this layout.
+        """
+        return [getattr(self.model, attr) for attr in self.attrs]
+
+    def rows(self, entities):
+        """
+        Converts model instances into rows in this layout.
+        """
+        getter = self._getter
+        return [getter(entity) for entity in entities]
+
+    def serialize(self, rows, controls=None):
+        """
+        Builds the documents of the rows.
+
+        Parameters:
+            rows (iterable): Rows in this serializer's layout.
+            controls (callable): Optional function returning the @controls
+            object of a row.
+
+        Returns:
+            list: The documents.
+        """
+        keys = self.keys
+        converters = self.converters
+        docs = []
+        for row in rows:
+            doc = dict(zip(keys, row))
+            for key, convert in converters:
+                doc[key] = convert(doc[key])
+            if controls is not None:
+                doc["@controls"] = controls(row)
+            docs.append(doc)
+        return docs
+
+
+PRODUCT_FIELDS = [("id", "product_id"), ("name", "name")]
+PRODUCT_DETAIL_FIELDS = PRODUCT_FIELDS + [
+    ("description", "description"), ("manufacturer_id", "manufacturer_id"),
+    ("sku", "sku"), ("quantity", "quantity"), ("image", "image"),
+    ("price", "price"), ("width", "width"), ("date_added", "date_added"),
+]
+
+ORDER_FIELDS = [("firstname", "firstname"), ("email", "email")]
+ORDER_DETAIL_FIELDS = ORDER_FIELDS + [
+    ("telephone", "telephone"), ("payment_address_1", "payment_address_1"),
+    ("payment_city", "payment_city"), ("payment_postcode", "payment_postcode"),
+    ("payment_country", "payment_country"), ("total", "total"),
+    ("date_added", "date_added"),
+]
+
+MANUFACTURER_FIELDS = [("name", "name")]
+MANUFACTURER_DETAIL_FIELDS = MANUFACTURER_FIELDS + [("description", "description")]
+
+# Serializers reproducing Model.serialize(), keyed by its short_form
+# argument. Note that Product.serialize includes every field when
+# short_form is True.
+PRODUCT_SERIALIZERS = {
+    False: RowSerializer(Product, PRODUCT_FIELDS),
+    True: RowSerializer(Product, PRODUCT_DETAIL_FIELDS, converters={"date_added": str}),
+}
+ORDER_SERIALIZERS = {
+    True: RowSerializer(Order, ORDER_FIELDS, hidden=["order_id"]),
+    False: RowSerializer(Order, ORDER_DETAIL_FIELDS, hidden=["order_id"],
+                         converters={"date_added": str}),
+}
+MANUFACTURER_SERIALIZERS = {
+    True: RowSerializer(Manufacturer, MANUFACTURER_FIELDS, hidden=["manufacturer_id"]),
+    False: RowSerializer(Manufacturer, MANUFACTURER_DETAIL_FIELDS, hidden=["manufacturer_id"]),
+}
+OPTION_SERIALIZER = RowSerializer(
+    Options, [("id", "option_id"), ("name", "name"), ("image", "image")])
+
+
+def product_controls():
+    """
+    Returns a function building the @controls of a product row, as added
+    by ProductItem.get.
+    """
+    href = HrefTemplate("api.ProductIndividualItem", "id")
+    return lambda row: {"self": {"href": href(row[0])}}
+
+
+def manufacturer_controls():
+    """
+    Returns a function building the @controls of a manufacturer row, as
+    added by ManufacturerBuilder.add_control_view_product.
+    """
+    href = HrefTemplate("api.ManufacturerItem", "mid")
+    schema = Manufacturer.json_schema()
+    return lambda row: {"storage:manufacturer": {
+        "method": "GET",
+        "title": "View a manufacturer",
+        "schema": schema,
+        "href": href(row[-1]),
+    }}
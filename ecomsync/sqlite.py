@@ -0,0 +1,81 @@
+"""
+SQLite module.
+
+This module applies the SQLite performance profile: PRAGMAs set on every
+new connection through a SQLAlchemy engine event, and the connection pool
+configuration for file-backed databases.
+"""
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from ecomsync import db
+
+# Default performance profile. WAL lets readers run while a writer holds the
+# database, synchronous=NORMAL only fsyncs at checkpoints instead of on every
+# commit (the last commits can be lost on power failure, but the database
+# cannot be corrupted), and busy_timeout makes writers wait for the lock
+# instead of failing immediately.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+}
+
+DEFAULT_POOL = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+}
+
+
+def _is_file_database(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:")
+
+
+def configure_engine(app):
+    """
+    Adds the pool settings to SQLALCHEMY_ENGINE_OPTIONS for file-backed
+    SQLite databases. Must be called before db.init_app(). Options already
+    present in the configuration are kept.
+
+    Parameters:
+        app (Flask): The application.
+    """
+    if not _is_file_database(app.config["SQLALCHEMY_DATABASE_URI"]):
+        return
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    for name, value in app.config["SQLITE_POOL"].items():
+        options.setdefault(name, value)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+def apply_pragmas(app):
+    """
+    Registers an engine event that runs the SQLITE_PRAGMAS of the
+    application on every new connection of each SQLite engine (the main
+    database and the binds). Must be called after db.init_app().
+
+    Parameters:
+        app (Flask): The application.
+    """
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    with app.app_context():
+        engines = list(db.engines.values())
+    if not pragmas:
+        return
+
+    statements = ["PRAGMA %s=%s" % (name, value) for name, value in pragmas.items()]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+    for engine in engines:
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "connect", set_pragmas)
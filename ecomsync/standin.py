@@ -0,0 +1,398 @@
+"""
+Stand-in module.
+
+This module provides local stand-ins for the systems ecomsync exchanges
+orders with: a marketplace order API with the connector pulling from it,
+so the connector framework (see ecomsync.connectors) can be run, tested
+and benchmarked without seller accounts on a real marketplace, and a mock
+WooCommerce and OpenCart store receiving the order push (see
+ecomsync.push).
+
+The stand-in marketplace serves GET /sellers/<seller>/orders?after=<cursor>&limit=<n>
+with pages of orders shaped like a typical marketplace API: nested buyer
+and billing address, the total as an amount string with a currency and
+UTC timestamps. The orders of a seller are generated deterministically
+from the seller and the seed, and every seller is limited to rate
+requests per second, answering 429 Too Many Requests with a Retry-After
+header beyond that, like the real marketplaces do.
+"""
+import base64
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import click
+
+from ecomsync.connectors import MarketplaceConnector, MarketplaceError, OrderPage, RateLimited
+from ecomsync.datagen import CITIES, FIRST_NAMES, LAST_NAMES, STREETS
+from ecomsync.serializers import dumps
+
+MAX_PAGE_SIZE = 500
+
+_ORDERS_PATH = re.compile(r"^/sellers/([^/]+)/orders$")
+
+_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class StandInMarketplace:
+    """
+    State and request handling of the stand-in marketplace; serve() serves
+    it over HTTP.
+
+    Parameters:
+        orders (int): Number of orders of every seller.
+        latency (float): Seconds every response is delayed by, like the
+        round trip to a remote API.
+        rate (float): Requests per second allowed per seller, or None for
+        no limit.
+        seed (int): Seed of the generated orders.
+    """
+
+    def __init__(self, orders=1000, latency=0.0, rate=None, seed=0):
+        self.orders = orders
+        self.latency = latency
+        self.rate = rate
+        self.seed = seed
+        self.requests = 0
+        self.rejected = 0
+        self._allowed = {}
+        self._lock = threading.Lock()
+
+    def order(self, seller, number):
+        """
+        Returns order number of a seller, the same every time.
+        """
+        rng = random.Random("%s:%s:%d" % (self.seed, seller, number))
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        city, postcode, country, _ = rng.choice(CITIES)
+        return {
+            "id": "%s-%08d" % (seller, number),
+            "buyer": {
+                "first_name": first_name,
+                "last_name": last_name,
+                "email": "%s.%s%d@example.com" % (first_name.lower(), last_name.lower(), number),
+                "phone": "0%09d" % rng.randrange(10 ** 9),
+            },
+            "billing_address": {
+                "line1": "%s %d" % (rng.choice(STREETS), rng.randint(1, 199)),
+                "city": city,
+                "postal_code": "%s%02d" % (postcode, rng.randrange(100)),
+                "country": country,
+            },
+            "total": {"amount": "%.2f" % rng.uniform(5, 500), "currency": "EUR"},
+            "created_at": (_START + timedelta(minutes=number)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+
+    def _retry_after(self, seller):
+        """
+        Returns 0 if the request of seller is allowed, else the seconds
+        until it would be.
+        """
+        if self.rate is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            allowed = max(self._allowed.get(seller, now), now)
+            if allowed - now >= 1 / self.rate:
+                return allowed - now
+            self._allowed[seller] = allowed + 1 / self.rate
+            return 0
+
+    def handle(self, method, target, headers=None, body=b""):
+        """
+        Answers a request.
+
+        Returns:
+            tuple: (status, headers, body) of the response.
+        """
+        parts = urlsplit(target)
+        match = _ORDERS_PATH.match(parts.path)
+        if match is None:
+            return 404, {}, dumps({"error": "not found"})
+        if method != "GET":
+            return 405, {"Allow": "GET"}, dumps({"error": "method not allowed"})
+        seller = unquote(match.group(1))
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        retry_after = self._retry_after(seller)
+        if retry_after:
+            with self._lock:
+                self.rejected += 1
+            return 429, {"Retry-After": "%.3f" % retry_after}, dumps(
+                {"error": "rate limit exceeded"})
+        args = parse_qs(parts.query)
+        try:
+            after = int(args.get("after", ["0"])[0])
+            limit = min(int(args.get("limit", ["100"])[0]), MAX_PAGE_SIZE)
+        except ValueError:
+            return 400, {}, dumps({"error": "invalid after or limit"})
+        end = min(after + limit, self.orders)
+        return 200, {}, dumps({
+            "orders": [self.order(seller, number) for number in range(after, end)],
+            "next": str(max(end, after)),
+            "has_more": end < self.orders,
+        })
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Every response has a Content-Length, so connections are kept alive
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; with Nagle's algorithm the
+    # body would wait for the delayed ACK of the headers
+    disable_nagle_algorithm = True
+
+    def _respond(self):
+        request_body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        status, headers, body = self.server.stand_in.handle(
+            self.command, self.path, self.headers, request_body)
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops the connections a scheduler opens at
+    # once, and each dropped one waits a second for the SYN retransmit
+    request_queue_size = 128
+
+
+def make_server(stand_in, host="127.0.0.1", port=0):
+    """
+    Creates the HTTP server of a StandInMarketplace or MockStore, answering
+    with a thread per connection and keeping connections alive. Port 0
+    picks a free port; the port taken is server.server_port.
+    """
+    server = _Server((host, port), _Handler)
+    server.stand_in = stand_in
+    return server
+
+
+def serve(stand_in, host="127.0.0.1", port=0):
+    """
+    Serves a StandInMarketplace or MockStore on a daemon thread.
+
+    Returns:
+        ThreadingHTTPServer: The server; server.shutdown() stops it.
+    """
+    server = make_server(stand_in, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StandInConnector(MarketplaceConnector):
+    """
+    Connector of the stand-in marketplace. Account settings: "base_url",
+    "seller" (default the account name) and "page_size" (default 100).
+    """
+
+    async def fetch_page(self, http, cursor):
+        url = "%s/sellers/%s/orders?limit=%d" % (
+            self.account["base_url"].rstrip("/"), quote(self.account.get("seller", self.name)),
+            self.account.get("page_size", 100))
+        if cursor is not None:
+            url += "&after=" + quote(cursor)
+        response = await http.request("GET", url, {"Accept": "application/json"})
+        if response.status == 429:
+            raise RateLimited(float(response.headers.get("retry-after", 1)))
+        if response.status != 200:
+            raise MarketplaceError("GET %s answered %d" % (url, response.status))
+        data = response.json()
+        return OrderPage([self.order_row(order) for order in data["orders"]],
+                         data["next"], data["has_more"])
+
+    @staticmethod
+    def order_row(order):
+        """
+        Maps an order of the stand-in marketplace to a row of the order
+        import. Malformed orders are mapped as far as possible and left to
+        the validation to reject.
+        """
+        buyer = order.get("buyer") or {}
+        address = order.get("billing_address") or {}
+        row = {
+            "firstname": buyer.get("first_name"),
+            "lastname": buyer.get("last_name"),
+            "email": buyer.get("email"),
+            "telephone": buyer.get("phone"),
+            "product_id": None,
+            "payment_address_1": address.get("line1"),
+            "payment_city": address.get("city"),
+            "payment_postcode": address.get("postal_code"),
+            "payment_country": address.get("country"),
+            "date_added": order.get("created_at"),
+        }
+        try:
+            row["total"] = float((order.get("total") or {})["amount"])
+        except (KeyError, TypeError, ValueError):
+            row["total"] = None
+        # validate_order_rows() stores the timestamp in naive UTC
+        return row
+
+
+class MockStore:
+    """
+    Mock WooCommerce and OpenCart store receiving the order push (see
+    ecomsync.push). It answers
+
+    - POST /wp-json/wc/v3/orders/batch (WooCommerce, Basic authentication
+      with consumer_key and consumer_secret, at most 100 orders),
+    - POST /wp-json/wc/v3/orders (WooCommerce, a single order),
+    - POST /index.php?route=api/sale/order.bulk&api_token=<api_token>
+      (OpenCart API extension),
+
+    and keeps the orders it accepted in woocommerce and opencart. Orders
+    without an e-mail address are rejected one by one, like the stores'
+    validation does. The first failures requests are answered with 503
+    Service Unavailable, to exercise retries.
+    """
+
+    def __init__(self, latency=0.0, failures=0, consumer_key="ck_test",
+                 consumer_secret="cs_test", api_token="test"):
+        self.latency = latency
+        self.failures = failures
+        self.authorization = "Basic " + base64.b64encode(
+            ("%s:%s" % (consumer_key, consumer_secret)).encode()).decode()
+        self.api_token = api_token
+        self.woocommerce = []
+        self.opencart = []
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def handle(self, method, target, headers=None, body=b""):
+        """
+        Answers a request.
+
+        Returns:
+            tuple: (status, headers, body) of the response.
+        """
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            failing = self.requests <= self.failures
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if failing:
+                return 503, {}, dumps({"error": "service unavailable"})
+            return self._answer(method, target, headers or {}, body)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _answer(self, method, target, headers, body):
+        parts = urlsplit(target)
+        if method != "POST":
+            return 405, {"Allow": "POST"}, dumps({"error": "method not allowed"})
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, {}, dumps({"error": "invalid JSON"})
+
+        if parts.path.startswith("/wp-json/wc/v3/orders"):
+            if headers.get("Authorization") != self.authorization:
+                return 401, {}, dumps({"code": "woocommerce_rest_cannot_create"})
+            if parts.path == "/wp-json/wc/v3/orders":
+                result = self._woocommerce_order(data)
+                return (400 if "error" in result else 201), {}, dumps(result)
+            if parts.path != "/wp-json/wc/v3/orders/batch":
+                return 404, {}, dumps({"code": "rest_no_route"})
+            if len(data.get("create", [])) > 100:
+                return 400, {}, dumps({"code": "rest_batch_too_large"})
+            return 200, {}, dumps({"create": [self._woocommerce_order(doc)
+                                              for doc in data.get("create", [])]})
+
+        args = parse_qs(parts.query)
+        if parts.path != "/index.php" or args.get("route") != ["api/sale/order.bulk"]:
+            return 404, {}, dumps({"error": "not found"})
+        if args.get("api_token") != [self.api_token]:
+            return 401, {}, dumps({"error": "Warning: You do not have permission"})
+        created, errors = [], {}
+        for index, doc in enumerate(data.get("orders", [])):
+            if not doc.get("email"):
+                errors[str(index)] = "E-Mail Address does not appear to be valid!"
+                continue
+            with self._lock:
+                self.opencart.append(doc)
+                created.append({"order_id": len(self.opencart)})
+        return 200, {}, dumps({"orders": created, "error": errors})
+
+    def _woocommerce_order(self, doc):
+        if not (doc.get("billing") or {}).get("email"):
+            return {"id": 0, "error": {"code": "woocommerce_rest_invalid_email",
+                                       "message": "Invalid billing email address."}}
+        with self._lock:
+            self.woocommerce.append(doc)
+            return {"id": len(self.woocommerce), "status": doc.get("status", "pending")}
+
+
+@click.command("standin-marketplace")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", type=int, default=8081, show_default=True)
+@click.option("--orders", type=int, default=1000, show_default=True,
+              help="Orders of every seller.")
+@click.option("--latency", type=float, default=0.0, show_default=True,
+              help="Seconds every response is delayed by.")
+@click.option("--rate", type=float, default=None,
+              help="Requests per second allowed per seller (default unlimited).")
+@click.option("--seed", type=int, default=0, show_default=True)
+def standin_marketplace_command(host, port, orders, latency, rate, seed):
+    """
+    Command to serve the stand-in marketplace until interrupted.
+
+    Usage:
+        flask standin-marketplace --port 8081 --latency 0.02 --rate 10
+    """
+    server = make_server(StandInMarketplace(orders, latency, rate, seed), host, port)
+    print("Serving the stand-in marketplace on http://%s:%d" % (host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+@click.command("standin-store")
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", type=int, default=8082, show_default=True)
+@click.option("--latency", type=float, default=0.0, show_default=True,
+              help="Seconds every response is delayed by.")
+def standin_store_command(host, port, latency):
+    """
+    Command to serve the mock WooCommerce and OpenCart store until
+    interrupted, with consumer key "ck_test", secret "cs_test" and API
+    token "test".
+
+    Usage:
+        flask standin-store --port 8082 --latency 0.02
+    """
+    server = make_server(MockStore(latency), host, port)
+    print("Serving the mock store on http://%s:%d" % (host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,334 @@
+"""
+Stock module.
+
+This module provides stock reservations. Every change to the stock is a
+single conditional UPDATE: reserving takes the quantities of all the SKUs
+of a reservation out of Product.quantity with one statement that only
+matches the products that still have enough stock, and releasing or
+expiring a reservation first moves it out of the "held" or "committed"
+status with a conditional UPDATE, so its stock is given back exactly once.
+Nothing is read first and written later, so concurrent reservations can
+never sell more than the stock.
+
+Reserving, committing and releasing run for every order, so their
+statements are sent to the driver as SQL text, which costs about a third
+of the Python time of the equivalent SQLAlchemy statements.
+
+The functions make their changes through db.session without committing,
+so they are meant to run inside run_write() (see ecomsync.writes).
+"""
+import threading
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, update
+from sqlalchemy.exc import OperationalError
+
+from ecomsync import db
+from ecomsync.caching import bump_version, invalidate
+from ecomsync.models import StockReservation
+from ecomsync.utils import sql_timestamp
+from ecomsync.writes import run_write
+
+# Most SKUs in one reservation
+MAX_RESERVATION_ITEMS = 100
+
+# Reservations expired per transaction by the sweeper
+SWEEP_BATCH_SIZE = 1000
+
+# Subtracts the wanted quantity of every SKU that has enough stock; the
+# CASE expression "CASE sku WHEN ? THEN ? ... END" maps a SKU to its quantity.
+_RESERVE = """
+    UPDATE product SET quantity = quantity - {wanted}
+    WHERE sku IN ({skus}) AND quantity >= {wanted}
+    RETURNING product_id, sku
+"""
+_INSERT_RESERVATION = """
+    INSERT INTO stock_reservation (status, created_at, expires_at) VALUES ('held', ?, ?)
+    RETURNING reservation_id
+"""
+_INSERT_LINE = """
+    INSERT INTO stock_reservation_line (reservation_id, product_id, sku, quantity)
+    VALUES (?, ?, ?, ?)
+"""
+_COMMIT = """
+    UPDATE stock_reservation SET status = 'committed', order_id = ?
+    WHERE reservation_id = ? AND status = 'held' AND expires_at > ?
+    RETURNING created_at, expires_at
+"""
+_RELEASE = """
+    UPDATE stock_reservation SET status = 'released'
+    WHERE reservation_id = ? AND status IN ('held', 'committed')
+"""
+_LINES = """
+    SELECT sku, product_id, quantity FROM stock_reservation_line
+    WHERE reservation_id = ? ORDER BY sku
+"""
+_RESERVED = """
+    SELECT product_id, sum(quantity) FROM stock_reservation_line
+    WHERE reservation_id IN ({ids}) GROUP BY product_id
+"""
+_RESTORE = "UPDATE product SET quantity = quantity + ? WHERE product_id = ?"
+
+
+def _document(reservation_id, status, order_id, created_at, expires_at, lines):
+    """
+    Returns the same document as StockReservation.serialize() for a
+    reservation and its (sku, product_id, quantity) lines.
+    """
+    return {
+        "id": reservation_id,
+        "status": status,
+        "order_id": order_id,
+        "created_at": str(created_at),
+        "expires_at": str(expires_at),
+        "items": [{"sku": sku, "product_id": product_id, "quantity": quantity}
+                  for sku, product_id, quantity in lines],
+    }
+
+
+class ReservationError(Exception):
+    """
+    Raised when a reservation cannot be made, committed or released.
+    """
+
+
+class InsufficientStock(ReservationError):
+    """
+    Raised when some of the SKUs of a reservation do not exist or do not
+    have enough stock. Nothing is reserved then.
+
+    Attributes:
+        skus (list): The SKUs that could not be reserved.
+    """
+
+    def __init__(self, skus):
+        super().__init__("Insufficient stock for %s" % ", ".join(skus))
+        self.skus = skus
+
+
+def reserve(items, ttl, now=None):
+    """
+    Reserves the given quantities of several SKUs, all or nothing.
+
+    Parameters:
+        items (dict): Maps each SKU to the positive quantity to reserve.
+        ttl (int): Seconds until the reservation expires if it is not
+        committed.
+        now (datetime): The current time, by default datetime.utcnow().
+
+    Returns:
+        dict: The serialized reservation.
+
+    Raises:
+        InsufficientStock: If a SKU does not exist or has too little
+        stock. The caller must roll back, which run_write() does.
+    """
+    now = now or datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+    connection = db.session.connection()
+    skus = list(items)
+    wanted = [value for sku in skus for value in (sku, items[sku])]
+    statement = _RESERVE.format(
+        wanted="CASE sku %s END" % " ".join(["WHEN ? THEN ?"] * len(skus)),
+        skus=", ".join(["?"] * len(skus)))
+    reserved = connection.exec_driver_sql(statement, tuple(wanted + skus + wanted)).all()
+    if len(reserved) < len(items):
+        raise InsufficientStock(sorted(set(items) - {sku for _, sku in reserved}))
+
+    reservation_id = connection.exec_driver_sql(
+        _INSERT_RESERVATION, (sql_timestamp(now), sql_timestamp(expires_at))).scalar_one()
+    lines = sorted((sku, product_id, items[sku]) for product_id, sku in reserved)
+    connection.exec_driver_sql(_INSERT_LINE, [
+        (reservation_id, product_id, sku, quantity) for sku, product_id, quantity in lines])
+    bump_version("product")
+    return _document(reservation_id, "held", None, now, expires_at, lines)
+
+
+def _restore(reservation_ids):
+    """
+    Gives the stock of the given reservations back to their products with
+    one UPDATE per product.
+
+    Returns:
+        list: The ids of the products whose stock changed.
+    """
+    connection = db.session.connection()
+    reserved = connection.exec_driver_sql(
+        _RESERVED.format(ids=", ".join(["?"] * len(reservation_ids))),
+        tuple(reservation_ids)).all()
+    if reserved:
+        connection.exec_driver_sql(_RESTORE, [
+            (quantity, product_id) for product_id, quantity in reserved])
+        bump_version("product")
+    return [product_id for product_id, _ in reserved]
+
+
+def _status_error(reservation_id, action):
+    """
+    Returns None if the reservation does not exist, or raises the
+    ReservationError explaining why it cannot be changed: it has expired
+    while still held, or it is no longer held.
+    """
+    status = db.session.scalar(select(StockReservation.status)
+                               .where(StockReservation.reservation_id == reservation_id))
+    if status is None:
+        return None
+    if status == "held":
+        raise ReservationError("Reservation %s has expired" % reservation_id)
+    raise ReservationError("Reservation %s is %s and cannot be %s"
+                           % (reservation_id, status, action))
+
+
+def commit_reservation(reservation_id, order_id=None, now=None):
+    """
+    Marks a held reservation that has not expired yet as committed, i.e.
+    its stock as sold, optionally to the given order.
+
+    Returns:
+        dict: The serialized reservation, or None if it does not exist.
+
+    Raises:
+        ReservationError: If the reservation is not held or has expired.
+    """
+    now = now or datetime.utcnow()
+    connection = db.session.connection()
+    committed = connection.exec_driver_sql(
+        _COMMIT, (order_id, reservation_id, sql_timestamp(now))).first()
+    if committed is None:
+        return _status_error(reservation_id, "committed")
+    created_at, expires_at = map(datetime.fromisoformat, committed)
+    lines = connection.exec_driver_sql(_LINES, (reservation_id,)).all()
+    return _document(reservation_id, "committed", order_id, created_at, expires_at, lines)
+
+
+def release_reservation(reservation_id):
+    """
+    Releases a held or committed reservation and gives its stock back.
+
+    Returns:
+        list: The ids of the products whose stock changed, or None if the
+        reservation does not exist.
+
+    Raises:
+        ReservationError: If the reservation has already been released or
+        has expired.
+    """
+    released = db.session.connection().exec_driver_sql(_RELEASE, (reservation_id,)).rowcount
+    if not released:
+        return _status_error(reservation_id, "released")
+    return _restore([reservation_id])
+
+
+def expire_reservations(now=None, limit=SWEEP_BATCH_SIZE):
+    """
+    Expires up to limit held reservations whose expires_at has passed and
+    gives their stock back.
+
+    Returns:
+        tuple: (expired, product_ids) with the number of expired
+        reservations and the ids of the products whose stock changed.
+    """
+    now = now or datetime.utcnow()
+    due = select(StockReservation.reservation_id).where(
+        StockReservation.status == "held", StockReservation.expires_at <= now
+    ).order_by(StockReservation.expires_at).limit(limit)
+    expired = db.session.scalars(
+        update(StockReservation)
+        .where(StockReservation.reservation_id.in_(due), StockReservation.status == "held")
+        .values(status="expired")
+        .returning(StockReservation.reservation_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if not expired:
+        return 0, []
+    return len(expired), _restore(expired)
+
+
+def invalidate_stock(product_ids):
+    """
+    Invalidates the cached product responses showing the stock of the given
+    products. Should be called after the change has been committed.
+    """
+    invalidate("product", *["product:%s" % product_id for product_id in product_ids])
+
+
+def sweep_expired():
+    """
+    Expires every overdue reservation, SWEEP_BATCH_SIZE per transaction.
+    Must be called inside an application context.
+
+    Returns:
+        int: The number of expired reservations.
+    """
+    total = 0
+    while True:
+        expired, product_ids = run_write(expire_reservations)
+        invalidate_stock(product_ids)
+        total += expired
+        if expired < SWEEP_BATCH_SIZE:
+            return total
+
+
+class ReservationSweeper:
+    """
+    Thread expiring the overdue reservations of an application every
+    interval seconds.
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        with self.app.app_context():
+            while not self._stop.wait(self.interval):
+                try:
+                    sweep_expired()
+                except OperationalError:
+                    # e.g. "database is locked", or no tables before "flask init-db"
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    def start(self):
+        """
+        Starts the sweeper thread.
+        """
+        self._thread = threading.Thread(target=self._run, name="reservation-sweeper",
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the sweeper thread.
+        """
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+@click.command("sweep-reservations")
+@click.option("--interval", type=float, default=0, show_default=True,
+              help="Seconds between sweeps; 0 sweeps once and exits.")
+@with_appcontext
+def sweep_reservations_command(interval):
+    """
+    Command to expire the overdue stock reservations, once or until
+    interrupted.
+
+    Usage:
+        flask sweep-reservations --interval 30
+    """
+    print("Expired %d reservations" % sweep_expired())
+    if interval:
+        sweeper = ReservationSweeper(current_app._get_current_object(), interval)
+        sweeper.start()
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            sweeper.stop()
@@ -1,12 +1,18 @@
 """
 Util module.
 """
+import base64
 import json
-import secrets
-from flask import Response, request, url_for
-from werkzeug.exceptions import Forbidden, NotFound
+import threading
+import time
+from datetime import datetime, timezone
+from flask import Response, current_app, request, url_for
+from sqlalchemy import DateTime, select, tuple_
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
 from werkzeug.routing import BaseConverter
 
+from ecomsync import db
+from ecomsync.constants import MAX_PAGE_SIZE, MEASUREMENT_PAGE_SIZE
 from ecomsync.models import Manufacturer, Product, ApiKey
 
 class MasonBuilder(dict):
@@ -175,6 +181,196 @@ class ManufacturerBuilder(MasonBuilder):
             schema=Manufacturer.json_schema()
         )
 
+def encode_cursor(values, direction):
+    """
+    Encodes a keyset position into an opaque cursor string.
+
+    Parameters:
+        values (list): The key column values of the boundary row.
+        direction (str): "next" to continue after the row, "prev" to
+        continue before it.
+
+    Returns:
+        str: URL-safe cursor token.
+    """
+    raw = json.dumps({"k": list(values), "d": direction}, separators=(",", ":"),
+                     default=lambda value: value.isoformat())
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(token):
+    """
+    Decodes a cursor produced by encode_cursor.
+
+    Parameters:
+        token (str): The cursor token from the query string.
+
+    Returns:
+        tuple: (values, direction)
+
+    Raises:
+        BadRequest: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        data = json.loads(raw)
+        values, direction = data["k"], data["d"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise BadRequest(description="Invalid cursor") from e
+    if direction not in ("next", "prev") or not isinstance(values, list):
+        raise BadRequest(description="Invalid cursor")
+    return values, direction
+
+def positive_int(value):
+    """
+    Returns whether a value parsed from a JSON body is a positive integer;
+    booleans, floats and strings are not.
+    """
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def sql_timestamp(value):
+    """
+    Formats a datetime the way SQLAlchemy stores DateTime columns on
+    SQLite, for statements that bypass the ORM.
+    """
+    return value.isoformat(" ", "microseconds")
+
+def naive_utc(value):
+    """
+    Converts a datetime with a UTC offset into the naive UTC datetime that
+    DateTime columns store; naive datetimes are taken as UTC already.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+class KeysetPage:
+    """
+    Keyset (cursor) pagination over one or more ordered key columns.
+
+    Rows are located with an indexed range predicate on the key columns
+    instead of OFFSET, so every page costs the same regardless of how deep
+    into the collection it is. Cursors are opaque tokens produced by
+    encode_cursor. With descending=True the collection is ordered by the
+    key columns in descending order instead.
+    """
+
+    def __init__(self, key_columns, cursor=None, limit=MEASUREMENT_PAGE_SIZE, descending=False):
+        self.key_columns = list(key_columns)
+        self.limit = limit
+        self.descending = descending
+        self.values, self.direction = (None, "next")
+        if cursor:
+            self.values, self.direction = decode_cursor(cursor)
+            if len(self.values) != len(self.key_columns):
+                raise BadRequest(description="Invalid cursor")
+            self.values = [
+                self._coerce(column, value) for column, value in zip(self.key_columns, self.values)
+            ]
+        self.next_cursor = None
+        self.prev_cursor = None
+
+    @staticmethod
+    def _coerce(column, value):
+        """
+        Converts a cursor value back into the Python type of its column;
+        datetimes are stored in cursors as ISO 8601 strings.
+        """
+        if value is not None and isinstance(column.type, DateTime):
+            try:
+                return datetime.fromisoformat(value)
+            except (TypeError, ValueError) as e:
+                raise BadRequest(description="Invalid cursor") from e
+        return value
+
+    @classmethod
+    def from_request(cls, *key_columns, descending=False):
+        """
+        Builds a page from the "cursor" and "limit" query parameters.
+
+        Returns:
+            KeysetPage: The requested page.
+
+        Raises:
+            BadRequest: If the limit or cursor is invalid.
+        """
+        try:
+            limit = int(request.args.get("limit", MEASUREMENT_PAGE_SIZE))
+        except ValueError as e:
+            raise BadRequest(description="limit must be an integer") from e
+        if limit < 1:
+            raise BadRequest(description="limit must be positive")
+        return cls(key_columns, request.args.get("cursor"), min(limit, MAX_PAGE_SIZE), descending)
+
+    def _key(self):
+        if len(self.key_columns) == 1:
+            return self.key_columns[0], self.values[0] if self.values else None
+        return tuple_(*self.key_columns), tuple_(*self.values) if self.values else None
+
+    def apply(self, stmt):
+        """
+        Restricts a select statement to this page. One extra row is
+        fetched so collect() can tell whether another page follows.
+
+        Parameters:
+            stmt (Select): The statement to paginate.
+
+        Returns:
+            Select: The paginated statement.
+        """
+        key, value = self._key()
+        if (self.direction == "prev") != self.descending:
+            if value is not None:
+                stmt = stmt.where(key < value)
+            order = [col.desc() for col in self.key_columns]
+        else:
+            if value is not None:
+                stmt = stmt.where(key > value)
+            order = self.key_columns
+        return stmt.order_by(*order).limit(self.limit + 1)
+
+    def collect(self, rows, key_of):
+        """
+        Trims the fetched rows to the page and computes the neighbouring
+        cursors.
+
+        Parameters:
+            rows (list): Rows returned by the statement from apply().
+            key_of (callable): Returns the key values of a row as a tuple.
+
+        Returns:
+            list: The rows of this page in collection order.
+        """
+        more = len(rows) > self.limit
+        rows = list(rows[:self.limit])
+        if self.direction == "prev":
+            rows.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = self.values is not None, more
+        if rows and has_prev:
+            self.prev_cursor = encode_cursor(key_of(rows[0]), "prev")
+        if rows and has_next:
+            self.next_cursor = encode_cursor(key_of(rows[-1]), "next")
+        return rows
+
+    def add_controls(self, body):
+        """
+        Adds Mason "next" and "prev" controls pointing at the
+        neighbouring pages to a response body.
+
+        Parameters:
+            body (MasonBuilder): The collection response body.
+        """
+        args = request.args.to_dict()
+        for name, cursor in (("next", self.next_cursor), ("prev", self.prev_cursor)):
+            if cursor is not None:
+                args["cursor"] = cursor
+                body.add_control(
+                    name,
+                    url_for(request.endpoint, **(request.view_args or {}), **args),
+                    method="GET"
+                )
+
 class ProductConverter(BaseConverter):
     """
     Custom URL converter for Flask routes, converting product IDs to 
@@ -254,12 +450,71 @@ class ManufacturerConverter(BaseConverter):
         """
         return str(manufacturer.manufacturer_id)
 
+class ApiKeyStore:
+    """
+    In-memory copy of the API keys, mapping each key hash to its admin
+    flag. Verifying a request key is a dictionary lookup; the database is
+    only read when the copy is older than API_KEY_TTL seconds, or when
+    refresh() is called after keys change (e.g. by ``flask masterkey``).
+
+    Each application owns one store, available through for_app().
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._keys = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def for_app(app):
+        """
+        Returns the key store of an application, creating it on first use.
+
+        Parameters:
+            app (Flask): The application.
+
+        Returns:
+            ApiKeyStore: The application's key store.
+        """
+        store = app.extensions.get("ecomsync_api_keys")
+        if store is None:
+            store = app.extensions.setdefault(
+                "ecomsync_api_keys", ApiKeyStore(app.config["API_KEY_TTL"]))
+        return store
+
+    def refresh(self):
+        """
+        Reloads every key from the database. Must be called inside an
+        application context.
+        """
+        rows = db.session.execute(select(ApiKey.key, ApiKey.admin)).all()
+        keys = {key: bool(admin) for key, admin in rows}
+        with self._lock:
+            self._keys = keys
+            self._loaded_at = time.monotonic()
+
+    def lookup(self, key_hash):
+        """
+        Looks up a hashed key.
+
+        Parameters:
+            key_hash (bytes): Hash produced by ApiKey.key_hash.
+
+        Returns:
+            bool: The admin flag of the key, or None for unknown keys.
+        """
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at > self.ttl:
+            self.refresh()
+        return self._keys.get(key_hash)
+
 def require_admin(func):
     """
     Decorator function to require admin privileges for a function.
 
     This decorator verifies the access key present in the request headers. It first hashes the key,
-    then compares the hashed key with the stored hash of the admin key. If they match, 
+    then looks the hash up in the application's ApiKeyStore. If it belongs to an admin key,
     the wrapped function is executed. Otherwise, a Forbidden exception is raised.
 
     Parameters:
@@ -270,8 +525,7 @@ def require_admin(func):
     """
     def wrapper(*args, **kwargs):
         key_hash = ApiKey.key_hash(request.headers.get("access-Key", "").strip())
-        db_key = ApiKey.query.filter_by(admin=True).first()
-        if secrets.compare_digest(key_hash, db_key.key):
+        if ApiKeyStore.for_app(current_app).lookup(key_hash):
             return func(*args, **kwargs)
         raise Forbidden
     return wrapper
@@ -0,0 +1,228 @@
+"""
+Writes module.
+
+This module provides group commit for the write handlers. Instead of
+committing on its own, a handler passes a function making its changes to
+run_write(). A single writer thread per application collects the writes
+submitted at about the same time, applies each of them inside its own
+SAVEPOINT and commits them all in one transaction. Every handler is only
+answered after that commit has succeeded, so a successful response still
+means the write is in the database.
+
+Concurrent requests then share one commit, and one sync to disk, instead
+of queueing for the SQLite write lock one after the other. A failing
+write (e.g. an IntegrityError) only rolls back its own savepoint.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError
+
+from flask import current_app
+from sqlalchemy import text
+from werkzeug.exceptions import ServiceUnavailable
+
+from ecomsync import db
+
+
+class WriteBatcher:
+    """
+    Single writer thread committing the writes of an application in
+    groups. After taking a write from the queue the thread waits up to
+    window seconds for more, and commits at most max_size writes at once.
+    Writes arriving while a group is being committed form the next group,
+    so groups grow with the load even without a window. The thread is
+    started on demand and exits after idle seconds without writes.
+    Submitters wait at most timeout seconds for their write to commit.
+    """
+
+    def __init__(self, app, window=0.0, max_size=64, idle=5.0, timeout=30.0):
+        self.app = app
+        self.window = window
+        self.max_size = max_size
+        self.idle = idle
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, work):
+        """
+        Queues a write and waits until it has been committed.
+
+        Parameters:
+            work (callable): Function without arguments making changes
+            through db.session. It runs on the writer thread, outside the
+            request context, and must return plain values rather than
+            model instances.
+
+        Returns:
+            The return value of work.
+
+        Raises:
+            The exception raised by work, or by the commit of its group.
+            ServiceUnavailable (503) if the write was not committed within
+            timeout seconds or the writer thread stopped.
+        """
+        future = Future()
+        with self._lock:
+            self._queue.put((work, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-batcher",
+                                                daemon=True)
+                self._thread.start()
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            # A write that has not started yet is dropped; one that has
+            # may still be committed, but the request cannot wait for it.
+            future.cancel()
+            raise ServiceUnavailable("The write was not committed within %s seconds"
+                                     % self.timeout)
+
+    def _collect(self):
+        """
+        Returns the next group of queued writes, an empty list if none
+        arrived within idle seconds, or None once the thread should exit.
+        """
+        try:
+            batch = [self._queue.get(timeout=self.idle)]
+        except queue.Empty:
+            with self._lock:
+                if self._queue.empty():
+                    self._thread = None
+                    return None
+            return []
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, batch):
+        """
+        Applies the writes of a group in one transaction and resolves their
+        futures once it has been committed.
+        """
+        results = []
+        try:
+            # Taking the write lock up front also makes the savepoints nest
+            # inside one transaction with the sqlite3 driver.
+            if db.engine.dialect.name == "sqlite":
+                db.session.execute(text("BEGIN IMMEDIATE"))
+            for work, future in batch:
+                # Skip the writes whose submitter has given up waiting
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    # Leaving the block flushes the changes of the write
+                    with db.session.begin_nested():
+                        value = work()
+                except Exception as e:
+                    results.append((future, None, e))
+                else:
+                    results.append((future, value, None))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            results = [(future, None, e) for _, future in batch]
+        finally:
+            db.session.remove()
+
+        for future, value, error in results:
+            try:
+                if error is None:
+                    future.set_result(value)
+                else:
+                    future.set_exception(error)
+            except InvalidStateError:
+                # Cancelled by its submitter before the group started
+                pass
+
+    def _run(self):
+        batch = []
+        try:
+            with self.app.app_context():
+                while True:
+                    batch = self._collect()
+                    if batch is None:
+                        return
+                    if batch:
+                        self._commit(batch)
+                    batch = []
+        except BaseException as e:
+            # Fail the outstanding writes instead of leaving their
+            # submitters waiting; the next submit starts a new thread.
+            with self._lock:
+                self._thread = None
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+            for _, future in batch:
+                try:
+                    future.set_exception(ServiceUnavailable("The writer thread stopped: %r" % e))
+                except InvalidStateError:
+                    pass
+            raise
+
+
+def configure_writes(app):
+    """
+    Creates the write batcher of the application if WRITE_BATCHING is
+    enabled.
+
+    Parameters:
+        app (Flask): The application.
+    """
+    if app.config["WRITE_BATCHING"]:
+        timeout = app.config["WRITE_BATCH_TIMEOUT"]
+        if timeout is None:
+            # A write waits for the lock at most twice, for the group being
+            # committed and for its own, plus the time the groups take
+            busy_timeout = app.config["SQLITE_PRAGMAS"].get("busy_timeout", 5000)
+            timeout = 3 * busy_timeout / 1000
+        app.extensions["ecomsync_write_batcher"] = WriteBatcher(
+            app,
+            window=app.config["WRITE_BATCH_WINDOW"],
+            max_size=app.config["WRITE_BATCH_MAX_SIZE"],
+            timeout=timeout,
+        )
+
+
+def run_write(work):
+    """
+    Runs a write and commits it, grouped with concurrent writes by the
+    application's WriteBatcher, or directly in the request's session when
+    write batching is disabled. The request's session must not have
+    uncommitted changes of its own.
+
+    Parameters:
+        work (callable): Function without arguments making changes through
+        db.session and returning plain values.
+
+    Returns:
+        The return value of work.
+    """
+    # Statements run on the writer thread still count for this request
+    for name in ("ecomsync_query_check", "ecomsync_metrics"):
+        extension = current_app.extensions.get(name)
+        if extension is not None:
+            work = extension.attributed(work)
+    batcher = current_app.extensions.get("ecomsync_write_batcher")
+    if batcher is not None:
+        return batcher.submit(work)
+    try:
+        result = work()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result
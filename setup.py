@@ -3,7 +3,7 @@ from setuptools import find_packages, setup
 setup(
     name="ecomsync",
     version="0.1.0",
-    packages=find_packages(),
+    packages=find_packages(exclude=["tests", "benchmarks", "benchmarks.*"]),
     include_package_data=True,
     zip_safe=False,
     install_requires=[
@@ -11,6 +11,7 @@ setup(
         "flask-caching",
         "flask-restful",
         "flask-sqlalchemy",
+        "httpx",
         "jsonschema",
         "rfc3339-validator",
         "SQLAlchemy",
@@ -0,0 +1,5 @@
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "query_budget(queries=None, repeated=True, slow=False): fail the test if "
+        "a request executes more SQL statements, or repeats a statement shape, see "
+        "ecomsync.querycheck")
@@ -1,4 +1,5 @@
 
+import copy
 import json
 import os
 import pytest
@@ -8,7 +9,7 @@ from datetime import datetime
 from flask.testing import FlaskClient
 from jsonschema import validate
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, select
 from sqlalchemy.exc import IntegrityError, StatementError
 from werkzeug.datastructures import Headers
 from jsonschema import validate, ValidationError, draft7_format_checker
@@ -23,7 +24,9 @@ def client():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
+        "TESTING": True,
+        "CACHE_TYPE": "ecomsync.caching.LRUCache",
+        "QUERY_CHECK_ENABLED": True,
     }
     
     app = create_app(config)
@@ -38,6 +41,28 @@ def client():
     os.close(db_fd)
     os.unlink(db_fname)
 
+@pytest.fixture
+def query_budget(client):
+    """
+    Checks the requests sent inside the block against a query budget,
+    e.g. ``with query_budget(3): client.get(...)``, see QueryCheck.budget().
+    """
+    return client.application.extensions["ecomsync_query_check"].budget
+
+
+@pytest.fixture(autouse=True)
+def _query_budget_marker(request):
+    """
+    Applies @pytest.mark.query_budget(queries) to every request of a test.
+    """
+    marker = request.node.get_closest_marker("query_budget")
+    if marker is None:
+        yield
+        return
+    budget = request.getfixturevalue("query_budget")
+    with budget(*marker.args, **marker.kwargs):
+        yield
+
 def _populate_db():
     from datetime import datetime
     # Add Manufacturer data
@@ -189,6 +214,7 @@ class TestManufacturerItem(object):
     
     RESOURCE_URL = "/api/manufacturer/1"
 
+    @pytest.mark.query_budget(3)
     def test_get(self, client):
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
@@ -197,22 +223,1408 @@ class TestProductCollection(object):
     
     RESOURCE_URL = "/api/product/"
 
+    @pytest.mark.query_budget(3)
     def test_get(self, client):
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
 
+    def test_get_paginated(self, client):
+        resp = client.get(self.RESOURCE_URL + "?limit=3")
+        body = json.loads(resp.data)
+        assert [p["id"] for p in body["products"]] == [1, 2, 3]
+        assert "prev" not in body["@controls"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [p["id"] for p in body["products"]] == [4]
+        assert "next" not in body["@controls"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [p["id"] for p in body["products"]] == [1, 2, 3]
+
+    def test_get_invalid_cursor(self, client):
+        resp = client.get(self.RESOURCE_URL + "?cursor=garbage")
+        assert resp.status_code == 400
+
+    @pytest.mark.query_budget(3)
+    def test_get_many(self, client):
+        resp = client.get(self.RESOURCE_URL + "?ids=4,2,99")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [p["id"] for p in body["products"]] == [4, 2]
+        assert body["products"][0]["manufacturer_name"] == "Oakley"
+        assert body["products"][1]["manufacturer_name"] == "Ray Ban"
+        assert body["not_found"] == [99]
+        resp = client.get(self.RESOURCE_URL + "?ids=1,x")
+        assert resp.status_code == 400
+
 class TestProductItem(object):
     
     RESOURCE_URL = "/api/product/1"
 
+    @pytest.mark.query_budget(3)
     def test_get(self, client):
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
 
+    def test_get_cached(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["name"] == "Rage 4025"
+        with client.application.app_context():
+            db.session.get(Product, 1).name = "Changed behind the cache"
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["name"] == "Rage 4025"
+        resp = client.get(self.RESOURCE_URL + "?form=short")
+        assert json.loads(resp.data)["name"] == "Changed behind the cache"
+
+    def test_put_invalidates_cache(self, client):
+        client.get(self.RESOURCE_URL)
+        client.get("/api/manufacturer/2")
+        resp = client.put(self.RESOURCE_URL, json={
+            "name_update": "Rage 4025 Pro", "description_update": "Updated",
+            "sku_update": "ANX4025000008BF2", "quantity_update": 10,
+            "image_update": "/image/products/rage_4025.jpg",
+            "price_update": "45.0", "width_update": "3"
+        })
+        assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["name"] == "Rage 4025 Pro"
+        resp = client.get("/api/manufacturer/2")
+        products = json.loads(resp.data)["manufacturer"][0]["products"]
+        assert products[0]["product_name"] == "Rage 4025 Pro"
+
+    def test_get_conditional(self, client, query_budget):
+        resp = client.get(self.RESOURCE_URL)
+        resp.get_data()
+        etag, modified = resp.headers["ETag"], resp.headers["Last-Modified"]
+        # Cached responses are revalidated without any SQL
+        with query_budget(0):
+            resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+            assert resp.status_code == 304 and resp.headers["ETag"] == etag
+            resp = client.get(self.RESOURCE_URL, headers={"If-Modified-Since": modified})
+            assert resp.status_code == 304
+            resp = client.get(self.RESOURCE_URL)
+            assert resp.status_code == 200 and resp.headers["ETag"] == etag
+        resp = client.get(self.RESOURCE_URL + "?form=short", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        client.put("/api/manufacturer/2", json={
+            "name_update": "Arnette", "description_update": "Arnette Lenses",
+            "image_update": "/image/arnette.jpg"
+        })
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
+    @pytest.mark.query_budget(3)
+    def test_get_details(self, client):
+        resp = client.get("/api/product/4")
+        body = json.loads(resp.data)
+        assert body["manufacturer_name"] == "Oakley"
+        assert [o["option_id"] for o in body["options"]] == [1, 2, 12]
+        assert body["sku"] == "OAKXHIJINX006BF1"
+
 class TestOrderCollection(object):
     
     RESOURCE_URL = "/api/order/"
 
+    @pytest.mark.query_budget(1)
     def test_get(self, client):
         resp = client.get(self.RESOURCE_URL)
-        assert resp.status_code == 200
\ No newline at end of file
+        assert resp.status_code == 200
+
+    @pytest.mark.query_budget(1)
+    def test_get_ndjson_stream(self, client):
+        resp = client.get(self.RESOURCE_URL + "?stream=ndjson")
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        lines = resp.data.decode().splitlines()
+        assert [json.loads(line)["email"] for line in lines] == [
+            "roshan@gmail.com", "dilshani@gmail.com", "mithum@gmail.com"
+        ]
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/x-ndjson"})
+        assert len(resp.data.decode().splitlines()) == 3
+
+    def test_get_short_projection(self, client):
+        statements = []
+        with client.application.app_context():
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(db.engine, "before_cursor_execute", record)
+            try:
+                resp = client.get(self.RESOURCE_URL + "?form=short")
+            finally:
+                event.remove(db.engine, "before_cursor_execute", record)
+        assert json.loads(resp.data)["orders"][0] == {
+            "firstname": "Roshan", "email": "roshan@gmail.com"}
+        select = [s for s in statements if 'FROM "order"' in s][0]
+        assert "telephone" not in select and "payment_city" not in select
+
+    def test_get_filtered(self, client):
+        orders = [TestOrderBatch._order(email="buyer%d@example.com" % i, total=10.0 * i,
+                                        payment_country="Sweden" if i % 2 else "Finland",
+                                        date_added="2023-03-%02dT10:00:00+00:00" % (i + 1))
+                  for i in range(6)]
+        client.post("/api/order/batch", json=orders)
+
+        def emails(query):
+            resp = client.get(self.RESOURCE_URL + "?form=short&" + query)
+            assert resp.status_code == 200
+            return [order["email"] for order in json.loads(resp.data)["orders"]]
+
+        assert emails("email=mithum@gmail.com") == ["mithum@gmail.com"]
+        assert emails("product_id=2") == ["dilshani@gmail.com"]
+        assert emails("date_from=2023-03-02&date_to=2023-03-04") == [
+            "buyer1@example.com", "buyer2@example.com"]
+        assert emails("payment_country=Sweden&total_min=20&total_max=50") == [
+            "buyer3@example.com", "buyer5@example.com"]
+        assert emails("payment_country=Sweden&sort=-total") == [
+            "buyer5@example.com", "buyer3@example.com", "buyer1@example.com"]
+        assert client.get(self.RESOURCE_URL + "?total_min=lots").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?sort=lastname").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?sort=--total").status_code == 400
+
+        # Orders given with an offset are stored, and filtered, in UTC
+        client.post(self.RESOURCE_URL, json=TestOrderBatch._order(
+            email="single@example.com", date_added="2023-03-10T01:00:00+03:00"))
+        client.post("/api/order/batch", json=[TestOrderBatch._order(
+            email="batch@example.com", date_added="2023-03-10T02:30:00+03:00")])
+        assert emails("date_from=2023-03-09T22:00:00&date_to=2023-03-09T23:00:00") == [
+            "single@example.com"]
+        assert emails("date_from=2023-03-10T01:30:00%2B02:00&sort=date_added") == [
+            "batch@example.com"]
+
+    def test_get_sorted_paginated(self, client):
+        resp = client.get(self.RESOURCE_URL + "?form=short&sort=-date_added&limit=2")
+        body = json.loads(resp.data)
+        assert [o["email"] for o in body["orders"]] == ["mithum@gmail.com", "dilshani@gmail.com"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [o["email"] for o in body["orders"]] == ["roshan@gmail.com"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [o["email"] for o in body["orders"]] == ["mithum@gmail.com", "dilshani@gmail.com"]
+
+class TestOrderBatch(object):
+
+    RESOURCE_URL = "/api/order/batch"
+
+    @staticmethod
+    def _order(**overrides):
+        order = {
+            "firstname": "Aino", "lastname": "Virtanen", "email": "aino@example.com",
+            "telephone": "0401234567", "product_id": 1,
+            "payment_address_1": "Kauppurienkatu 1", "payment_city": "Oulu",
+            "payment_postcode": "90100", "payment_country": "Finland",
+            "total": 79.1, "date_added": "2023-03-01T10:00:00+00:00"
+        }
+        order.update(overrides)
+        return order
+
+    def test_post_json_array(self, client):
+        orders = [self._order(email="buyer%d@example.com" % i) for i in range(5)]
+        resp = client.post(self.RESOURCE_URL + "?chunk_size=2", json=orders)
+        assert resp.status_code == 201
+        body = json.loads(resp.data)
+        assert body["created"] == 5
+        resp = client.get("/api/order/")
+        assert len(json.loads(resp.data)["orders"]) == 8
+
+    def test_post_ndjson(self, client):
+        data = "\n".join(json.dumps(self._order()) for _ in range(3))
+        resp = client.post(self.RESOURCE_URL, data=data, content_type="application/x-ndjson")
+        assert resp.status_code == 201
+
+    def test_post_invalid_row(self, client):
+        orders = [self._order(), self._order(total="lots"), self._order(date_added="yesterday")]
+        resp = client.post(self.RESOURCE_URL, json=orders)
+        assert resp.status_code == 400
+        results = json.loads(resp.data)["results"]
+        assert [r["status"] for r in results] == ["valid", "invalid", "invalid"]
+        resp = client.get("/api/order/")
+        assert len(json.loads(resp.data)["orders"]) == 3
+
+class TestLRUCache(object):
+
+    def test_eviction_and_ttl(self, monkeypatch):
+        from ecomsync import caching
+        lru = caching.LRUCache(threshold=2, default_timeout=0)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        assert lru.get("a") == 1
+        lru.set("c", 3)
+        assert lru.get("b") is None
+        assert lru.get("a") == 1 and lru.get("c") == 3
+        lru.set("d", 4, timeout=10)
+        now = time.monotonic()
+        monkeypatch.setattr(caching.time, "monotonic", lambda: now + 11)
+        assert lru.get("d") is None
+        assert lru.get("c") == 3
+
+class TestApiKeyStore(object):
+
+    RESOURCE_URL = "/api/option/"
+
+    def test_admin_keys(self, client):
+        from ecomsync.utils import ApiKeyStore
+        app = client.application
+        with app.app_context():
+            for token, admin in (("first-admin", True), ("second-admin", True), ("user", False)):
+                db.session.add(ApiKey(key=ApiKey.key_hash(token), admin=admin))
+            db.session.commit()
+            ApiKeyStore.for_app(app).refresh()
+
+        for token in ("first-admin", "second-admin"):
+            resp = client.get(self.RESOURCE_URL, headers={"access-key": token})
+            assert resp.status_code == 200
+        resp = client.get(self.RESOURCE_URL, headers={"access-key": "user"})
+        assert resp.status_code == 403
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 403
+
+        with app.app_context():
+            ApiKey.query.delete()
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL, headers={"access-key": "first-admin"})
+        assert resp.status_code == 200
+        with app.app_context():
+            ApiKeyStore.for_app(app).refresh()
+        resp = client.get(self.RESOURCE_URL, headers={"access-key": "first-admin"})
+        assert resp.status_code == 403
+
+class TestMigrateDb(object):
+
+    def test_creates_missing_indexes(self, client):
+        from sqlalchemy import inspect, text
+        app = client.application
+        with app.app_context():
+            with db.engine.begin() as connection:
+                connection.execute(text("DROP INDEX ix_product_sku"))
+                connection.execute(text("DROP INDEX ix_order_email"))
+        result = app.test_cli_runner().invoke(args=["migrate-db"])
+        assert "Created index ix_order_email" in result.output
+        assert "Created index ix_product_sku" in result.output
+        with app.app_context():
+            names = {index["name"] for index in inspect(db.engine).get_indexes("product")}
+            assert "ix_product_sku" in names
+
+class TestSqliteProfile(object):
+
+    def test_pragmas_applied(self, client):
+        from sqlalchemy import text
+        with client.application.app_context():
+            assert db.session.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert db.session.execute(text("PRAGMA synchronous")).scalar() == 1
+            assert db.session.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+
+class TestSerializers(object):
+
+    def test_match_model_serialize(self, client):
+        from ecomsync.serializers import (PRODUCT_SERIALIZERS, ORDER_SERIALIZERS,
+                                          MANUFACTURER_SERIALIZERS, OPTION_SERIALIZER)
+        with client.application.app_context():
+            for model, serializers in ((Product, PRODUCT_SERIALIZERS), (Order, ORDER_SERIALIZERS),
+                                       (Manufacturer, MANUFACTURER_SERIALIZERS)):
+                entities = model.query.all()
+                for short_form, serializer in serializers.items():
+                    docs = serializer.serialize(serializer.rows(entities))
+                    assert docs == [entity.serialize(short_form) for entity in entities]
+            options = Options.query.all()
+            docs = OPTION_SERIALIZER.serialize(OPTION_SERIALIZER.rows(options))
+            assert docs == [option.serialize() for option in options]
+
+    def test_collection_controls(self, client):
+        resp = client.get("/api/product/?limit=2")
+        body = json.loads(resp.data)
+        assert body["products"][1]["@controls"]["self"]["href"] == "/api/product/2"
+        app = client.application
+        with app.app_context():
+            db.session.add(ApiKey(key=ApiKey.key_hash("admin"), admin=True))
+            db.session.commit()
+            from ecomsync.utils import ApiKeyStore
+            ApiKeyStore.for_app(app).refresh()
+        resp = client.get("/api/manufacturer/?limit=3", headers={"access-key": "admin"})
+        items = json.loads(resp.data)["items"]
+        assert items[2] == {"name": "Oakley", "description": "Oakley Sunglass Lenses",
+                            "@controls": {"storage:manufacturer": {
+                                "method": "GET", "title": "View a manufacturer",
+                                "schema": Manufacturer.json_schema(),
+                                "href": "/api/manufacturer/3"}}}
+
+class TestProductSearch(object):
+
+    RESOURCE_URL = "/api/product/search"
+
+    def test_search(self, client):
+        def ids(query):
+            resp = client.get(self.RESOURCE_URL, query_string=query)
+            assert resp.status_code == 200
+            return [p["id"] for p in json.loads(resp.data)["products"]]
+
+        assert ids({"q": "oakley"}) == [4]
+        assert ids({"q": "sunglass rb33"}) == [2]
+        assert ids({"q": "GUCXGG259800006B"}) == [3]
+        assert sorted(ids({"q": "sunglass"})) == [1, 2, 3, 4]
+        assert ids({"q": "hijinx-OO9021\" NOT"}) == []
+        assert ids({"q": "\"hijinx\" - OO9021"}) == [4]
+        resp = client.get(self.RESOURCE_URL, query_string={"q": "  "})
+        assert resp.status_code == 400
+
+    def test_search_paginated(self, client):
+        resp = client.get(self.RESOURCE_URL, query_string={"q": "sunglass", "limit": 3})
+        body = json.loads(resp.data)
+        first = [p["id"] for p in body["products"]]
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert len(first) == 3 and len(body["products"]) == 1
+        assert body["products"][0]["id"] not in first
+
+    def test_search_in_sync(self, client):
+        client.put("/api/manufacturer/3", json={
+            "name_update": "Oakley Inc", "description_update": "Oakley Lenses",
+            "image_update": "/image/oakley.jpg"
+        })
+        resp = client.get(self.RESOURCE_URL, query_string={"q": "oakley inc"})
+        assert [p["id"] for p in json.loads(resp.data)["products"]] == [4]
+        client.delete("/api/product/4")
+        resp = client.get(self.RESOURCE_URL, query_string={"q": "oakley"})
+        assert json.loads(resp.data)["products"] == []
+
+class TestSalesReport(object):
+
+    RESOURCE_URL = "/api/report/sales"
+
+    def test_rollups_match_orders(self, client):
+        orders = [TestOrderBatch._order(product_id=1 + i % 3, total=10.0 + i,
+                                        payment_country="Sweden" if i % 2 else "Finland",
+                                        date_added="2023-03-%02dT10:00:00+00:00" % (1 + i % 4))
+                  for i in range(12)]
+        client.post("/api/order/batch", json=orders)
+        with client.application.app_context():
+            db.session.delete(db.session.get(Order, 4))
+            db.session.get(Order, 5).total = 100.0
+            db.session.commit()
+
+        for group_by in ("day", "product", "manufacturer", "country", "day,country"):
+            query = {"group_by": group_by, "date_from": "2019-01-01"}
+            rollup = json.loads(client.get(self.RESOURCE_URL, query_string=query).data)
+            orders = json.loads(client.get(self.RESOURCE_URL, query_string=dict(
+                query, source="orders")).data)
+            assert rollup["sales"] == orders["sales"]
+
+    def test_report(self, client):
+        resp = client.get(self.RESOURCE_URL, query_string={"group_by": "manufacturer"})
+        sales = json.loads(resp.data)["sales"]
+        assert [(s["manufacturer_name"], s["orders"], s["revenue"]) for s in sales] == [
+            ("Ray Ban", 1, 39.55), ("Arnette", 1, 39.55), ("Gucci", 1, 39.55)]
+        resp = client.get(self.RESOURCE_URL, query_string={"date_from": "2020-01-01"})
+        assert json.loads(resp.data)["sales"] == []
+        resp = client.get(self.RESOURCE_URL, query_string={"group_by": "weekday"})
+        assert resp.status_code == 400
+
+class TestChangeFeed(object):
+
+    RESOURCE_URL = "/api/changes"
+
+    def test_changes(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        assert sorted((c["entity"], c["id"], c["operation"]) for c in body["changes"]) == [
+            ("order", 1, "insert"), ("order", 2, "insert"), ("order", 3, "insert"),
+            ("product", 1, "insert"), ("product", 2, "insert"), ("product", 3, "insert"),
+            ("product", 4, "insert")]
+        since = body["last_seq"]
+
+        client.delete("/api/product/4")
+        client.post("/api/order/batch", json=[TestOrderBatch._order()])
+        resp = client.get(self.RESOURCE_URL, query_string={"since": since, "limit": 1})
+        body = json.loads(resp.data)
+        assert body["more"] is True
+        change = body["changes"][0]
+        assert (change["entity"], change["id"], change["operation"]) == ("product", 4, "delete")
+        assert change["data"] is None
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert body["more"] is False
+        assert body["changes"][0]["data"]["email"] == "aino@example.com"
+
+        resp = client.get(self.RESOURCE_URL, query_string={"since": since, "entity": "order"})
+        assert [c["entity"] for c in json.loads(resp.data)["changes"]] == ["order"]
+        assert client.get(self.RESOURCE_URL + "?since=x").status_code == 400
+
+class TestIngestJobs(object):
+
+    def test_async_import(self, client):
+        from ecomsync.jobs import drain_once
+        orders = [TestOrderBatch._order(email="queued%d@example.com" % i) for i in range(4)]
+        resp = client.post("/api/order/batch?async=1", json=orders)
+        assert resp.status_code == 202
+        job_url = resp.headers["Location"]
+        assert json.loads(resp.data)["status"] == "queued"
+        resp = client.post("/api/order/?async=true", json=TestOrderBatch._order())
+        assert resp.status_code == 202
+
+        with client.application.app_context():
+            assert Order.query.count() == 3
+            assert drain_once(max_bytes=1, chunk_size=2) == 1
+            assert Order.query.count() == 7
+            assert drain_once(max_bytes=1, chunk_size=2) == 1
+            assert drain_once(max_bytes=1, chunk_size=2) == 0
+            assert Order.query.count() == 8
+        body = json.loads(client.get(job_url).data)
+        assert body["status"] == "done" and body["rows"] == 4
+        assert client.get("/api/jobs/99").status_code == 404
+
+    def test_failed_job(self, client):
+        from ecomsync.jobs import drain_once
+        good = client.post("/api/order/batch?async=1", json=[TestOrderBatch._order()])
+        bad = client.post("/api/order/?async=1", json=TestOrderBatch._order(total="lots"))
+        with client.application.app_context():
+            assert drain_once(max_bytes=10000, chunk_size=10) == 2
+            assert Order.query.count() == 4
+        assert json.loads(client.get(good.headers["Location"]).data)["status"] == "done"
+        body = json.loads(client.get(bad.headers["Location"]).data)
+        assert body["status"] == "failed" and "invalid_rows" in body["error"]
+
+    def test_not_utf8(self, client):
+        resp = client.post("/api/order/batch?async=1", data=b'[{"email": "\xff"}]',
+                           content_type="application/json")
+        assert resp.status_code == 400
+        # The workers use ORDER_BATCH_CHUNK_SIZE, not the request's
+        resp = client.post("/api/order/batch?async=1&chunk_size=10",
+                           json=[TestOrderBatch._order()])
+        assert resp.status_code == 400
+        with client.application.app_context():
+            assert IngestJob.query.count() == 0
+
+    def test_unexpected_error(self, client, monkeypatch):
+        import ecomsync.jobs
+        from ecomsync.jobs import drain_once
+        insert_orders = ecomsync.jobs.insert_orders
+
+        def broken(mappings, chunk_size):
+            if mappings[0]["email"] == "broken@example.com":
+                raise TypeError("a bug")
+            return insert_orders(mappings, chunk_size)
+
+        monkeypatch.setattr(ecomsync.jobs, "insert_orders", broken)
+        good = client.post("/api/order/batch?async=1", json=[TestOrderBatch._order()])
+        bad = client.post("/api/order/batch?async=1",
+                          json=[TestOrderBatch._order(email="broken@example.com")])
+        with client.application.app_context():
+            assert drain_once(max_bytes=10000, chunk_size=10) == 2
+            assert Order.query.count() == 4
+        assert json.loads(client.get(good.headers["Location"]).data)["status"] == "done"
+        body = json.loads(client.get(bad.headers["Location"]).data)
+        assert body["status"] == "failed" and body["error"] == "TypeError: a bug"
+
+    def test_requeue_after_crash(self, client):
+        from ecomsync.jobs import drain_once, requeue_stale
+        resp = client.post("/api/order/batch?async=1", json=[TestOrderBatch._order()] * 2)
+        with client.application.app_context():
+            job = IngestJob.query.one()
+            # The worker imported the orders and died before updating the queue
+            job.status, job.claimed_at = "running", datetime(2020, 1, 1)
+            db.session.commit()
+            db.session.add(IngestedJob(job_id=job.job_id, row_count=2))
+            db.session.commit()
+            assert requeue_stale(60) == 1
+            assert drain_once(max_bytes=10000, chunk_size=10) == 1
+            assert Order.query.count() == 3
+        body = json.loads(client.get(resp.headers["Location"]).data)
+        assert body["status"] == "done" and body["rows"] == 2
+
+    def test_workers(self, client, monkeypatch):
+        import ecomsync.jobs
+        from ecomsync.jobs import IngestWorkers
+        app = client.application
+        app.config["INGEST_POLL_INTERVAL"] = 0.01
+        # A worker that hits an unexpected error keeps going
+        failures = iter([RuntimeError("first poll fails")])
+        drain_once = ecomsync.jobs.drain_once
+
+        def flaky(*args):
+            for error in failures:
+                raise error
+            return drain_once(*args)
+
+        monkeypatch.setattr(ecomsync.jobs, "drain_once", flaky)
+        workers = IngestWorkers(app, 2)
+        workers.start()
+        try:
+            urls = [client.post("/api/order/batch?async=1", json=[TestOrderBatch._order()])
+                    .headers["Location"] for _ in range(5)]
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                if all(json.loads(client.get(url).data)["status"] == "done" for url in urls):
+                    break
+                time.sleep(0.02)
+        finally:
+            workers.stop()
+        assert all(json.loads(client.get(url).data)["status"] == "done" for url in urls)
+
+
+class TestWriteBatching(object):
+
+    @staticmethod
+    def _product(sku, **overrides):
+        product = {
+            "name": "Batched", "description": "Group commit", "manufacturerId": 1,
+            "sku": sku, "quantity": 1, "image": "/image/batched.jpg", "price": "9.5",
+            "width": "50", "selectedOptions": [1, 2], "date_added": "2023-01-01T00:00:00",
+        }
+        product.update(overrides)
+        return product
+
+    def test_product_post_single_transaction(self, client):
+        app = client.application
+        with app.app_context():
+            commits = []
+            event.listen(db.engine, "commit", commits.append)
+        resp = client.post("/api/product/", json=self._product("BATCH-1"))
+        assert resp.status_code == 201
+        assert len(commits) == 1
+        with app.app_context():
+            product = Product.query.filter_by(sku="BATCH-1").one()
+            assert sorted(po.option_id for po in product.product_option) == [1, 2]
+
+    def test_group_commit(self, client):
+        import threading
+        from ecomsync.writes import WriteBatcher, run_write
+        app = client.application
+        batcher = WriteBatcher(app, window=0.2, max_size=64)
+        app.extensions["ecomsync_write_batcher"] = batcher
+        with app.app_context():
+            commits = []
+            event.listen(db.engine, "commit", commits.append)
+
+        def add(sku):
+            with app.app_context():
+                try:
+                    results[sku] = run_write(lambda: db.session.add(Product(
+                        sku=sku, quantity=1, image="-", price=1.0, width=1.0)))
+                except IntegrityError as e:
+                    results[sku] = e
+
+        results = {}
+        # Product 1 already has this SKU
+        skus = ["GROUP-%d" % i for i in range(8)] + ["ANX4025000008BF2"]
+        threads = [threading.Thread(target=add, args=(sku,)) for sku in skus]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert isinstance(results.pop("ANX4025000008BF2"), IntegrityError)
+        assert all(result is None for result in results.values())
+        assert len(commits) < len(skus)
+        with app.app_context():
+            assert Product.query.filter(Product.sku.like("GROUP-%")).count() == 8
+
+    def test_timeout(self, client):
+        import threading
+        from werkzeug.exceptions import ServiceUnavailable
+        from ecomsync.writes import WriteBatcher, run_write
+        app = client.application
+        batcher = app.extensions["ecomsync_write_batcher"] = WriteBatcher(app, timeout=0.2)
+        release = threading.Event()
+
+        def stall():
+            # Times out itself too, while the writer thread keeps waiting
+            with pytest.raises(ServiceUnavailable):
+                batcher.submit(lambda: release.wait(5))
+
+        blocked = threading.Thread(target=stall)
+        blocked.start()
+        try:
+            # Queued behind the stalled write: answered 503 and never applied
+            resp = client.post("/api/product/", json=self._product("BATCH-3"))
+            assert resp.status_code == 503
+        finally:
+            release.set()
+            blocked.join()
+        with app.app_context():
+            assert run_write(lambda: Product.query.filter_by(sku="BATCH-3").count()) == 0
+
+    @pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+    def test_writer_thread_dies(self, client):
+        from werkzeug.exceptions import ServiceUnavailable
+        from ecomsync.writes import WriteBatcher
+
+        import threading
+
+        class Stop(BaseException):
+            pass
+
+        def stop():
+            raise Stop()
+
+        app = client.application
+        batcher = WriteBatcher(app, timeout=5)
+        running = set(threading.enumerate())
+        with pytest.raises(ServiceUnavailable):
+            batcher.submit(stop)
+        # Let the dead thread exit while its warning is still ignored
+        for thread in set(threading.enumerate()) - running:
+            thread.join(5)
+        # A new writer thread takes over
+        assert batcher.submit(lambda: 42) == 42
+
+    def test_without_batching(self, client):
+        client.application.extensions.pop("ecomsync_write_batcher")
+        resp = client.post("/api/product/", json=self._product("BATCH-2"))
+        assert resp.status_code == 201
+        resp = client.post("/api/product/", json=self._product("ANX4025000008BF2"))
+        assert resp.status_code == 400
+        resp = client.delete("/api/product/99/")
+        assert resp.status_code == 404
+
+
+class TestBenchmarkSuite(object):
+
+    def test_covers_every_resource(self, client):
+        from benchmarks.bench_api import uncovered_endpoints
+        assert uncovered_endpoints(client.application) == []
+
+    def test_scenarios_succeed(self):
+        from benchmarks.bench_api import SCENARIOS, run
+        results = run(100, ["client"], SCENARIOS, requests=3, concurrency=2)
+        assert len(results) == len(SCENARIOS)
+        assert [r["scenario"] for r in results if r["errors"]] == []
+
+
+class TestDataGenerator(object):
+
+    def test_generate(self, client):
+        from ecomsync.datagen import generate
+        from ecomsync.reporting import sales_report
+        from sqlalchemy import text
+        app = client.application
+        with app.app_context():
+            schema = "SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger')"
+            before = sorted(db.session.execute(text(schema)).all())
+            counts = generate(manufacturers=3, options=5, products=20, orders=500, seed=7)
+            assert counts["order"] == 500 and counts["product"] == 20
+            assert sorted(db.session.execute(text(schema)).all()) == before
+
+            # New rows follow the fixture's ids
+            assert Order.query.count() == 503
+            assert db.session.get(Manufacturer, 22).name == "Ray Ban 2"
+            assert all(o.product_id > 4 for o in Order.query.filter(Order.order_id > 3))
+
+            # Derived tables were rebuilt and the triggers still work
+            assert sales_report(["day", "country"]) == \
+                sales_report(["day", "country"], from_orders=True)
+            assert ChangeLog.query.filter_by(entity="order").count() == 503
+        assert len(json.loads(client.get("/api/product/search?q=sunglass&limit=100").data)
+                   ["products"]) == 24
+        client.delete("/api/product/5")
+        with app.app_context():
+            assert ChangeLog.query.filter_by(operation="delete").count() == 1
+
+    def test_failed_load(self, client, monkeypatch):
+        import ecomsync.datagen
+        from ecomsync.datagen import generate
+        from sqlalchemy import text
+
+        def broken(*args):
+            raise RuntimeError("interrupted")
+
+        monkeypatch.setattr(ecomsync.datagen, "_order_rows", broken)
+        app = client.application
+        with app.app_context():
+            schema = "SELECT type, name FROM sqlite_master WHERE type IN ('index', 'trigger')"
+            before = sorted(db.session.execute(text(schema)).all())
+            with pytest.raises(RuntimeError):
+                generate(products=20, orders=100)
+        with app.app_context():
+            # The dropped triggers and indexes came back with the rollback
+            assert sorted(db.session.execute(text(schema)).all()) == before
+            assert Product.query.count() == 4
+        client.delete("/api/product/4")
+        with app.app_context():
+            assert ChangeLog.query.filter_by(operation="delete").count() == 1
+
+    def test_deterministic(self):
+        from benchmarks.common import temporary_app
+        from ecomsync.datagen import generate
+        snapshots = []
+        for _ in range(2):
+            with temporary_app() as app, app.app_context():
+                generate(products=10, orders=200, seed=3)
+                snapshots.append([
+                    [tuple(row) for row in db.session.execute(select(*model.__table__.c))]
+                    for model in (Manufacturer, Options, Product, ProductOption, Order)
+                ])
+        assert snapshots[0] == snapshots[1]
+
+    def test_command(self, client):
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["testgen", "--orders", "10", "--products", "2"])
+        assert "10 order" in result.output
+        result = runner.invoke(args=["populate-db", "--orders", "5", "--manufacturers", "0"])
+        assert "5 order" in result.output
+
+
+class TestStockReservations(object):
+
+    RESOURCE_URL = "/api/reservations/"
+
+    @staticmethod
+    def _stock(client):
+        with client.application.app_context():
+            return {p.product_id: p.quantity for p in Product.query.order_by(Product.product_id)}
+
+    def test_reserve_commit_release(self, client):
+        resp = client.post(self.RESOURCE_URL, json={"items": [
+            {"sku": "RBX335700000006B", "quantity": 2}, {"sku": "ANX4025000008BF2", "quantity": 1},
+            {"sku": "RBX335700000006B", "quantity": 1}]})
+        assert resp.status_code == 201
+        body = json.loads(resp.data)
+        assert body["status"] == "held"
+        assert [(i["product_id"], i["quantity"]) for i in body["items"]] == [(1, 1), (2, 3)]
+        assert self._stock(client) == {1: 999, 2: 997, 3: 1000, 4: 1000}
+
+        # All or nothing
+        resp = client.post(self.RESOURCE_URL, json={"items": [
+            {"sku": "GUCXGG259800006B", "quantity": 1}, {"sku": "RBX335700000006B", "quantity": 998},
+            {"sku": "NOSUCHSKU", "quantity": 1}]})
+        assert resp.status_code == 409
+        assert json.loads(resp.data)["unavailable"] == ["NOSUCHSKU", "RBX335700000006B"]
+        assert self._stock(client) == {1: 999, 2: 997, 3: 1000, 4: 1000}
+        assert client.post(self.RESOURCE_URL, json={"items": []}).status_code == 400
+        assert client.post(self.RESOURCE_URL, json={"items": [
+            {"sku": "RBX335700000006B", "quantity": 0}]}).status_code == 400
+
+        href = client.post(self.RESOURCE_URL, json={"items": [
+            {"sku": "GUCXGG259800006B", "quantity": 5}]}).headers["Location"]
+        resp = client.post(body["@controls"]["commit"]["href"], json={"order_id": 1})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["status"] == "committed"
+        assert client.post(body["@controls"]["commit"]["href"]).status_code == 409
+        assert self._stock(client) == {1: 999, 2: 997, 3: 995, 4: 1000}
+
+        assert client.delete(href).status_code == 200
+        assert client.delete(href).status_code == 409
+        assert json.loads(client.get(href).data)["status"] == "released"
+        # Releasing a committed reservation puts its stock back too
+        assert client.delete(body["@controls"]["release"]["href"]).status_code == 200
+        assert self._stock(client) == {1: 1000, 2: 1000, 3: 1000, 4: 1000}
+        assert client.get(self.RESOURCE_URL + "99").status_code == 404
+        assert client.delete(self.RESOURCE_URL + "99").status_code == 404
+        assert client.post(self.RESOURCE_URL + "99/commit").status_code == 404
+
+    def test_order_commits_reservation(self, client):
+        resp = client.post(self.RESOURCE_URL, json={"items": [
+            {"sku": "OAKXHIJINX006BF1", "quantity": 1}]})
+        reservation_id = json.loads(resp.data)["id"]
+        order = dict(TestOrderBatch._order(), reservation_id=reservation_id)
+        assert client.post("/api/order/", json=order).status_code == 201
+        with client.application.app_context():
+            reservation = db.session.get(StockReservation, reservation_id)
+            assert reservation.status == "committed" and reservation.order_id == 4
+        # The order is not added when its reservation cannot be committed
+        assert client.post("/api/order/", json=order).status_code == 409
+        assert client.post("/api/order/", json=dict(order, reservation_id=99)).status_code == 409
+        # Ids must be integers, "1" is not looked up
+        for invalid in (str(reservation_id), 0, True, 1.5):
+            resp = client.post("/api/order/", json=dict(order, reservation_id=invalid))
+            assert resp.status_code == 400
+        with client.application.app_context():
+            assert Order.query.count() == 4
+
+    def test_order_imports_reject_reservation(self, client):
+        from ecomsync.ingest import validate_order_rows
+        from ecomsync.jobs import drain_once
+        order = dict(TestOrderBatch._order(), reservation_id=1)
+        # Queued and bulk imports cannot commit the reservation
+        assert client.post("/api/order/?async=1", json=order).status_code == 400
+        resp = client.post("/api/order/batch", json=[TestOrderBatch._order(), order])
+        assert resp.status_code == 400
+        assert json.loads(resp.data)["results"][1]["status"] == "invalid"
+        assert 1 in validate_order_rows([TestOrderBatch._order(), order])[1]
+
+        # Queued batches are checked by the worker, whatever the JSON looks
+        # like; text that merely mentions the key is accepted
+        escaped = b'[' + json.dumps(order).encode().replace(b'"reservation_id"',
+                                                             b'"\\u0072eservation_id"') + b']'
+        assert client.post("/api/order/batch?async=1", data=escaped,
+                           content_type="application/json").status_code == 202
+        mention = TestOrderBatch._order(payment_address_1='"reservation_id"')
+        assert client.post("/api/order/batch?async=1", json=[mention]).status_code == 202
+        with client.application.app_context():
+            assert drain_once(max_bytes=1, chunk_size=100) == 1
+            assert drain_once(max_bytes=1, chunk_size=100) == 1
+            failed, done = IngestJob.query.order_by(IngestJob.job_id)
+            assert failed.status == "failed" and "reservation_id" in failed.error
+            assert done.status == "done"
+            assert Order.query.count() == 4
+
+    def test_expiry(self, client):
+        from datetime import timedelta
+        from ecomsync.stock import expire_reservations
+        from ecomsync.writes import run_write
+        href = client.post(self.RESOURCE_URL, json={"ttl": 60, "items": [
+            {"sku": "OAKXHIJINX006BF1", "quantity": 10}]}).headers["Location"]
+        client.post(self.RESOURCE_URL, json={"items": [{"sku": "OAKXHIJINX006BF1", "quantity": 1}]})
+        with client.application.app_context():
+            later = datetime.utcnow() + timedelta(seconds=120)
+            assert run_write(lambda: expire_reservations(later)) == (1, [4])
+            assert run_write(lambda: expire_reservations(later)) == (0, [])
+        assert self._stock(client)[4] == 999
+        assert json.loads(client.get(href).data)["status"] == "expired"
+        assert client.post(href + "/commit").status_code == 409
+
+        runner = client.application.test_cli_runner()
+        assert "Expired 0 reservations" in runner.invoke(args=["sweep-reservations"]).output
+
+    def test_concurrent_reservations(self, client):
+        import threading
+        app = client.application
+        with app.app_context():
+            db.session.get(Product, 1).quantity = 50
+            db.session.commit()
+        statuses = []
+
+        def reserve():
+            test_client = app.test_client()
+            for _ in range(10):
+                statuses.append(test_client.post(self.RESOURCE_URL, json={"items": [
+                    {"sku": "ANX4025000008BF2", "quantity": 1},
+                    {"sku": "GUCXGG259800006B", "quantity": 1}]}).status_code)
+
+        threads = [threading.Thread(target=reserve) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert statuses.count(201) == 50 and statuses.count(409) == 30
+        assert self._stock(client) == {1: 0, 2: 1000, 3: 950, 4: 1000}
+
+
+class TestConnectors(object):
+
+    @staticmethod
+    def _accounts(server, names, **settings):
+        return [dict({"name": name, "connector": "ecomsync.standin.StandInConnector",
+                      "base_url": "http://127.0.0.1:%d" % server.server_port,
+                      "page_size": 100, "rate": 100, "burst": 5}, **settings)
+                for name in names]
+
+    def test_pull_orders(self, client):
+        import asyncio
+        from ecomsync.connectors import ConnectorScheduler
+        from ecomsync.standin import StandInMarketplace, serve
+        app = client.application
+        marketplace = StandInMarketplace(orders=250)
+        server = serve(marketplace)
+        app.config["MARKETPLACE_ACCOUNTS"] = self._accounts(server, ["a", "b", "c"])
+        try:
+            scheduler = ConnectorScheduler.from_app(app)
+            stats = asyncio.run(scheduler.run())
+            assert {name: (s["pages"], s["orders"], s["error"]) for name, s in stats.items()} \
+                == {"a": (3, 250, None), "b": (3, 250, None), "c": (3, 250, None)}
+            # One kept alive connection per account for all of its pages
+            assert scheduler.http.opened == 3 and marketplace.requests == 9
+            with app.app_context():
+                assert Order.query.count() == 753
+                # Timestamps are stored in naive UTC
+                assert Order.query.filter_by(date_added=datetime(2024, 1, 1)).count() == 3
+                assert {c.account: c.cursor for c in MarketplaceCursor.query} \
+                    == {"a": "250", "b": "250", "c": "250"}
+
+            # Resumes from the stored cursors without importing twice
+            runner = app.test_cli_runner()
+            output = runner.invoke(args=["pull-orders", "--account", "a"]).output
+            assert "a: 0 orders in 1 pages" in output
+            with app.app_context():
+                assert Order.query.count() == 753
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_rate_limited(self, client):
+        import asyncio
+        from ecomsync.connectors import ConnectorScheduler
+        from ecomsync.standin import StandInMarketplace, serve
+        app = client.application
+        marketplace = StandInMarketplace(orders=30, rate=20)
+        server = serve(marketplace)
+        try:
+            accounts = self._accounts(server, ["a", "b"], page_size=5)
+            stats = asyncio.run(ConnectorScheduler(app, accounts).run())
+            assert marketplace.rejected > 0
+            assert sum(s["rate_limited"] for s in stats.values()) == marketplace.rejected
+            assert all(s["orders"] == 30 and s["error"] is None for s in stats.values())
+            with app.app_context():
+                assert Order.query.count() == 63
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_failing_account(self, client):
+        import asyncio
+        from ecomsync.connectors import ConnectorScheduler
+        from ecomsync.standin import StandInMarketplace, serve
+        app = client.application
+        server = serve(StandInMarketplace(orders=10))
+        try:
+            accounts = self._accounts(server, ["up"]) + [
+                {"name": "down", "connector": "ecomsync.standin.StandInConnector",
+                 "base_url": "http://127.0.0.1:1"}]
+            stats = asyncio.run(ConnectorScheduler(app, accounts, retries=2, backoff=0.01).run())
+            assert stats["up"]["orders"] == 10 and stats["up"]["error"] is None
+            assert stats["down"]["retries"] == 2 and "failed" in stats["down"]["error"]
+            with app.app_context():
+                assert [c.account for c in MarketplaceCursor.query] == ["up"]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_http_pool(self):
+        import asyncio
+        import socket
+        from ecomsync.connectors import HttpPool, RequestNotSent
+        received = []
+
+        async def handle(reader, writer):
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                method, path, _ = head.split(b" ", 2)
+                received.append(method + b" " + path)
+                if path == b"/drop":
+                    # Reads the request and closes without answering
+                    writer.close()
+                    return
+                status = b"204 No Content" if path == b"/empty" else b"200 OK"
+                # No Content-Length: only these responses may be kept alive
+                writer.write(b"HTTP/1.1 100 Continue\r\n\r\n"
+                             b"HTTP/1.1 " + status + b"\r\n\r\n")
+                await writer.drain()
+
+        async def run():
+            server = await asyncio.start_server(handle, "127.0.0.1", 0)
+            base_url = "http://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            http = HttpPool(timeout=5)
+            try:
+                head = await http.request("HEAD", base_url + "/head")
+                empty = await http.request("DELETE", base_url + "/empty")
+                assert (head.status, head.body, empty.status, empty.body) \
+                    == (200, b"", 204, b"")
+                # The answers ended without waiting for the connection to close
+                assert http.opened == 1
+                # A kept connection failing after the request was sent
+                with pytest.raises(OSError):
+                    await http.request("POST", base_url + "/drop", body=b"{}")
+                await http.request("HEAD", base_url + "/head")
+                with pytest.raises(OSError):
+                    await http.request("GET", base_url + "/drop")
+                # Nothing listens on a port just released
+                with socket.socket() as sock:
+                    sock.bind(("127.0.0.1", 0))
+                    closed_url = "http://127.0.0.1:%d/" % sock.getsockname()[1]
+                with pytest.raises(RequestNotSent):
+                    await http.request("POST", closed_url, body=b"{}")
+            finally:
+                await http.close()
+                server.close()
+            return http.opened
+
+        assert asyncio.run(run()) == 3
+        # Only the idempotent request was sent again on a new connection
+        assert received == [b"HEAD /head", b"DELETE /empty", b"POST /drop", b"HEAD /head",
+                            b"GET /drop", b"GET /drop"]
+
+
+class TestOrderPush(object):
+
+    @staticmethod
+    def _targets(server, **settings):
+        base_url = "http://127.0.0.1:%d" % server.server_port
+        return [
+            dict({"name": "woo", "platform": "ecomsync.push.WooCommercePlatform",
+                  "base_url": base_url, "consumer_key": "ck_test",
+                  "consumer_secret": "cs_test"}, **settings),
+            dict({"name": "oc", "platform": "ecomsync.push.OpenCartPlatform",
+                  "base_url": base_url, "api_token": "test"}, **settings),
+        ]
+
+    def test_push_orders(self, client):
+        import asyncio
+        from ecomsync.push import PushScheduler
+        from ecomsync.standin import MockStore, serve
+        app = client.application
+        store = MockStore(failures=1)
+        server = serve(store)
+        app.config["PUSH_TARGETS"] = self._targets(server, batch_size=2)
+        try:
+            with app.app_context():
+                db.session.get(Order, 2).email = ""
+                db.session.commit()
+            scheduler = PushScheduler.from_app(app)
+            scheduler.backoff = 0.01
+            stats = asyncio.run(scheduler.run())
+            assert {name: (s["batches"], s["orders"], s["rejected"], s["error"])
+                    for name, s in stats.items()} == {"woo": (2, 2, 1, None),
+                                                      "oc": (2, 2, 1, None)}
+            # The first request got 503 and was sent again
+            assert sum(s["retries"] for s in stats.values()) == 1
+            assert sorted(doc["billing"]["email"] for doc in store.woocommerce) \
+                == ["mithum@gmail.com", "roshan@gmail.com"]
+            assert sorted(doc["comment"] for doc in store.opencart) \
+                == ["ecomsync order 1", "ecomsync order 3"]
+            with app.app_context():
+                marks = {c.target: c.seq for c in PushCursor.query}
+                assert marks["woo"] == marks["oc"] == stats["woo"]["mark"] > 0
+
+            # Only orders inserted after the mark are pushed
+            client.post("/api/order/", json=TestOrderBatch._order(email="new@example.com"))
+            runner = app.test_cli_runner()
+            output = runner.invoke(args=["push-orders", "--target", "woo"]).output
+            assert "woo: 1 orders in 1 batches" in output
+            assert [doc["billing"]["email"] for doc in store.woocommerce[2:]] \
+                == ["new@example.com"]
+            assert len(store.opencart) == 2
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_failed_batches(self, client):
+        import asyncio
+        from ecomsync.push import PushScheduler
+        from ecomsync.standin import MockStore, serve
+        app = client.application
+        store = MockStore(latency=0.05)
+        server = serve(store)
+        try:
+            woo, oc = self._targets(server, batch_size=1)
+            woo["consumer_secret"] = "wrong"
+            stats = asyncio.run(PushScheduler(app, [woo], retries=1, backoff=0.01).run())
+            # Refused credentials are not retried
+            assert stats["woo"]["retries"] == 0 and "401" in stats["woo"]["error"]
+
+            # The first batch fails again after its retry: the target stops
+            # before sending the other batches, and its mark stays put
+            store.failures = store.requests + 2
+            stats = asyncio.run(PushScheduler(app, [oc], max_in_flight=1, retries=1,
+                                              backoff=0.01).run())
+            assert stats["oc"]["retries"] == 1 and "503" in stats["oc"]["error"]
+            assert stats["oc"]["batches"] == 0 and store.opencart == []
+            with app.app_context():
+                assert PushCursor.query.count() == 0
+
+            store.max_in_flight = 0
+            stats = asyncio.run(PushScheduler(app, [oc], max_in_flight=2).run())
+            assert stats["oc"]["error"] is None and len(store.opencart) == 3
+            assert store.max_in_flight == 2
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_lost_answers(self, client):
+        import asyncio
+        from ecomsync.connectors import HttpPool, RequestNotSent
+        from ecomsync.push import PushScheduler
+        from ecomsync.standin import MockStore, serve
+        app = client.application
+        store = MockStore()
+        server = serve(store)
+        failures = []
+
+        class FlakyPool(HttpPool):
+            async def request(self, method, url, headers=None, body=None):
+                failure = failures.pop(0) if failures else None
+                if failure == "connect":
+                    raise RequestNotSent("%s %s failed" % (method, url))
+                response = await super().request(method, url, headers, body)
+                if failure == "answer":
+                    raise OSError("%s %s failed" % (method, url))
+                return response
+
+        try:
+            woo, _ = self._targets(server)
+            # A batch that never reached the store is sent again
+            failures[:] = ["connect"]
+            stats = asyncio.run(PushScheduler(app, [woo], http=FlakyPool(),
+                                              backoff=0.01).run())
+            assert stats["woo"]["retries"] == 1 and stats["woo"]["error"] is None
+            assert len(store.woocommerce) == 3
+
+            # One whose answer was lost is not, its orders were created
+            with app.app_context():
+                PushCursor.query.delete()
+                db.session.commit()
+            failures[:] = ["answer"]
+            stats = asyncio.run(PushScheduler(app, [woo], http=FlakyPool(),
+                                              backoff=0.01).run())
+            assert stats["woo"]["retries"] == 0 and "failed" in stats["woo"]["error"]
+            assert len(store.woocommerce) == 6 and store.requests == 2
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_settled_batches(self, client):
+        import asyncio
+        from ecomsync.connectors import HttpPool, HttpResponse, RequestNotSent
+        from ecomsync.push import PushScheduler
+        from ecomsync.standin import MockStore, serve
+        app = client.application
+        store = MockStore()
+        server = serve(store)
+        failures = {}
+
+        class FlakyPool(HttpPool):
+            # Fails the batch holding the order with the given e-mail
+            async def request(self, method, url, headers=None, body=None):
+                failure = next((failure for email, failure in failures.items()
+                                if email.encode() in body), None)
+                if failure == "connect":
+                    await asyncio.sleep(0.05)
+                    raise RequestNotSent("%s %s failed" % (method, url))
+                if failure == "refuse":
+                    return HttpResponse(400, {}, b'{"code": "invalid"}')
+                response = await super().request(method, url, headers, body)
+                if failure == "bad gateway":
+                    return HttpResponse(502, {}, b"")
+                return response
+
+        def push():
+            return asyncio.run(PushScheduler(app, [woo], http=FlakyPool(), max_in_flight=3,
+                                             retries=0).run())["woo"]
+
+        def pushed():
+            return sorted(doc["billing"]["email"] for doc in store.woocommerce)
+
+        try:
+            woo, _ = self._targets(server, batch_size=1)
+            # The batches around a failed one are sent at the same time;
+            # the last one is recorded, so only the failed one is sent again
+            failures["dilshani@gmail.com"] = "connect"
+            stats = push()
+            assert stats["batches"] == 2 and "failed" in stats["error"]
+            assert pushed() == ["mithum@gmail.com", "roshan@gmail.com"]
+            with app.app_context():
+                first = PushCursor.query.one().seq
+                assert [(b.status, b.first_seq) for b in PushBatch.query] \
+                    == [("accepted", first + 2)]
+            failures.clear()
+            stats = push()
+            assert stats["batches"] == 1 and stats["error"] is None
+            assert pushed() == ["dilshani@gmail.com", "mithum@gmail.com", "roshan@gmail.com"]
+            with app.app_context():
+                assert PushCursor.query.one().seq == first + 2
+                assert PushBatch.query.count() == 0
+
+            # A refused batch is a dead letter and does not hold back the
+            # others; a 502 may come after the orders were created, so it
+            # is not retried
+            for email, failure in [("refused", "refuse"), ("ok", None),
+                                   ("gateway", "bad gateway"), ("later", None)]:
+                client.post("/api/order/", json=TestOrderBatch._order(
+                    email="%s@example.com" % email)).get_data()
+            failures.update({"refused@example.com": "refuse",
+                             "gateway@example.com": "bad gateway"})
+            stats = push()
+            assert (stats["batches"], stats["dead_letters"]) == (2, 1)
+            assert stats["retries"] == 0 and "502" in stats["error"]
+            assert pushed() == ["dilshani@gmail.com", "gateway@example.com", "later@example.com",
+                                "mithum@gmail.com", "ok@example.com", "roshan@gmail.com"]
+            with app.app_context():
+                assert PushCursor.query.one().seq == first + 4
+                letter, later = PushBatch.query.order_by(PushBatch.first_seq)
+                assert (letter.status, letter.first_seq) == ("failed", first + 3)
+                assert "400" in letter.error
+                assert (later.status, later.first_seq) == ("accepted", first + 6)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestMetrics(object):
+
+    @staticmethod
+    def _samples(client):
+        resp = client.get("/metrics")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        samples = {}
+        for line in resp.get_data(as_text=True).splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_endpoint_metrics(self, client):
+        sizes = [len(client.get("/api/product/").get_data()) for _ in range(3)]
+        client.get("/api/product/1").get_data()
+        client.get("/api/nothing-here").get_data()
+        samples = self._samples(client)
+
+        labels = 'endpoint="api.productitem",method="GET"'
+        assert samples['ecomsync_http_requests_total{%s,status="200"}' % labels] == 3
+        assert samples["ecomsync_http_request_duration_seconds_count{%s}" % labels] == 3
+        assert samples['ecomsync_http_request_duration_seconds_bucket{%s,le="+Inf"}'
+                       % labels] == 3
+        assert samples["ecomsync_http_request_duration_seconds_sum{%s}" % labels] > 0
+        assert samples["ecomsync_http_response_size_bytes_sum{%s}" % labels] == sum(sizes)
+        # The first request reads the products, the others hit the cache
+        assert samples["ecomsync_http_request_sql_queries_sum{%s}" % labels] >= 1
+        assert samples['ecomsync_http_request_sql_queries_bucket{%s,le="0"}' % labels] == 2
+        assert samples["ecomsync_http_request_sql_seconds_total{%s}" % labels] > 0
+        assert samples['ecomsync_http_requests_total{endpoint="api.ProductIndividualItem",'
+                       'method="GET",status="200"}'] == 1
+        assert samples['ecomsync_http_requests_total{endpoint="unmatched",'
+                       'method="GET",status="404"}'] == 1
+        # The SQL of create_all() and the fixture ran outside any request
+        assert samples["ecomsync_background_sql_queries_total"] > 0
+
+    def test_batched_writes(self, client):
+        assert client.application.config["WRITE_BATCHING"]
+        resp = client.post("/api/order/", json=TestOrderBatch._order())
+        assert resp.status_code == 201
+        resp.get_data()
+        samples = self._samples(client)
+        # The INSERT ran on the writer thread but counts for the request
+        labels = 'endpoint="api.orderitem",method="POST"'
+        assert samples["ecomsync_http_request_sql_queries_sum{%s}" % labels] >= 1
+        assert samples['ecomsync_http_request_sql_queries_bucket{%s,le="0"}' % labels] == 0
+        assert samples["ecomsync_http_request_sql_seconds_total{%s}" % labels] > 0
+
+    def test_threads(self, client):
+        import threading
+        app = client.application
+
+        def requests():
+            local = app.test_client()
+            for _ in range(10):
+                local.get("/api/product/1").get_data()
+
+        threads = [threading.Thread(target=requests) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # The shards of the exited threads are folded in once, not twice
+        for _ in range(2):
+            samples = self._samples(client)
+            assert samples['ecomsync_http_request_duration_seconds_count{'
+                           'endpoint="api.ProductIndividualItem",method="GET"}'] == 40
+
+    def test_failing_statement(self, client):
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+        app = client.application
+        metrics = app.extensions["ecomsync_metrics"]
+        with app.app_context():
+            connection = db.session.connection()
+            info = copy.deepcopy(connection.info)
+            queries = metrics.collect()[1][0]
+            for _ in range(3):
+                with pytest.raises(OperationalError):
+                    connection.execute(text("SELECT * FROM no_such_table"))
+                db.session.rollback()
+                connection = db.session.connection()
+            connection.execute(text("SELECT 1"))
+            # Nothing of the failed statements is left on the connection
+            assert connection.info == info
+            assert metrics.collect()[1][0] == queries + 1
+
+    def test_disabled(self):
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+                          "TESTING": True, "CACHE_TYPE": "NullCache",
+                          "METRICS_ENABLED": False})
+        try:
+            assert app.test_client().get("/metrics").status_code == 404
+            assert "ecomsync_metrics" not in app.extensions
+        finally:
+            os.close(db_fd)
+            os.unlink(db_fname)
+
+
+class TestQueryCheck(object):
+
+    def test_statement_shape(self):
+        from ecomsync.querycheck import statement_shape
+        assert statement_shape("SELECT * FROM product WHERE product_id = 12 AND name = 'a''b'") \
+            == statement_shape("SELECT *\n FROM product WHERE product_id = 3 AND name = 'c'") \
+            == "SELECT * FROM product WHERE product_id = ? AND name = ?"
+        assert statement_shape("SELECT * FROM product_1 WHERE id IN (?, ?, ?)") \
+            == statement_shape("SELECT * FROM product_1 WHERE id IN (?)") \
+            == "SELECT * FROM product_1 WHERE id IN (?, ...)"
+
+    def test_repeated_statements(self, client, query_budget, caplog):
+        from flask.views import MethodView
+        from ecomsync.querycheck import QueryBudgetExceeded
+
+        class ProductNames(MethodView):
+            def get(self):
+                ids = [p.product_id for p in Product.query.order_by(Product.product_id)]
+                # One query per product, the loop the check should catch
+                return {"names": [Product.query.filter_by(product_id=pid).first().name
+                                  for pid in ids]}
+
+        app = client.application
+        app.add_url_rule("/names", view_func=ProductNames.as_view("names"))
+        app.extensions["ecomsync_query_check"].repeat = 3
+        with pytest.raises(QueryBudgetExceeded) as excinfo:
+            with query_budget() as reports:
+                client.get("/names")
+        assert [report.resource for report in reports] == ["ProductNames.get"]
+        assert reports[0].count == 5
+        message = str(excinfo.value)
+        assert message.startswith("ProductNames.get (/names): 4 x SELECT")
+        assert "WHERE product.product_id = ?" in message
+        assert "tests/resource_test.py:" in message
+        assert "Query check: ProductNames.get (/names): 4 x" in caplog.text
+
+        # Budgets can leave repeated statements alone and count them only
+        with query_budget(5, repeated=False):
+            client.get("/names")
+        with pytest.raises(QueryBudgetExceeded, match="5 statements, budget 4"):
+            with query_budget(4, repeated=False):
+                client.get("/names")
+
+    def test_slow_statements(self, client, query_budget):
+        from ecomsync.querycheck import QueryBudgetExceeded
+        client.application.extensions["ecomsync_query_check"].slow_seconds = 0
+        with query_budget():
+            client.get("/api/order/")
+        with pytest.raises(QueryBudgetExceeded, match=r"OrderItem.get \(/api/order/\): [0-9.]+ "
+                                                      r"ms SELECT .* \[at ecomsync/"):
+            with query_budget(slow=True):
+                client.get("/api/order/")
+
+    def test_failing_statement(self, client, query_budget):
+        from flask.views import MethodView
+        from sqlalchemy import text
+        from sqlalchemy.exc import OperationalError
+        infos = []
+
+        class Failing(MethodView):
+            def get(self):
+                with pytest.raises(OperationalError):
+                    db.session.execute(text("SELECT * FROM no_such_table"))
+                db.session.rollback()
+                db.session.execute(text("SELECT 1"))
+                infos.append(copy.deepcopy(db.session.connection().info))
+                return {}
+
+        client.application.add_url_rule("/failing", view_func=Failing.as_view("failing"))
+        with query_budget() as reports:
+            for _ in range(3):
+                client.get("/failing")
+        # Only the statements that ran are recorded, and nothing of the
+        # failed ones is left on the connection
+        assert [report.count for report in reports] == [1, 1, 1]
+        assert infos[0] == infos[1] == infos[2]
+
+    def test_writes_and_streams(self, client, query_budget):
+        # The write runs on the writer thread and the stream after the
+        # request's teardown, both still count for their request
+        with query_budget() as reports:
+            client.post("/api/order/", json=TestOrderBatch._order(email="new@example.com"))
+            client.get("/api/order/?stream=ndjson").get_data()
+        assert [report.resource for report in reports] == ["OrderItem.post", "OrderItem.get"]
+        assert any(statement.startswith('INSERT INTO "order"')
+                   for statement, _, _ in reports[0].statements)
+        assert reports[1].count == 1